@@ -1,4 +1,8 @@
 import os.path
+import shutil
+import tempfile
+
+from django.test import override_settings
 
 import mock
 
@@ -7,6 +11,8 @@ from rest_framework.test import APITestCase
 
 from six.moves.urllib.parse import urlparse
 
+from .v3.views import log_events
+
 
 def authenticate(client, username=None, token=None):
     if token is None:
@@ -19,6 +25,8 @@ class APIv1Tests(APITestCase):
     base_url = '/api/v1/'
     source_should_be_embedded_in_build = False
     build_includes_duration = False
+    source_includes_checkout_mode = False
+    build_includes_phases = False
 
     def __init__(self, *args, **kwargs):
         super(APIv1Tests, self).__init__(*args, **kwargs)
@@ -245,7 +253,8 @@ class APIv1Tests(APITestCase):
     def test_fetch_builds(self):
         authenticate(self.client, 'eric')
         # 3 queries: Authenticate, count results, fetch results
-        with self.assertNumQueries(3):
+        # (and one more to fetch all their phases, if included)
+        with self.assertNumQueries(self.build_includes_phases and 4 or 3):
             response = self.client.get(self.build_list_url)
 
         self.assertEquals(response.status_code, 200)
@@ -339,6 +348,9 @@ class APIv1Tests(APITestCase):
         self.assertTrue(response.data['self'].startswith('http://testserver' + self.source_list_url), response.data['self'])
         data['self'] = response.data['self']
         data['builds'] = data['self'] + 'builds/'
+        if self.source_includes_checkout_mode:
+            data['checkout_mode'] = 'full'
+            data['checkout_depth'] = 1
         self.assertEquals(response.data, data)
 
         response = self.client.get(data['self'])
@@ -1057,6 +1069,53 @@ class APIv3Tests(APIv2Tests):
     base_url = '/api/v3/'
     source_should_be_embedded_in_build = True
     build_includes_duration = True
+    source_includes_checkout_mode = True
+    build_includes_phases = True
+
+    def test_create_shallow_source(self):
+        authenticate(self.client, 'eric')
+        response = self.client.get(self.repository_list_url)
+
+        data = {'git_repository': 'https://github.com/sorenh/buildsvctest',
+                'git_branch': 'master',
+                'repository': response.data['results'][0]['self'],
+                'checkout_mode': 'shallow',
+                'checkout_depth': 5}
+
+        response = self.client.post(self.source_list_url, data, format='json')
+
+        self.assertEquals(response.status_code, 201)
+        self.assertEquals(response.data['checkout_mode'], 'shallow')
+        self.assertEquals(response.data['checkout_depth'], 5)
+
+    def test_create_source_invalid_checkout_mode(self):
+        authenticate(self.client, 'eric')
+        response = self.client.get(self.repository_list_url)
+
+        data = {'git_repository': 'https://github.com/sorenh/buildsvctest',
+                'git_branch': 'master',
+                'repository': response.data['results'][0]['self'],
+                'checkout_mode': 'sideways'}
+
+        response = self.client.post(self.source_list_url, data, format='json')
+
+        self.assertEquals(response.status_code, 400)
+        self.assertIn('checkout_mode', response.data)
+
+    def test_create_source_invalid_checkout_depth(self):
+        authenticate(self.client, 'eric')
+        response = self.client.get(self.repository_list_url)
+
+        data = {'git_repository': 'https://github.com/sorenh/buildsvctest',
+                'git_branch': 'master',
+                'repository': response.data['results'][0]['self'],
+                'checkout_mode': 'shallow',
+                'checkout_depth': 0}
+
+        response = self.client.post(self.source_list_url, data, format='json')
+
+        self.assertEquals(response.status_code, 400)
+        self.assertIn('checkout_depth', response.data)
 
     def test_build_duration(self):
         authenticate(self.client, 'eric')
@@ -1067,6 +1126,164 @@ class APIv3Tests(APIv2Tests):
             else:
                 self.assertEquals(result['duration'], None)
 
+    @mock.patch('aasemble.django.apps.buildsvc.tasks.dispatch_builds')
+    def test_repository_queue(self, dispatch_builds):
+        from aasemble.django.apps.buildsvc.models import PackageSource, Repository
+
+        PackageSource.objects.get(id=1).build()
+        PackageSource.objects.get(id=13).build()
+
+        authenticate(self.client, 'eric')
+        repository = Repository.objects.get(id=4)
+        response = self.client.get('%s%s/queue/' % (self.repository_list_url, repository.uuid))
+
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response.data['depth'], 2)
+        self.assertEquals(len(response.data['builds']), 1)
+        self.assertEquals(response.data['builds'][0]['state'], 'queued')
+        self.assertIsNotNone(response.data['builds'][0]['estimated_start'])
+        self.assertTrue(response.data['builds'][0]['source'].endswith('/sources/%s/' % (PackageSource.objects.get(id=1).uuid,)))
+
+    def _add_phases(self):
+        from django.utils import timezone
+        from aasemble.django.apps.buildsvc.models import BuildRecord
+
+        for br_id, checkout, binary_build in [(1, 1.0, 10.0), (2, 2.0, 20.0), (3, 3.0, 30.0)]:
+            br = BuildRecord.objects.get(id=br_id)
+            br.phases.create(name='checkout', started=timezone.now(), duration=checkout)
+            br.phases.create(name='binary_build', started=timezone.now(), duration=binary_build)
+
+    def test_builds_include_phases(self):
+        self._add_phases()
+
+        authenticate(self.client, 'eric')
+        response = self.client.get(self.build_list_url)
+
+        phases = dict((result['sha'], result['phases']) for result in response.data['results'])
+        self.assertEquals([(phase['name'], phase['duration']) for phase in phases['5e1fafbd71e94e58a7280c92550a0be2']],
+                          [('checkout', 2.0), ('binary_build', 20.0)])
+
+    def test_repository_build_phases(self):
+        from aasemble.django.apps.buildsvc.models import Repository
+
+        self._add_phases()
+
+        authenticate(self.client, 'eric')
+        repository = Repository.objects.get(id=4)
+        response = self.client.get('%s%s/build_phases/' % (self.repository_list_url, repository.uuid))
+
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response.data['checkout'], {'count': 3, 'mean': 2.0, 'p50': 2.0, 'p90': 3.0, 'p99': 3.0})
+        self.assertEquals(response.data['binary_build']['p50'], 20.0)
+
+    def test_repository_build_phases_invalid_days(self):
+        from aasemble.django.apps.buildsvc.models import Repository
+
+        authenticate(self.client, 'eric')
+        repository = Repository.objects.get(id=4)
+        response = self.client.get('%s%s/build_phases/?days=many' % (self.repository_list_url, repository.uuid))
+
+        self.assertEquals(response.status_code, 400)
+
+    def test_repository_queue_other_users_repository(self):
+        from aasemble.django.apps.buildsvc.models import Repository
+
+        authenticate(self.client, 'eric')
+        repository = Repository.objects.get(id=3)
+        response = self.client.get('%s%s/queue/' % (self.repository_list_url, repository.uuid))
+
+        self.assertEquals(response.status_code, 404)
+
+    def _write_build_log(self, data, complete=True):
+        from aasemble.django.apps.buildsvc.models import BuildRecord
+
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        settings = override_settings(BUILDSVC_REPOS_BASE_PUBLIC_DIR=tmpdir)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        BuildRecord.objects.filter(id=1).update(log_complete=complete)
+        br = BuildRecord.objects.get(id=1)
+        with open(br.buildlog(), 'ab') as fp:
+            fp.write(data)
+        return br
+
+    def test_builds_include_log_status(self):
+        authenticate(self.client, 'eric')
+        response = self.client.get(self.build_list_url)
+
+        self.assertEquals(response.data['results'][0]['log_complete'], False)
+        self.assertEquals(response.data['results'][0]['publish_error'], '')
+
+    def test_build_log_from_offset(self):
+        br = self._write_build_log(b'hello world\n')
+
+        authenticate(self.client, 'eric')
+        response = self.client.get('%s%s/log/?offset=6' % (self.build_list_url, br.uuid))
+
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response.data, {'offset': 6, 'next_offset': 12, 'complete': True, 'data': 'world\n'})
+
+    def test_build_log_does_not_split_characters(self):
+        br = self._write_build_log(b'caf\xc3', complete=False)
+
+        authenticate(self.client, 'eric')
+        response = self.client.get('%s%s/log/' % (self.build_list_url, br.uuid))
+
+        self.assertEquals(response.data, {'offset': 0, 'next_offset': 3, 'complete': False, 'data': 'caf'})
+
+    def test_build_log_waits_for_more(self):
+        br = self._write_build_log(b'hello\n', complete=False)
+
+        def sleep(seconds):
+            with open(br.buildlog(), 'ab') as fp:
+                fp.write(b'world\n')
+
+        authenticate(self.client, 'eric')
+        with mock.patch('aasemble.django.apps.buildsvc.buildlog.time.sleep', side_effect=sleep):
+            response = self.client.get('%s%s/log/?offset=6&wait=10' % (self.build_list_url, br.uuid))
+
+        self.assertEquals(response.data['data'], 'world\n')
+        self.assertEquals(response.data['next_offset'], 12)
+
+    def test_build_log_invalid_offset(self):
+        br = self._write_build_log(b'hello\n')
+
+        authenticate(self.client, 'eric')
+        response = self.client.get('%s%s/log/?offset=start' % (self.build_list_url, br.uuid))
+
+        self.assertEquals(response.status_code, 400)
+
+    def test_build_log_event_stream(self):
+        br = self._write_build_log(b'hello\nworld\n')
+
+        authenticate(self.client, 'eric')
+        response = self.client.get('%s%s/log/' % (self.build_list_url, br.uuid),
+                                   HTTP_ACCEPT='text/event-stream', HTTP_LAST_EVENT_ID='6')
+
+        self.assertEquals(response['Content-Type'], 'text/event-stream')
+        self.assertEquals(b''.join(response.streaming_content),
+                          b'id: 12\ndata: world\ndata: \n\nid: 12\nevent: complete\ndata: \n\n')
+
+    def test_build_log_events_keep_partial_lines(self):
+        events = list(log_events([(b'hel', 3, False), (b'lo\r\nwor', 10, False), (b'ld\n', 13, True)]))
+
+        # Concatenating each event's data lines, joined with newlines,
+        # gives back the log
+        data = ''.join('\n'.join(line[len('data: '):] for line in event.splitlines() if line.startswith('data: '))
+                       for event in events[:-1])
+        self.assertEquals(data, 'hello\nworld\n')
+        self.assertTrue(all(event.endswith('\n\n') and not event.endswith('\n\n\n') for event in events))
+
+    def test_build_log_other_users_build(self):
+        br = self._write_build_log(b'hello\n')
+
+        authenticate(self.client, 'dennis')
+        response = self.client.get('%s%s/log/' % (self.build_list_url, br.uuid))
+
+        self.assertEquals(response.status_code, 404)
+
 
 class GithubHookViewTestCase(APITestCase):
     fixtures = ['complete.json']
@@ -10,6 +10,10 @@ class aaSembleAPIv1Serializers(object):
     snapshots_have_tags = False
     builds_nest_source = False
     include_build_duration = False
+    sources_have_checkout_mode = False
+    builds_have_phases = False
+    builds_have_log_status = False
+    builds_have_publish_error = False
 
     def __init__(self):
         self.MirrorSerializer = self.MirrorSerializerFactory()
@@ -17,6 +21,7 @@ class aaSembleAPIv1Serializers(object):
         self.SnapshotSerializer = self.SnapshotSerializerFactory()
         self.PackageSourceSerializer = self.PackageSourceSerializerFactory()
         self.SeriesSerializer = self.SeriesSerializerFactory()
+        self.BuildPhaseSerializer = self.BuildPhaseSerializerFactory()
         self.BuildRecordSerializer = self.BuildRecordSerializerFactory()
         self.ExternalDependencySerializer = self.ExternalDependencySerializerFactory()
         self.RepositorySerializer = self.RepositorySerializerFactory()
@@ -142,6 +147,8 @@ class aaSembleAPIv1Serializers(object):
             class Meta:
                 model = buildsvc_models.PackageSource
                 fields = ('self', 'git_repository', 'git_branch', 'repository', 'builds')
+                if selff.sources_have_checkout_mode:
+                    fields += ('checkout_mode', 'checkout_depth')
 
             def validate_repository(self, value):
                 return value.first_series()
@@ -163,6 +170,14 @@ class aaSembleAPIv1Serializers(object):
 
         return SeriesSerializer
 
+    def BuildPhaseSerializerFactory(selff):
+        class BuildPhaseSerializer(serializers.ModelSerializer):
+            class Meta:
+                model = buildsvc_models.BuildPhase
+                fields = ('name', 'started', 'duration')
+
+        return BuildPhaseSerializer
+
     def BuildRecordSerializerFactory(selff):
         class BuildRecordSerializer(serializers.HyperlinkedModelSerializer):
             self = serializers.HyperlinkedRelatedField(view_name='{0}_buildrecord-detail'.format(selff.view_prefix), read_only=True, source='*', lookup_field=selff.default_lookup_field)
@@ -170,12 +185,20 @@ class aaSembleAPIv1Serializers(object):
                 source = selff.PackageSourceSerializer()
             else:
                 source = serializers.HyperlinkedRelatedField(view_name='{0}_packagesource-detail'.format(selff.view_prefix), read_only=True, lookup_field=selff.default_lookup_field)
+            if selff.builds_have_phases:
+                phases = selff.BuildPhaseSerializer(many=True, read_only=True)
 
             class Meta:
                 model = buildsvc_models.BuildRecord
                 fields = ('self', 'source', 'version', 'build_started', 'sha', 'buildlog_url')
                 if selff.include_build_duration:
                     fields += ('duration', 'build_finished')
+                if selff.builds_have_phases:
+                    fields += ('phases',)
+                if selff.builds_have_log_status:
+                    fields += ('log_complete',)
+                if selff.builds_have_publish_error:
+                    fields += ('publish_error',)
 
         return BuildRecordSerializer
 
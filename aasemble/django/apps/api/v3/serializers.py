@@ -1,7 +1,29 @@
+from rest_framework import serializers
+
 from aasemble.django.apps.api.v2 import serializers as v2_serializers
+from aasemble.django.apps.buildsvc import models as buildsvc_models
 
 
 class aaSembleAPIv3Serializers(v2_serializers.aaSembleAPIv2Serializers):
     view_prefix = 'v3'
     builds_nest_source = True
     include_build_duration = True
+    sources_have_checkout_mode = True
+    builds_have_phases = True
+    builds_have_log_status = True
+    builds_have_publish_error = True
+
+    def __init__(self):
+        super(aaSembleAPIv3Serializers, self).__init__()
+        self.PendingBuildSerializer = self.PendingBuildSerializerFactory()
+
+    def PendingBuildSerializerFactory(selff):
+        class PendingBuildSerializer(serializers.ModelSerializer):
+            source = serializers.HyperlinkedRelatedField(view_name='{0}_packagesource-detail'.format(selff.view_prefix), read_only=True, lookup_field=selff.default_lookup_field)
+            estimated_start = serializers.DateTimeField(read_only=True)
+
+            class Meta:
+                model = buildsvc_models.PendingBuild
+                fields = ('source', 'state', 'priority', 'queued_at', 'started_at', 'estimated_start')
+
+        return PendingBuildSerializer
@@ -1,8 +1,118 @@
+import datetime
+
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+
+from rest_framework.decorators import detail_route
+from rest_framework.exceptions import ValidationError
+from rest_framework.renderers import BaseRenderer
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+
 from aasemble.django.apps.api.v2.views import aaSembleV2Views
+from aasemble.django.apps.buildsvc import buildlog, scheduler
 
 from . import serializers as serializers_
 
 
+class EventStreamRenderer(BaseRenderer):
+    """Lets clients ask for server-sent events, which views stream themselves"""
+    media_type = 'text/event-stream'
+    format = 'sse'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return data
+
+
+def int_param(request, name, default, value=None):
+    value = value or request.query_params.get(name)
+    if not value:
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        value = -1
+    if value < 0:
+        raise ValidationError({name: 'A valid non-negative integer is required.'})
+    return value
+
+
+def log_events(chunks):
+    """Server-sent events for tail()'s chunks
+
+    Clients join an event's data lines with newlines, so a chunk that
+    ends in a newline ends in an empty data line, and the log can be
+    put back together from the events."""
+    for data, next_offset, complete in chunks:
+        if data:
+            text = data.decode('utf-8', 'replace').replace('\r\n', '\n').replace('\r', '\n')
+            lines = text.split('\n')
+            yield 'id: %d\n%s\n' % (next_offset, ''.join('data: %s\n' % (line,) for line in lines))
+        if complete:
+            yield 'id: %d\nevent: complete\ndata: \n\n' % (next_offset,)
+
+
 class aaSembleV3Views(aaSembleV2Views):
     view_prefix = 'v3'
     serializers = serializers_.aaSembleAPIv3Serializers()
+
+    def RepositoryViewSetFactory(selff):
+        BaseRepositoryViewSet = super(aaSembleV3Views, selff).RepositoryViewSetFactory()
+
+        class RepositoryViewSet(BaseRepositoryViewSet):
+            @detail_route(methods=['get'])
+            def queue(self, request, **kwargs):
+                repository = self.get_object()
+                pending = scheduler.queue_status()
+                builds = [pb for pb in pending if pb.repository_id == repository.id]
+                serializer = selff.serializers.PendingBuildSerializer(builds, many=True, context={'request': request})
+                return Response({'depth': len([pb for pb in pending if pb.state == pb.QUEUED]),
+                                 'builds': serializer.data})
+
+            @detail_route(methods=['get'])
+            def build_phases(self, request, **kwargs):
+                repository = self.get_object()
+                try:
+                    days = int(request.query_params.get('days', 30))
+                except ValueError:
+                    raise ValidationError({'days': 'A valid integer is required.'})
+                since = timezone.now() - datetime.timedelta(days=days)
+                return Response(repository.build_phase_statistics(since=since))
+
+        return RepositoryViewSet
+
+    def BuildViewSetFactory(selff):
+        BaseBuildViewSet = super(aaSembleV3Views, selff).BuildViewSetFactory()
+
+        class BuildViewSet(BaseBuildViewSet):
+            queryset = BaseBuildViewSet.queryset.prefetch_related('phases')
+
+            @detail_route(methods=['get'], renderer_classes=list(api_settings.DEFAULT_RENDERER_CLASSES) + [EventStreamRenderer])
+            def log(self, request, **kwargs):
+                """The build log from the given byte offset onwards
+
+                With ?wait=N, waits up to N seconds for more to be
+                written. Clients that accept text/event-stream get the
+                log as server-sent events until the build is done."""
+                build = self.get_object()
+                limit = getattr(settings, 'BUILDSVC_BUILD_LOG_CHUNK_SIZE', 1024 * 1024)
+
+                if request.accepted_renderer.format == EventStreamRenderer.format:
+                    offset = int_param(request, 'offset', 0, request.META.get('HTTP_LAST_EVENT_ID'))
+                    timeout = getattr(settings, 'BUILDSVC_BUILD_LOG_STREAM_TIMEOUT', 300)
+                    chunks = buildlog.tail(build, offset, timeout=timeout, limit=limit)
+                    response = StreamingHttpResponse(log_events(chunks), content_type='text/event-stream')
+                    response['Cache-Control'] = 'no-cache'
+                    return response
+
+                offset = int_param(request, 'offset', 0)
+                wait = min(int_param(request, 'wait', 0), getattr(settings, 'BUILDSVC_BUILD_LOG_MAX_WAIT', 30))
+                data, next_offset, complete = next(buildlog.tail(build, offset, timeout=wait, limit=limit))
+                return Response({'offset': offset,
+                                 'next_offset': next_offset,
+                                 'complete': complete,
+                                 'data': data.decode('utf-8', 'replace')})
+
+        return BuildViewSet
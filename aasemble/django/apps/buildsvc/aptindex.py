@@ -0,0 +1,305 @@
+import email.utils
+import gzip
+import hashlib
+import io
+import itertools
+import logging
+import os
+import os.path
+import time
+
+import deb822
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+
+from . import signing
+from .artifactstore import get_artifact_store
+from .buildcache import read_control
+from .models import PublishedIndex, PublishedIndexFile, PublishedPackage, RepositoryDriver, ensure_dir, link_or_copy
+from ...utils import run_cmd
+
+LOG = logging.getLogger(__name__)
+
+COMPONENT = 'main'
+BINARY_ARCHITECTURES = ('amd64',)
+COMPRESSIONS = ('', '.gz', '.xz')
+
+
+def file_hashes(path):
+    """Size, MD5, SHA1 and SHA256 of the file at path"""
+    hashes = [hashlib.md5(), hashlib.sha1(), hashlib.sha256()]
+    size = 0
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(65536), b''):
+            size += len(chunk)
+            for h in hashes:
+                h.update(chunk)
+    return (size,) + tuple(h.hexdigest() for h in hashes)
+
+
+def gzip_data(data):
+    out = io.BytesIO()
+    # A fixed mtime keeps the output, and so its hash, reproducible
+    with gzip.GzipFile(fileobj=out, mode='wb', mtime=0) as gz:
+        gz.write(data)
+    return out.getvalue()
+
+
+def write_xz(src, dst):
+    tmppath = '%s.tmp' % (dst,)
+    with open(tmppath, 'wb') as fp:
+        run_cmd(['xz', '-c', src], stdout=fp, discard_stderr=True)
+    os.rename(tmppath, dst)
+
+
+def by_hash_grace_period():
+    return getattr(settings, 'BUILDSVC_BY_HASH_GRACE_PERIOD', 24 * 3600)
+
+
+def pool_dir(component, source):
+    prefix = source[:4] if source.startswith('lib') else source[:1]
+    return 'pool/%s/%s/%s' % (component, prefix, source)
+
+
+def index_architectures(architecture):
+    """The indexes a package of the given architecture appears in"""
+    if architecture == 'all':
+        return list(BINARY_ARCHITECTURES)
+    return [architecture]
+
+
+def write_file(path, data):
+    """Replace path with data without readers ever seeing half a file"""
+    ensure_dir(os.path.dirname(path))
+    tmppath = '%s.tmp' % (path,)
+    with open(tmppath, 'wb') as fp:
+        fp.write(data)
+    os.rename(tmppath, path)
+
+
+def binary_stanza(control, filename, hashes):
+    size, md5sum, sha1, sha256 = hashes
+    control['Filename'] = filename
+    control['Size'] = str(size)
+    control['MD5sum'] = md5sum
+    control['SHA1'] = sha1
+    control['SHA256'] = sha256
+    return control.dump()
+
+
+def file_list(entries):
+    return ''.join('\n %s %s %s' % entry for entry in entries)
+
+
+def source_stanza(dsc, directory, dsc_name, hashes):
+    size, md5sum, sha1, sha256 = hashes
+    stanza = deb822.Deb822()
+    stanza['Package'] = dsc['Source']
+    for key in dsc:
+        if key not in ('Source', 'Files', 'Checksums-Sha1', 'Checksums-Sha256'):
+            stanza[key] = dsc[key]
+    stanza['Directory'] = directory
+    md5sums = [(f['md5sum'], f['size'], f['name']) for f in dsc['Files']]
+    sha256s = [(f['sha256'], f['size'], f['name']) for f in dsc.get('Checksums-Sha256', [])]
+    stanza['Files'] = file_list([(md5sum, size, dsc_name)] + md5sums)
+    stanza['Checksums-Sha256'] = file_list([(sha256, size, dsc_name)] + sha256s)
+    return stanza.dump()
+
+
+class AptIndexDriver(RepositoryDriver):
+    """Publishes repositories without reprepro
+
+    Package metadata lives in the database (see PublishedPackage), and
+    the driver writes Packages, Sources and Release files itself. An
+    include only reads the packages being included, and an export only
+    rewrites the indexes those packages are in, so publishing costs the
+    same however many packages the repository already has.
+
+    Select it by setting BUILDSVC_REPODRIVER to
+    'aasemble.django.apps.buildsvc.aptindex.AptIndexDriver'."""
+    def outdir(self):
+        return self.repository.outdir()
+
+    def distdir(self, series):
+        return os.path.join(self.outdir(), 'dists', series.name)
+
+    def add_to_pool(self, path, directory):
+        filename = os.path.join(directory, os.path.basename(path))
+        dest = os.path.join(self.outdir(), filename)
+        ensure_dir(os.path.dirname(dest))
+        store = get_artifact_store()
+        if store:
+            store.link(path, dest)
+        else:
+            if os.path.exists(dest):
+                os.unlink(dest)
+            link_or_copy(path, dest)
+        return filename
+
+    def remove_from_pool(self, filenames):
+        published = PublishedPackage.objects.filter(series__repository=self.repository)
+        store = get_artifact_store()
+        for filename in filenames:
+            # files holds one filename per line
+            listed = Q(files=filename) | Q(files__startswith=filename + '\n') | Q(files__endswith='\n' + filename) | Q(files__contains='\n' + filename + '\n')
+            if not published.filter(listed).exists():
+                path = os.path.join(self.outdir(), filename)
+                if not os.path.exists(path):
+                    continue
+                if store:
+                    store.unlink(path)
+                else:
+                    os.unlink(path)
+
+    def mark_dirty(self, series, architectures):
+        architectures = set(itertools.chain(*[index_architectures(arch) for arch in architectures]))
+        for architecture in architectures:
+            PublishedIndex.objects.get_or_create(series=series, component=COMPONENT, architecture=architecture)
+        PublishedIndex.objects.filter(series=series, component=COMPONENT,
+                                      architecture__in=architectures).update(dirty=True)
+
+    def replace(self, series, architecture, name, source, version, stanza, filenames):
+        """Publish a package in place of any other version of it"""
+        old = PublishedPackage.objects.filter(series=series, component=COMPONENT,
+                                              architecture=architecture, name=name).first()
+        PublishedPackage.objects.update_or_create(series=series, component=COMPONENT,
+                                                  architecture=architecture, name=name,
+                                                  defaults={'source': source,
+                                                            'version': version,
+                                                            'stanza': stanza,
+                                                            'files': '\n'.join(filenames)})
+        if old:
+            self.remove_from_pool(set(old.file_list()) - set(filenames))
+        self.mark_dirty(series, [architecture])
+
+    def include(self, series_name, changes_file):
+        series = self.repository.series.get(name=series_name)
+        srcdir = os.path.dirname(changes_file)
+        with open(changes_file, 'r') as fp:
+            changes = deb822.Changes(fp)
+
+        source = changes['Source'].split(' ')[0]
+        directory = pool_dir(COMPONENT, source)
+        for f in changes['Files']:
+            path = os.path.join(srcdir, f['name'])
+            if f['name'].endswith('.deb'):
+                control = read_control(path)
+                filename = self.add_to_pool(path, directory)
+                stanza = binary_stanza(control, filename, file_hashes(path))
+                self.replace(series, control['Architecture'], control['Package'], source,
+                             control['Version'], stanza, [filename])
+            elif f['name'].endswith('.dsc'):
+                with open(path, 'r') as fp:
+                    dsc = deb822.Dsc(fp)
+                stanza = source_stanza(dsc, directory, f['name'], file_hashes(path))
+                filenames = [self.add_to_pool(path, directory)]
+                filenames += [self.add_to_pool(os.path.join(srcdir, df['name']), directory) for df in dsc['Files']]
+                self.replace(series, 'source', dsc['Source'], source, dsc['Version'], stanza, filenames)
+
+    def remove(self, series_name, source_name):
+        series = self.repository.series.get(name=series_name)
+        packages = list(PublishedPackage.objects.filter(series=series, source=source_name))
+        PublishedPackage.objects.filter(id__in=[p.id for p in packages]).delete()
+        self.remove_from_pool(set(itertools.chain(*[p.file_list() for p in packages])))
+        self.mark_dirty(series, set(p.architecture for p in packages))
+
+    def by_hash_path(self, series, path, sha256):
+        return os.path.join(self.distdir(series), os.path.dirname(path), 'by-hash', 'SHA256', sha256)
+
+    def write_index(self, series, index):
+        packages = PublishedPackage.objects.filter(series=series, component=index.component)
+        if index.architecture == 'source':
+            packages = packages.filter(architecture='source')
+        else:
+            packages = packages.filter(architecture__in=[index.architecture, 'all'])
+
+        data = '\n'.join(p.stanza.rstrip('\n') + '\n' for p in packages.order_by('name', 'architecture')).encode('utf-8')
+        basepath = os.path.join(self.distdir(series), index.path)
+        write_file(basepath, data)
+        write_file(basepath + '.gz', gzip_data(data))
+        write_xz(basepath, basepath + '.xz')
+
+        with transaction.atomic():
+            previous = dict((f.path, f.sha256) for f in index.files.all())
+            index.files.all().delete()
+            for suffix in COMPRESSIONS:
+                path = index.path + suffix
+                size, md5sum, sha1, sha256 = file_hashes(os.path.join(self.distdir(series), path))
+
+                by_hash = self.by_hash_path(series, path, sha256)
+                if not os.path.exists(by_hash):
+                    ensure_dir(os.path.dirname(by_hash))
+                    link_or_copy(os.path.join(self.distdir(series), path), by_hash)
+
+                # The grace period of a by-hash file starts when it is superseded
+                if previous.get(path, sha256) != sha256:
+                    superseded = self.by_hash_path(series, path, previous[path])
+                    if os.path.exists(superseded):
+                        os.utime(superseded, None)
+
+                index.files.create(path=path, size=size, md5sum=md5sum, sha1=sha1, sha256=sha256)
+
+            index.dirty = False
+            index.save()
+
+    def expire_by_hash(self, series, now=None):
+        """Remove by-hash files superseded more than a grace period ago
+
+        Clients that fetched the previous Release can still get the
+        indexes it lists until then."""
+        current = set(PublishedIndexFile.objects.filter(index__series=series).values_list('sha256', flat=True))
+        cutoff = (now or time.time()) - by_hash_grace_period()
+        removed = []
+        for dirpath, dirnames, filenames in os.walk(self.distdir(series)):
+            if os.path.basename(dirpath) != 'SHA256' or os.path.basename(os.path.dirname(dirpath)) != 'by-hash':
+                continue
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                if filename not in current and os.path.getmtime(path) < cutoff:
+                    os.unlink(path)
+                    removed.append(path)
+        return removed
+
+    def write_release(self, series):
+        repository = self.repository
+        files = list(PublishedIndexFile.objects.filter(index__series=series).order_by('path'))
+
+        release = deb822.Deb822()
+        release['Origin'] = repository.name.capitalize()
+        release['Label'] = repository.name.capitalize()
+        release['Suite'] = series.name
+        release['Codename'] = series.name
+        release['Date'] = email.utils.formatdate(usegmt=True)
+        release['Architectures'] = ' '.join(BINARY_ARCHITECTURES + ('source',))
+        release['Components'] = COMPONENT
+        release['Description'] = '%s %s' % (repository.name, series.name)
+        release['Acquire-By-Hash'] = 'yes'
+        for field, attr in (('MD5Sum', 'md5sum'), ('SHA1', 'sha1'), ('SHA256', 'sha256')):
+            release[field] = file_list([(getattr(f, attr), f.size, f.path) for f in files])
+
+        distdir = self.distdir(series)
+        if repository.key_id:
+            write_file(os.path.join(distdir, 'Release.new'), release.dump().encode('utf-8'))
+            signing.sign_release(repository.key_id, distdir)
+        else:
+            write_file(os.path.join(distdir, 'Release'), release.dump().encode('utf-8'))
+
+    def export(self):
+        """Rewrite the dirty indexes, and Release files that list them"""
+        for series in self.repository.series.all():
+            for architecture in BINARY_ARCHITECTURES + ('source',):
+                PublishedIndex.objects.get_or_create(series=series, component=COMPONENT, architecture=architecture)
+
+            dirty = list(series.published_indexes.filter(dirty=True))
+            distdir = self.distdir(series)
+            signed = os.path.exists(os.path.join(distdir, 'Release')) and not os.path.exists(os.path.join(distdir, 'Release.new'))
+            if not dirty and signed:
+                continue
+
+            for index in dirty:
+                LOG.debug('Writing %s for %s' % (index.path, series))
+                self.write_index(series, index)
+            self.write_release(series)
+            self.expire_by_hash(series)
@@ -0,0 +1,158 @@
+import contextlib
+import errno
+import fcntl
+import hashlib
+import logging
+import os
+import os.path
+import shutil
+import stat
+
+from django.conf import settings
+
+LOG = logging.getLogger(__name__)
+
+
+def sha256_file(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(65536), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def replace_with_link(src, dst):
+    """Make dst a hardlink to src, atomically replacing whatever was there"""
+    if not os.path.isdir(os.path.dirname(dst)):
+        os.makedirs(os.path.dirname(dst))
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        return
+    tmppath = '%s.tmp-link' % (dst,)
+    if os.path.lexists(tmppath):
+        os.unlink(tmppath)
+    os.link(src, tmppath)
+    os.rename(tmppath, dst)
+
+
+class ArtifactStore(object):
+    """Content addressed store for files published into repositories
+
+    Every file is stored once, named by its SHA256, and hardlinked into
+    the pools of the repositories that publish it. The link count of a
+    stored file is its reference count: a file with no links other than
+    its own is no longer published anywhere, and collect() removes it.
+    Pools must be on the same filesystem as the store."""
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, sha256):
+        return os.path.join(self.root, sha256[:2], sha256[2:4], sha256)
+
+    @contextlib.contextmanager
+    def locked(self):
+        """Keep collect() from removing files that are about to be linked"""
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+        with open(os.path.join(self.root, '.lock'), 'a') as fp:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fp, fcntl.LOCK_UN)
+
+    def _store(self, src, sha256):
+        stored = self.path(sha256)
+        if not os.path.exists(stored):
+            if not os.path.isdir(os.path.dirname(stored)):
+                os.makedirs(os.path.dirname(stored))
+            tmppath = '%s.tmp' % (stored,)
+            try:
+                os.link(src, tmppath)
+            except OSError:
+                shutil.copy2(src, tmppath)
+            os.rename(tmppath, stored)
+        return stored
+
+    def link(self, src, dst, sha256=None):
+        """Publish src as dst, sharing storage with identical files
+
+        Returns the SHA256 of the file."""
+        sha256 = sha256 or sha256_file(src)
+        with self.locked():
+            replace_with_link(self._store(src, sha256), dst)
+        return sha256
+
+    def references(self, sha256):
+        try:
+            return os.stat(self.path(sha256)).st_nlink - 1
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return 0
+
+    def unlink(self, path, sha256=None):
+        """Unpublish path, freeing its storage if nothing else uses it
+
+        Returns the number of bytes freed."""
+        st = os.stat(path)
+        if st.st_nlink != 2:
+            # Either still linked from another pool, or not from the store
+            os.unlink(path)
+            return 0
+
+        sha256 = sha256 or sha256_file(path)
+        with self.locked():
+            os.unlink(path)
+            stored = self.path(sha256)
+            if os.path.exists(stored) and os.stat(stored).st_nlink == 1:
+                os.unlink(stored)
+                return st.st_size
+        return 0
+
+    def dedupe(self, directory, logger=LOG):
+        """Replace files under directory with links into the store
+
+        Files that are already linked from somewhere are left alone, so
+        only files added since the last run get read. This is how pools
+        maintained by reprepro come to share storage. Returns the number
+        of bytes saved."""
+        saved = 0
+        for dirpath, dirnames, filenames in os.walk(directory):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                st = os.lstat(path)
+                if not stat.S_ISREG(st.st_mode) or st.st_nlink > 1:
+                    continue
+                sha256 = sha256_file(path)
+                if os.path.exists(self.path(sha256)):
+                    saved += st.st_size
+                self.link(path, path, sha256=sha256)
+        if saved:
+            logger.info('Saved %d bytes by linking files in %s to the artifact store' % (saved, directory))
+        return saved
+
+    def collect(self, logger=LOG):
+        """Remove stored files that are no longer published anywhere
+
+        Returns the number of bytes freed."""
+        freed = 0
+        with self.locked():
+            for dirpath, dirnames, filenames in os.walk(self.root):
+                for filename in filenames:
+                    if filename == '.lock':
+                        continue
+                    path = os.path.join(dirpath, filename)
+                    st = os.stat(path)
+                    if st.st_nlink == 1:
+                        os.unlink(path)
+                        freed += st.st_size
+        if freed:
+            logger.info('Freed %d bytes in the artifact store' % (freed,))
+        return freed
+
+
+def get_artifact_store():
+    root = getattr(settings, 'BUILDSVC_ARTIFACT_STORE_DIR', None)
+    if not root:
+        return None
+    return ArtifactStore(root)
@@ -0,0 +1,226 @@
+import glob
+import hashlib
+import io
+import logging
+import os
+import os.path
+import re
+import shutil
+import struct
+import tarfile
+import time
+
+import deb822
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .lrustore import LRUDirectoryStore
+
+LOG = logging.getLogger(__name__)
+
+HITS_KEY = 'buildsvc:buildcache:hits'
+MISSES_KEY = 'buildsvc:buildcache:misses'
+
+AR_MAGIC = b'!<arch>\n'
+AR_HEADER = '16s12s6s6s8s10s2s'
+
+RELATION_FIELDS = ('Pre-Depends', 'Depends', 'Recommends', 'Suggests', 'Enhances',
+                   'Breaks', 'Conflicts', 'Replaces', 'Provides')
+RELATION_RE = re.compile(r'(?P<name>[a-z0-9][a-z0-9.+-]*)(?P<arch>:[a-z0-9-]+)?(?P<op>\s*\(\s*(?:<<|<=|=|>=|>>|<|>)\s*)(?P<version>[^\s)]+)(?P<close>\s*\))')
+
+
+def build_key(tree_sha, builder_name, build_dependencies, runtime_dependencies, repos, keys, series_name, base):
+    """Hash of everything that determines the binary packages of a build"""
+    h = hashlib.sha256()
+    for part in [tree_sha, builder_name,
+                 '\n'.join(sorted(set(build_dependencies))),
+                 '\n'.join(sorted(set(runtime_dependencies))),
+                 repos, keys, series_name, base]:
+        h.update(part.encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+def count(key):
+    cache.add(key, 0, None)
+    cache.incr(key)
+
+
+def stats():
+    return {'hits': cache.get(HITS_KEY, 0),
+            'misses': cache.get(MISSES_KEY, 0)}
+
+
+def read_ar(path):
+    """Read an ar archive (such as a .deb) into a list of (name, data)"""
+    members = []
+    with open(path, 'rb') as fp:
+        if fp.read(len(AR_MAGIC)) != AR_MAGIC:
+            raise ValueError('%s is not an ar archive' % (path,))
+        while True:
+            header = fp.read(struct.calcsize(AR_HEADER))
+            if not header:
+                break
+            name, _, _, _, _, size, _ = struct.unpack(AR_HEADER, header)
+            size = int(size.strip())
+            members.append((name.decode('ascii').strip().rstrip('/'), fp.read(size)))
+            if size % 2:
+                fp.read(1)
+    return members
+
+
+def write_ar(path, members):
+    mtime = int(time.time())
+    with open(path, 'wb') as fp:
+        fp.write(AR_MAGIC)
+        for name, data in members:
+            fp.write(struct.pack(AR_HEADER,
+                                 name.ljust(16).encode('ascii'),
+                                 str(mtime).ljust(12).encode('ascii'),
+                                 b'0     ', b'0     ',
+                                 b'100644  ',
+                                 str(len(data)).ljust(10).encode('ascii'),
+                                 b'`\n'))
+            fp.write(data)
+            if len(data) % 2:
+                fp.write(b'\n')
+
+
+def read_control(deb):
+    """The control paragraph of deb"""
+    for name, data in read_ar(deb):
+        if name.startswith('control.tar'):
+            with tarfile.open(fileobj=io.BytesIO(data), mode='r:*') as tar:
+                for member in tar.getmembers():
+                    if member.name in ('./control', 'control'):
+                        return deb822.Deb822(tar.extractfile(member).read().decode('utf-8').splitlines())
+    raise ValueError('%s has no control member' % (deb,))
+
+
+def rewrite_relations(value, siblings, version):
+    """Point the relations in value at siblings to version
+
+    siblings maps the other binaries built from the same source to
+    their old version. Only relations to exactly that version are
+    rewritten (typically ${binary:Version} ones), so anything else is
+    left alone."""
+    def replace(match):
+        if siblings.get(match.group('name')) != match.group('version'):
+            return match.group(0)
+        return '%s%s%s%s%s' % (match.group('name'), match.group('arch') or '',
+                               match.group('op'), version, match.group('close'))
+    return RELATION_RE.sub(replace, value)
+
+
+def rewrite_control(control_tar, version, siblings=None):
+    """Set the version in a compressed control tarball
+
+    Versioned relations to siblings (see rewrite_relations()) are moved
+    to the new version too. Returns the new tarball (always gzip
+    compressed) and the new control paragraph."""
+    out = io.BytesIO()
+    control = None
+    with tarfile.open(fileobj=io.BytesIO(control_tar), mode='r:*') as src, \
+            tarfile.open(fileobj=out, mode='w:gz') as dst:
+        for member in src.getmembers():
+            if not member.isfile():
+                dst.addfile(member)
+                continue
+            data = src.extractfile(member).read()
+            if member.name in ('./control', 'control'):
+                control = deb822.Deb822(data.decode('utf-8').splitlines())
+                control['Version'] = version
+                if 'Source' in control:
+                    # Binaries now have the same version as their source
+                    control['Source'] = control['Source'].split(' ')[0]
+                for field in RELATION_FIELDS:
+                    if siblings and field in control:
+                        control[field] = rewrite_relations(control[field], siblings, version)
+                data = control.dump().encode('utf-8')
+                member.size = len(data)
+            dst.addfile(member, io.BytesIO(data))
+    return out.getvalue(), control
+
+
+def rewrite_deb_version(deb, version, outdir, siblings=None):
+    """Write a copy of deb with a new version to outdir
+
+    siblings is passed on to rewrite_control(). Only the control member is rewritten. The (much larger) data member
+    is copied as is, so nothing gets decompressed or recompressed."""
+    members = []
+    control = None
+    for name, data in read_ar(deb):
+        if name.startswith('control.tar'):
+            data, control = rewrite_control(data, version, siblings)
+            name = 'control.tar.gz'
+        members.append((name, data))
+
+    if control is None:
+        raise ValueError('%s has no control member' % (deb,))
+
+    filename = '%s_%s_%s.deb' % (control['Package'], version.split(':', 1)[-1], control['Architecture'])
+    write_ar(os.path.join(outdir, filename), members)
+    return filename, control
+
+
+class BuildCache(LRUDirectoryStore):
+    """On-disk store of the binary packages of earlier builds
+
+    Entries are keyed by build_key(), so a build of a tree that has been
+    built before with the same builder, dependencies and external
+    dependency configuration can republish the stored packages under a
+    new version instead of building them again. Entries are evicted
+    least recently used first once the store exceeds max_size bytes."""
+    description = 'build cache'
+
+    def entry_path(self, key):
+        return os.path.join(self.root, key)
+
+    def store(self, key, debs, logger=LOG):
+        path = self.entry_path(key)
+        with self.locked(path):
+            tmppath = '%s.tmp' % (path,)
+            if os.path.isdir(tmppath):
+                shutil.rmtree(tmppath)
+            os.makedirs(tmppath)
+            for deb in debs:
+                shutil.copy(deb, tmppath)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            os.rename(tmppath, path)
+        logger.info('Stored %d packages in build cache as %s' % (len(debs), key))
+        self.evict(keep=path, logger=logger)
+
+    def republish(self, key, version, outdir, logger=LOG):
+        """Copy the stored packages for key to outdir as version
+
+        Returns a list of (filename, control) tuples, or None on a miss.
+        The entry stays locked while it is read, so it cannot be evicted
+        half way through."""
+        path = self.entry_path(key)
+        with self.locked(path):
+            debs = sorted(glob.glob(os.path.join(path, '*.deb')))
+            if not debs:
+                count(MISSES_KEY)
+                return None
+
+            os.utime(path, None)
+            count(HITS_KEY)
+            logger.info('Build cache hit for %s' % (key,))
+            controls = [read_control(deb) for deb in debs]
+            siblings = dict((control['Package'], control['Version']) for control in controls)
+            return [rewrite_deb_version(deb, version, outdir, siblings) for deb in debs]
+
+    def entries(self):
+        if not os.path.isdir(self.root):
+            return []
+        return [os.path.join(self.root, d) for d in os.listdir(self.root)
+                if os.path.isdir(os.path.join(self.root, d)) and not d.endswith('.tmp')]
+
+
+def get_build_cache():
+    root = getattr(settings, 'BUILDSVC_BUILD_CACHE_DIR', None)
+    if not root:
+        return None
+    return BuildCache(root, getattr(settings, 'BUILDSVC_BUILD_CACHE_MAX_SIZE', None))
@@ -0,0 +1,158 @@
+import datetime
+import hashlib
+import logging
+import os
+import os.path
+import shutil
+import tempfile
+
+from django.conf import settings
+from django.db.models import Sum
+from django.utils import timezone
+
+import docker
+
+LOG = logging.getLogger(__name__)
+
+IMAGE_REPOSITORY = 'aasemble-buildenv'
+
+DOCKERFILE = '''FROM %(base)s
+ENV DEBIAN_FRONTEND noninteractive
+COPY repos /etc/apt/sources.list.d/aasemble-build.list
+COPY keys /tmp/aasemble-build.keys
+RUN [ ! -s /tmp/aasemble-build.keys ] || apt-key add /tmp/aasemble-build.keys
+RUN apt-get update && apt-get install -y --no-install-recommends build-essential debhelper devscripts equivs %(packages)s && apt-get clean
+'''
+
+
+class BuildEnvironmentFailed(Exception):
+    pass
+
+
+def read_file(path):
+    if not os.path.exists(path):
+        return ''
+    with open(path, 'r') as fp:
+        return fp.read()
+
+
+def base_image():
+    return '%s:%s' % (getattr(settings, 'BUILDSVC_BUILD_BASE_DIST', 'ubuntu'),
+                      getattr(settings, 'BUILDSVC_BUILD_BASE_RELEASE', 'trusty'))
+
+
+def environment_key(build_dependencies, repos, keys, series_name, base):
+    """Hash of everything that goes into a prepared build image"""
+    h = hashlib.sha256()
+    for part in ['\n'.join(sorted(set(build_dependencies))), repos, keys, series_name, base]:
+        h.update(part.encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()[:32]
+
+
+class BuildEnvironmentCache(object):
+    """Keeps docker images with build dependencies preinstalled
+
+    Images are keyed by the build dependencies, the external dependency
+    repos/keys files and the series, so builds that need the same
+    environment can start from it instead of installing everything from
+    a bare base image."""
+    def __init__(self, client=None, base_dist=None, base_release=None):
+        self.client = client or docker.Client(base_url=getattr(settings, 'BUILDSVC_DOCKER_URL', 'unix://var/run/docker.sock'))
+        self.base_dist = base_dist or getattr(settings, 'BUILDSVC_BUILD_BASE_DIST', 'ubuntu')
+        self.base_release = base_release or getattr(settings, 'BUILDSVC_BUILD_BASE_RELEASE', 'trusty')
+
+    @property
+    def base(self):
+        return '%s:%s' % (self.base_dist, self.base_release)
+
+    def image_name(self, key):
+        return '%s:%s' % (IMAGE_REPOSITORY, key)
+
+    def image_exists(self, key):
+        return bool(self.client.images(name=self.image_name(key)))
+
+    def build_image(self, key, build_dependencies, basedir, logger=LOG):
+        context = tempfile.mkdtemp()
+        try:
+            for f in ('repos', 'keys'):
+                with open(os.path.join(context, f), 'w') as fp:
+                    fp.write(read_file(os.path.join(basedir, f)))
+
+            with open(os.path.join(context, 'Dockerfile'), 'w') as fp:
+                fp.write(DOCKERFILE % {'base': self.base,
+                                       'packages': ' '.join(sorted(set(build_dependencies)))})
+
+            logger.info('Preparing build environment %s' % (self.image_name(key),))
+            for chunk in self.client.build(path=context, tag=self.image_name(key), rm=True, stream=True, decode=True):
+                if 'error' in chunk or 'errorDetail' in chunk:
+                    error = chunk.get('errorDetail', {}).get('message') or chunk.get('error')
+                    raise BuildEnvironmentFailed('Failed to prepare build environment %s: %s' % (self.image_name(key), error))
+                if chunk.get('stream'):
+                    logger.debug(chunk['stream'].rstrip('\n'))
+        finally:
+            shutil.rmtree(context)
+
+    def image_size(self, key):
+        return self.client.inspect_image(self.image_name(key)).get('Size', 0)
+
+    def prepare(self, build_dependencies, basedir, series_name, logger=LOG):
+        """Return the (dist, release) pair to build from, preparing it if needed"""
+        from .models import BuildEnvironment
+
+        key = environment_key(build_dependencies,
+                              read_file(os.path.join(basedir, 'repos')),
+                              read_file(os.path.join(basedir, 'keys')),
+                              series_name, self.base)
+
+        if self.image_exists(key):
+            logger.info('Reusing build environment %s' % (self.image_name(key),))
+        else:
+            self.build_image(key, build_dependencies, basedir, logger=logger)
+
+        if not BuildEnvironment.objects.filter(key=key).update(last_used=timezone.now()):
+            # Another build may be preparing the same environment
+            BuildEnvironment.objects.get_or_create(key=key, defaults={'size': self.image_size(key)})
+
+        return IMAGE_REPOSITORY, key
+
+    def remove(self, env, logger=LOG):
+        logger.info('Removing build environment %s' % (self.image_name(env.key),))
+        try:
+            self.client.remove_image(self.image_name(env.key))
+        except docker.errors.APIError as e:
+            logger.warning('Failed to remove %s: %s' % (self.image_name(env.key), e))
+        env.delete()
+
+    def evict(self, max_age=None, max_size=None, logger=LOG):
+        """Remove images unused for max_age seconds, then the least
+        recently used ones until the rest fit in max_size bytes"""
+        from .models import BuildEnvironment
+
+        if max_age is None:
+            max_age = getattr(settings, 'BUILDSVC_BUILD_ENV_MAX_AGE', 7 * 24 * 3600)
+        if max_size is None:
+            max_size = getattr(settings, 'BUILDSVC_BUILD_ENV_MAX_SIZE', None)
+
+        evicted = []
+        cutoff = timezone.now() - datetime.timedelta(seconds=max_age)
+        for env in BuildEnvironment.objects.filter(last_used__lt=cutoff):
+            self.remove(env, logger=logger)
+            evicted.append(env.key)
+
+        if max_size:
+            total = BuildEnvironment.objects.aggregate(total=Sum('size'))['total'] or 0
+            for env in BuildEnvironment.objects.order_by('last_used'):
+                if total <= max_size:
+                    break
+                self.remove(env, logger=logger)
+                evicted.append(env.key)
+                total -= env.size
+
+        return evicted
+
+
+def get_build_environment_cache():
+    if not getattr(settings, 'BUILDSVC_BUILD_ENV_CACHE', False):
+        return None
+    return BuildEnvironmentCache()
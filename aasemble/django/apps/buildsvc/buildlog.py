@@ -0,0 +1,176 @@
+import errno
+import io
+import logging
+import os
+import os.path
+import threading
+import time
+
+from django.conf import settings
+
+# Build loggers pass records on to this one, so whatever is configured
+# for it still sees them
+PARENT = logging.getLogger('buildsvc.pkgbuild')
+
+FORMAT = '%(asctime)s: %(message)s'
+
+
+def flush_interval():
+    return getattr(settings, 'BUILDSVC_BUILD_LOG_FLUSH_INTERVAL', 1.0)
+
+
+def poll_interval():
+    return getattr(settings, 'BUILDSVC_BUILD_LOG_POLL_INTERVAL', 0.5)
+
+
+class BuildLogSink(logging.Handler):
+    """Buffered writer for one build's log file
+
+    Writes are flushed to disk at most flush_interval() seconds apart,
+    and straight away for warnings and errors. Besides log records, it
+    takes raw output (such as docker's) through write(), so everything
+    lands in the order it was produced. The file stays open until
+    close(), and move() renames it without reopening it."""
+    def __init__(self, path):
+        super(BuildLogSink, self).__init__(logging.DEBUG)
+        self.setFormatter(logging.Formatter(FORMAT))
+        self.path = path
+        self.fp = io.open(path, 'ab')
+        self.last_flush = time.time()
+        self.timer = None
+        self.write_lock = threading.Lock()
+
+    def emit(self, record):
+        try:
+            self._write((self.format(record) + '\n').encode('utf-8'), record.levelno >= logging.WARNING)
+        except Exception:
+            self.handleError(record)
+
+    def write(self, data):
+        """Write raw output, as a file would"""
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        self._write(data)
+
+    def _write(self, data, urgent=False):
+        with self.write_lock:
+            if self.fp is None:
+                return
+            self.fp.write(data)
+            if urgent or time.time() - self.last_flush >= flush_interval():
+                self._flush()
+            elif self.timer is None:
+                # Flush even if nothing else is written for a while, so
+                # whoever follows the log does not stall
+                self.timer = threading.Timer(flush_interval(), self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def _flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.fp.flush()
+        self.last_flush = time.time()
+
+    def flush(self):
+        with self.write_lock:
+            if self.fp is not None:
+                self._flush()
+
+    def move(self, path):
+        """Rename the log file to path. Logging carries on into it."""
+        with self.write_lock:
+            os.rename(self.path, path)
+            self.path = path
+
+    @property
+    def closed(self):
+        return self.fp is None
+
+    def close(self):
+        with self.write_lock:
+            if self.fp is not None:
+                self._flush()
+                self.fp.close()
+                self.fp = None
+        super(BuildLogSink, self).close()
+
+
+def make_logger(name, sink):
+    """A logger that writes to sink
+
+    Unlike logging.getLogger(), this does not register the logger with
+    the logging module, so it is freed along with the build that uses
+    it rather than kept for the life of the process."""
+    logger = logging.Logger('%s.%s' % (PARENT.name, name), logging.DEBUG)
+    logger.parent = PARENT
+    logger.addHandler(sink)
+    return logger
+
+
+def read(paths, offset, limit=None):
+    """Up to limit bytes from offset in the first of paths that exists"""
+    for path in paths:
+        try:
+            with io.open(path, 'rb') as fp:
+                fp.seek(offset)
+                return fp.read() if limit is None else fp.read(limit)
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+    return b''
+
+
+def complete_characters(data):
+    """data, less any UTF-8 sequence cut short at its end"""
+    tail = bytearray(data[-4:])
+    for i in range(1, len(tail) + 1):
+        byte = tail[-i]
+        if byte & 0xc0 == 0x80:
+            continue
+        if byte >= 0xc0:
+            length = 2 if byte < 0xe0 else 3 if byte < 0xf0 else 4
+            if length > i:
+                return data[:-i]
+        break
+    return data
+
+
+def tail(build_record, offset=0, timeout=0, limit=None):
+    """Follow build_record's log from offset
+
+    Yields (data, next offset, complete) tuples: whenever there is new
+    data, and one last time once the log is complete or nothing has
+    been written for timeout seconds. Offsets are in bytes, and data
+    never ends part way through a character, so it can be decoded."""
+    from .models import BuildRecord
+
+    deadline = time.time() + timeout
+    while True:
+        # Checked before reading, so a complete log is read to the end.
+        # The version is refreshed too, as the log is renamed once it
+        # is known.
+        state = BuildRecord.objects.filter(id=build_record.id).values('log_complete', 'version').first()
+        if state is None:
+            # Removed by the retention policy
+            yield b'', offset, True
+            return
+        complete = state['log_complete']
+        build_record.version = state['version']
+        data, next_offset = build_record.read_log(offset, limit)
+        complete = complete and (limit is None or len(data) < limit)
+        if not complete:
+            data = complete_characters(data)
+            next_offset = offset + len(data)
+        timed_out = time.time() >= deadline
+
+        if data or complete or timed_out:
+            yield data, next_offset, complete
+        if complete or (timed_out and not data):
+            return
+        offset = next_offset
+        if data:
+            deadline = time.time() + timeout
+        else:
+            time.sleep(poll_interval())
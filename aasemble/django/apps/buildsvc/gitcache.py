@@ -0,0 +1,85 @@
+import hashlib
+import logging
+import os
+import os.path
+import shutil
+
+from django.conf import settings
+
+from six.moves.urllib.parse import urlparse, urlunparse
+
+from .lrustore import LRUDirectoryStore
+from ...utils import run_cmd
+
+LOG = logging.getLogger(__name__)
+
+
+def normalize_git_url(url):
+    """Normalise a git URL so equivalent remotes share one cache entry"""
+    parsed = urlparse(url.strip())
+    path = parsed.path.rstrip('/')
+    if path.endswith('.git'):
+        path = path[:-len('.git')]
+    return urlunparse((parsed.scheme.lower(), parsed.netloc.lower(), path, '', '', ''))
+
+
+class GitCache(LRUDirectoryStore):
+    """On-disk cache of bare mirrors, one per remote
+
+    Mirrors are updated with an incremental fetch and build trees are
+    materialised from them with a local clone, which hardlinks the
+    objects instead of copying them. Because of the hardlinks, a build
+    tree stays intact even if its mirror is evicted while it is in use.
+    """
+    description = 'git cache'
+
+    def mirror_path(self, url):
+        key = hashlib.sha1(normalize_git_url(url).encode('utf-8')).hexdigest()
+        return os.path.join(self.root, '%s.git' % (key,))
+
+    def update_mirror(self, url, logger=LOG):
+        path = self.mirror_path(url)
+        with self.locked(path):
+            self._update_mirror(path, url, logger)
+        return path
+
+    def _update_mirror(self, path, url, logger):
+        # Callers must hold the mirror lock
+        if os.path.isdir(path):
+            run_cmd(['git', 'remote', 'set-url', 'origin', url], cwd=path, logger=logger)
+            run_cmd(['git', 'fetch', '--prune', 'origin'], cwd=path, logger=logger)
+        else:
+            tmppath = '%s.tmp' % (path,)
+            if os.path.isdir(tmppath):
+                shutil.rmtree(tmppath)
+            run_cmd(['git', 'clone', '--mirror', url, tmppath], logger=logger)
+            os.rename(tmppath, path)
+        # Mark as recently used for LRU eviction
+        os.utime(path, None)
+
+    def checkout(self, url, branch, dest, logger=LOG):
+        """Materialise a build tree for branch of url at dest
+
+        The mirror lock is held from the fetch through the local clone so
+        that another build cannot evict the mirror in between.
+        """
+        path = self.mirror_path(url)
+        with self.locked(path):
+            self._update_mirror(path, url, logger)
+            run_cmd(['git', 'clone', '--local', '-b', branch, path, dest], logger=logger)
+        run_cmd(['git', 'remote', 'set-url', 'origin', url], cwd=dest, logger=logger)
+        self.evict(keep=path, logger=logger)
+        return dest
+
+    def entries(self):
+        if not os.path.isdir(self.root):
+            return []
+        return [os.path.join(self.root, d) for d in os.listdir(self.root)
+                if d.endswith('.git') and os.path.isdir(os.path.join(self.root, d))]
+
+
+def get_git_cache():
+    root = getattr(settings, 'BUILDSVC_GIT_CACHE_DIR', None)
+    if not root:
+        return None
+    return GitCache(root, getattr(settings, 'BUILDSVC_GIT_CACHE_MAX_SIZE', None))
@@ -0,0 +1,79 @@
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+
+LOG = logging.getLogger(__name__)
+
+# How long a key generation may take before its slot is given to
+# another one
+SLOT_TIMEOUT = 3600
+
+
+def pool_size():
+    return getattr(settings, 'BUILDSVC_KEY_POOL_SIZE', 10)
+
+
+def parallelism():
+    return getattr(settings, 'BUILDSVC_KEY_POOL_PARALLELISM', 2)
+
+
+def slot_key(slot):
+    return 'buildsvc:keypool:slot:%d' % (slot,)
+
+
+def available():
+    from .models import SigningKey
+    return SigningKey.objects.filter(repository__isnull=True).count()
+
+
+def claim(repository):
+    """Take a key from the pool for repository
+
+    Returns the key's id, or None if the pool is empty. Every key goes
+    to at most one repository, however many claim at the same time."""
+    from .models import SigningKey
+
+    while True:
+        key = SigningKey.objects.filter(repository__isnull=True).order_by('id').first()
+        if key is None:
+            LOG.debug('Signing key pool is empty')
+            return None
+        if SigningKey.objects.filter(id=key.id, repository__isnull=True).update(repository=repository):
+            LOG.info('Assigned pooled key %s to %s' % (key.key_id, repository))
+            return key.key_id
+
+
+def refill(logger=LOG):
+    """Start generating keys until the pool is back to its configured size
+
+    At most parallelism() keys are generated at a time. Each generation
+    holds a slot in the cache while it runs. Returns the slots started."""
+    from . import tasks
+
+    missing = pool_size() - available()
+    started = []
+    for slot in range(parallelism()):
+        if len(started) >= missing:
+            break
+        if cache.add(slot_key(slot), True, SLOT_TIMEOUT):
+            tasks.generate_pool_key.delay(slot)
+            started.append(slot)
+
+    if started:
+        logger.info('Generating %d key(s) for the signing key pool' % (len(started),))
+    return started
+
+
+def generate(slot, logger=LOG):
+    """Add one key to the pool, then carry on refilling"""
+    from .models import SigningKey, get_repo_driver
+
+    try:
+        if available() < pool_size():
+            key_id = get_repo_driver(None).generate_key()
+            SigningKey.objects.create(key_id=key_id)
+            logger.info('Added key %s to the signing key pool' % (key_id,))
+    finally:
+        cache.delete(slot_key(slot))
+    refill(logger=logger)
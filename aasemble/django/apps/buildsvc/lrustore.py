@@ -0,0 +1,67 @@
+import contextlib
+import fcntl
+import logging
+import os
+import os.path
+import shutil
+
+LOG = logging.getLogger(__name__)
+
+
+def dir_size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            try:
+                size += os.lstat(os.path.join(root, f)).st_size
+            except OSError:
+                pass
+    return size
+
+
+class LRUDirectoryStore(object):
+    """Directories under root, evicted least recently used first
+
+    Each entry is a directory with a lock file next to it. Users of an
+    entry hold its lock and touch it, and evict() removes the entries
+    touched longest ago once they add up to more than max_size bytes."""
+    description = 'store'
+
+    def __init__(self, root, max_size=None):
+        self.root = root
+        self.max_size = max_size
+
+    @contextlib.contextmanager
+    def locked(self, path):
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+        with open('%s.lock' % (path,), 'a') as fp:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fp, fcntl.LOCK_UN)
+
+    def entries(self):
+        raise NotImplementedError()
+
+    def evict(self, keep=None, logger=LOG):
+        """Remove least recently used entries until the store fits its budget"""
+        if not self.max_size:
+            return []
+
+        entries = sorted([(os.path.getmtime(p), dir_size(p), p) for p in self.entries()])
+        total = sum(size for _, size, _ in entries)
+
+        evicted = []
+        for mtime, size, path in entries:
+            if total <= self.max_size:
+                break
+            if path == keep:
+                continue
+            with self.locked(path):
+                logger.info('Evicting %s from %s (%d bytes)' % (path, self.description, size))
+                shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            evicted.append(path)
+        return evicted
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from ...buildcache import stats
+
+
+class Command(BaseCommand):
+    help = 'Shows build cache hits and misses'
+
+    def handle(self, *args, **options):
+        counts = stats()
+        lookups = counts['hits'] + counts['misses']
+        self.stdout.write('Hits: %d' % (counts['hits'],))
+        self.stdout.write('Misses: %d' % (counts['misses'],))
+        if lookups:
+            self.stdout.write('Hit rate: %.1f%%' % (100.0 * counts['hits'] / lookups,))
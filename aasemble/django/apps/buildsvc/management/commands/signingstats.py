@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from ...signing import stats
+
+
+class Command(BaseCommand):
+    help = 'Shows how many signatures have been made and how long they took'
+
+    def handle(self, *args, **options):
+        result = stats()
+        self.stdout.write('Signatures: %d' % (result['count'],))
+        if 'mean' in result:
+            self.stdout.write('Mean latency: %.3fs' % (result['mean'],))
+            for p in (50, 90, 99):
+                self.stdout.write('p%d latency: %.3fs' % (p, result['p%d' % (p,)]))
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('buildsvc', '0016_buildrecord_build_finished'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='packagesource',
+            name='checkout_mode',
+            field=models.CharField(default='full', max_length=16, choices=[('full', 'Full history'), ('shallow', 'Shallow, single branch'), ('blobless', 'Blobless partial clone')]),
+        ),
+        migrations.AddField(
+            model_name='packagesource',
+            name='checkout_depth',
+            field=models.PositiveIntegerField(default=1),
+        ),
+    ]
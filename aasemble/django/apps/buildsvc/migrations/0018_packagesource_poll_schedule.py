@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('buildsvc', '0017_packagesource_checkout_mode'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='packagesource',
+            name='next_poll',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='packagesource',
+            name='poll_interval',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='packagesource',
+            name='last_changed',
+            field=models.DateTimeField(null=True, blank=True),
+        ),
+        migrations.AlterIndexTogether(
+            name='packagesource',
+            index_together=set([('webhook_registered', 'next_poll')]),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('buildsvc', '0018_packagesource_poll_schedule'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='packagesource',
+            name='build_scheduled',
+            field=models.BooleanField(default=False),
+        ),
+    ]
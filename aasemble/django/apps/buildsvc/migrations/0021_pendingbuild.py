@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('buildsvc', '0020_buildenvironment'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingBuild',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('priority', models.IntegerField(default=0)),
+                ('state', models.CharField(default='queued', max_length=16, choices=[('queued', 'Queued'), ('running', 'Running')])),
+                ('queued_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('started_at', models.DateTimeField(null=True, blank=True)),
+                ('repository', models.ForeignKey(related_name='pending_builds', to='buildsvc.Repository')),
+                ('source', models.ForeignKey(related_name='pending_builds', to='buildsvc.PackageSource')),
+                ('user', models.ForeignKey(related_name='pending_builds', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='pendingbuild',
+            index_together=set([('state', 'started_at')]),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('buildsvc', '0021_pendingbuild'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BuildPhase',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('name', models.CharField(max_length=32, db_index=True)),
+                ('started', models.DateTimeField()),
+                ('duration', models.FloatField()),
+                ('build_record', models.ForeignKey(related_name='phases', to='buildsvc.BuildRecord')),
+            ],
+            options={
+                'ordering': ('started', 'id'),
+            },
+        ),
+    ]
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('buildsvc', '0022_buildphase'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='repository',
+            name='include_generation',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='repository',
+            name='export_generation',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('buildsvc', '0023_repository_publish_generations'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PublishOperation',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('action', models.CharField(max_length=16, choices=[('include', 'Include changes file'), ('remove', 'Remove source package')])),
+                ('series_name', models.CharField(max_length=100)),
+                ('argument', models.CharField(max_length=255)),
+                ('created', models.DateTimeField(default=django.utils.timezone.now)),
+                ('error', models.TextField(blank=True)),
+                ('build_record', models.ForeignKey(related_name='+', on_delete=django.db.models.deletion.SET_NULL, blank=True, to='buildsvc.BuildRecord', null=True)),
+                ('repository', models.ForeignKey(related_name='publish_operations', to='buildsvc.Repository')),
+            ],
+            options={
+                'ordering': ('id',),
+            },
+        ),
+    ]
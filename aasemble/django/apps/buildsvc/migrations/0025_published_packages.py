@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('buildsvc', '0024_publishoperation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PublishedIndex',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('component', models.CharField(default='main', max_length=32)),
+                ('architecture', models.CharField(max_length=32)),
+                ('dirty', models.BooleanField(default=True)),
+                ('size', models.BigIntegerField(default=0)),
+                ('md5sum', models.CharField(max_length=32, blank=True)),
+                ('sha1', models.CharField(max_length=40, blank=True)),
+                ('sha256', models.CharField(max_length=64, blank=True)),
+                ('series', models.ForeignKey(related_name='published_indexes', to='buildsvc.Series')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='PublishedPackage',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('component', models.CharField(default='main', max_length=32)),
+                ('architecture', models.CharField(max_length=32)),
+                ('name', models.CharField(max_length=100)),
+                ('source', models.CharField(max_length=100, db_index=True)),
+                ('version', models.CharField(max_length=100)),
+                ('stanza', models.TextField()),
+                ('files', models.TextField()),
+                ('series', models.ForeignKey(related_name='published_packages', to='buildsvc.Series')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='publishedpackage',
+            unique_together=set([('series', 'component', 'architecture', 'name')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='publishedindex',
+            unique_together=set([('series', 'component', 'architecture')]),
+        ),
+    ]
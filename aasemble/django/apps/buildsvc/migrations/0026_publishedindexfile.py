@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def mark_indexes_dirty(apps, schema_editor):
+    # Have the next export write the compressed and by-hash variants
+    PublishedIndex = apps.get_model('buildsvc', 'PublishedIndex')
+    PublishedIndex.objects.update(dirty=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('buildsvc', '0025_published_packages'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PublishedIndexFile',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('path', models.CharField(max_length=255)),
+                ('size', models.BigIntegerField()),
+                ('md5sum', models.CharField(max_length=32)),
+                ('sha1', models.CharField(max_length=40)),
+                ('sha256', models.CharField(max_length=64)),
+                ('index', models.ForeignKey(related_name='files', to='buildsvc.PublishedIndex')),
+            ],
+        ),
+        migrations.RemoveField(
+            model_name='publishedindex',
+            name='md5sum',
+        ),
+        migrations.RemoveField(
+            model_name='publishedindex',
+            name='sha1',
+        ),
+        migrations.RemoveField(
+            model_name='publishedindex',
+            name='sha256',
+        ),
+        migrations.RemoveField(
+            model_name='publishedindex',
+            name='size',
+        ),
+        migrations.RunPython(mark_indexes_dirty, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('buildsvc', '0026_publishedindexfile'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SigningKey',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('key_id', models.CharField(max_length=100)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('repository', models.ForeignKey(related_name='signing_keys', blank=True, to='buildsvc.Repository', null=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('buildsvc', '0027_signingkey'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='repository',
+            name='last_retention_sweep',
+            field=models.DateTimeField(null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='repository',
+            name='reclaimed_bytes',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='repository',
+            name='retain_builds',
+            field=models.PositiveIntegerField(null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='repository',
+            name='retain_days',
+            field=models.PositiveIntegerField(null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='repository',
+            name='retain_log_bytes',
+            field=models.BigIntegerField(null=True, blank=True),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def mark_existing_logs_complete(apps, schema_editor):
+    # Builds from before the flag existed are long finished
+    BuildRecord = apps.get_model('buildsvc', 'BuildRecord')
+    BuildRecord.objects.update(log_complete=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('buildsvc', '0028_repository_retention'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='buildrecord',
+            name='log_complete',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.RunPython(mark_existing_logs_complete, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('buildsvc', '0029_buildrecord_log_complete'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='packagesource',
+            name='build_scheduled',
+        ),
+        migrations.AddField(
+            model_name='packagesource',
+            name='build_generation',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
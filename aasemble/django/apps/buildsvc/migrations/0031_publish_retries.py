@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('buildsvc', '0030_packagesource_build_generation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='publishoperation',
+            name='attempts',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='publishoperation',
+            name='retry_at',
+            field=models.DateTimeField(null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='buildrecord',
+            name='publish_error',
+            field=models.TextField(blank=True),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('buildsvc', '0031_publish_retries'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='packagesource',
+            name='checkout_depth',
+            field=models.PositiveIntegerField(default=1, validators=[django.core.validators.MinValueValidator(1)]),
+        ),
+    ]
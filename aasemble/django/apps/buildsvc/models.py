@@ -1,8 +1,15 @@
+import contextlib
+import datetime
+import errno
+import fcntl
+import hashlib
 import logging
+import math
 import os
 import os.path
 import shutil
 import tempfile
+import time
 import uuid
 
 from allauth.socialaccount.models import SocialToken
@@ -11,9 +18,12 @@ import deb822
 
 from django.conf import settings
 from django.contrib.auth import models as auth_models
-from django.db import models
+from django.core.validators import MinValueValidator
+from django.db import models, transaction
+from django.db.models import F
 from django.forms import ModelForm
 from django.template.loader import render_to_string
+from django.utils import timezone
 from django.utils.encoding import python_2_unicode_compatible
 from django.utils.module_loading import import_string
 
@@ -21,18 +31,38 @@ import github3
 
 from six.moves.urllib.parse import urlparse
 
-from . import tasks
-from ...utils import recursive_render, run_cmd
+from . import artifactstore, buildlog, gitcache, keypool, poller, scratch, signing, tasks
+from ...exceptions import CommandFailed
+from ...utils import recursive_render, run_cmd, tree_digest
 
 LOG = logging.getLogger(__name__)
 
 
+REPREPRO_TEMPLATES = os.path.join(os.path.dirname(__file__), 'templates/buildsvc/reprepro')
+
+_template_digests = {}
+
+
+def template_digest(path):
+    """tree_digest of a template directory, computed once per process"""
+    if path not in _template_digests:
+        _template_digests[path] = tree_digest(path)
+    return _template_digests[path]
+
+
 def ensure_dir(d):
     if not os.path.isdir(d):
         os.makedirs(d)
     return d
 
 
+def link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
 def remove_ddebs_from_changes(changes_file):
     with open(changes_file, 'r') as fp:
         changes = deb822.Changes(fp)
@@ -48,25 +78,68 @@ def remove_ddebs_from_changes(changes_file):
 
 
 class RepositoryDriver(object):
+    """Maintains the published form of a repository
+
+    Drivers get to include changes files, remove source packages and
+    export. Callers hold the repository's publish lock and call
+    prepare() once before a batch of includes and removals."""
     def __init__(self, repository):
         self.repository = repository
 
+    def key_name(self):
+        if self.repository is None:
+            # Pooled keys are made before anyone knows what they will sign
+            return 'aaSemble repository'
+        return '%s repository' % (self.repository.name,)
 
-class FakeDriver(RepositoryDriver):
     def generate_key(self):
-        return 'FAKEID'
+        LOG.info('Generating key for %s' % (self.repository or 'the signing key pool'))
+        gpg_input = render_to_string('buildsvc/gpg-keygen-input.tmpl',
+                                     {'name': self.key_name()})
+        # Made in the keyring the signer uses (BUILDSVC_GNUPGHOME)
+        output = signing.get_signer().gpg('--gen-key', input=gpg_input.encode('utf-8'))
+
+        for line in output.decode('utf-8', 'replace').split('\n'):
+            if line.startswith('gpg: key '):
+                return line.split(' ')[2]
+
+    def prepare(self):
+        pass
+
+    def include(self, series_name, changes_file):
+        raise NotImplementedError()
+
+    def remove(self, series_name, source_name):
+        raise NotImplementedError()
+
+    def export(self):
+        raise NotImplementedError()
 
 
 class RepreproDriver(RepositoryDriver):
-    def generate_key(self):
-        LOG.info('Generating key for %s' % (self.repository))
-        gpg_input = render_to_string('buildsvc/gpg-keygen-input.tmpl',
-                                     {'repository': self.repository})
-        output = run_cmd(['gpg', '--batch', '--gen-key'], input=gpg_input)
+    def prepare(self):
+        self.repository.ensure_directory_structure()
+
+    def include(self, series_name, changes_file):
+        self.repository._reprepro('--export=never', '--ignore=wrongdistribution', 'include', series_name, changes_file)
+
+    def remove(self, series_name, source_name):
+        self.repository._reprepro('--export=never', 'removesrc', series_name, source_name)
+
+    def export(self):
+        self.repository.ensure_directory_structure()
+        self.repository._reprepro('export')
 
-        for l in output.split('\n'):
-            if l.startswith('gpg: key '):
-                return l.split(' ')[2]
+        # reprepro copies files into the pool itself. Swap new ones for
+        # links to the shared store.
+        store = artifactstore.get_artifact_store()
+        if store:
+            store.dedupe(os.path.join(self.repository.outdir(), 'pool'))
+
+
+class FakeDriver(RepreproDriver):
+    def generate_key(self):
+        return 'FAKEID'
 
 
 def get_repo_driver(repository):
@@ -82,6 +155,14 @@ class Repository(models.Model):
     name = models.CharField(max_length=100)
     key_id = models.CharField(max_length=100)
     extra_admins = models.ManyToManyField(auth_models.Group)
+    include_generation = models.PositiveIntegerField(default=0)
+    export_generation = models.PositiveIntegerField(default=0)
+    # Retention policy. See retention.py. None means keep everything.
+    retain_builds = models.PositiveIntegerField(null=True, blank=True)
+    retain_days = models.PositiveIntegerField(null=True, blank=True)
+    retain_log_bytes = models.BigIntegerField(null=True, blank=True)
+    reclaimed_bytes = models.BigIntegerField(default=0)
+    last_retention_sweep = models.DateTimeField(null=True, blank=True)
 
     class Meta:
         verbose_name_plural = 'repositories'
@@ -104,7 +185,7 @@ class Repository(models.Model):
 
     def ensure_key(self):
         if not self.key_id:
-            self.key_id = get_repo_driver(self).generate_key()
+            self.key_id = keypool.claim(self) or get_repo_driver(self).generate_key()
             self.save()
 
     def first_series(self):
@@ -129,10 +210,31 @@ class Repository(models.Model):
     def gpghome(self):
         return os.path.join(self.basedir, '.gnupg')
 
+    def directory_structure_stamp(self):
+        """Changes whenever the reprepro configuration would render differently"""
+        parts = [template_digest(REPREPRO_TEMPLATES), self.name, self.key_id, self.outdir()]
+        parts += sorted(self.series.values_list('name', flat=True))
+        return hashlib.sha1('\0'.join(parts).encode('utf-8')).hexdigest()
+
     def ensure_directory_structure(self):
-        recursive_render(os.path.join(os.path.dirname(__file__),
-                                      'templates/buildsvc/reprepro'),
-                         self.basedir, {'repository': self})
+        """Render the reprepro configuration, unless it is up to date
+
+        A stamp file records what the configuration was last rendered
+        from, so repositories whose templates and settings are unchanged
+        skip rendering altogether. Returns whether it rendered."""
+        stamp = self.directory_structure_stamp()
+        stampfile = os.path.join(self.basedir, '.conf-stamp')
+        try:
+            with open(stampfile, 'r') as fp:
+                if fp.read() == stamp and os.path.isdir(self.confdir()):
+                    return False
+        except IOError:
+            pass
+
+        recursive_render(REPREPRO_TEMPLATES, self.basedir, {'repository': self})
+        with open(stampfile, 'w') as fp:
+            fp.write(stamp)
+        return True
 
     def _reprepro(self, *args):
         env = {'GNUPG_HOME': self.gpghome()}
@@ -142,21 +244,273 @@ class Repository(models.Model):
     def export_key(self):
         keypath = os.path.join(self.outdir(), 'repo.key')
         if not os.path.exists(keypath):
-            output = run_cmd(['gpg', '-a', '--export', self.key_id])
-            with open(keypath, 'w') as fp:
+            output = signing.get_signer().export_public_key(self.key_id)
+            if not output.strip():
+                LOG.warning('Signing key %s of %s not found. Not writing repo.key' % (self.key_id, self))
+                return
+            with open(keypath, 'wb') as fp:
                 fp.write(output)
 
     def export(self):
         self.ensure_key()
-        self.ensure_directory_structure()
         self.export_key()
-        self._reprepro('export')
+        get_repo_driver(self).export()
 
-    def process_changes(self, series_name, changes_file):
-        self.ensure_directory_structure()
+    def acquire_publish_lock(self, blocking=True):
+        """Take the lock that serialises changes to the repository
+
+        Returns the open lock file for release_publish_lock(), or None
+        if blocking is False and another worker holds the lock."""
+        fp = open(os.path.join(self.basedir, '.publish.lock'), 'a')
+        try:
+            fcntl.flock(fp, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except IOError as e:
+            fp.close()
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            return None
+        return fp
+
+    @staticmethod
+    def release_publish_lock(fp):
+        fcntl.flock(fp, fcntl.LOCK_UN)
+        fp.close()
+
+    @contextlib.contextmanager
+    def publish_lock(self, blocking=True):
+        """Serialise changes to the repository between workers
+
+        Yields whether the lock was taken, which is always the case
+        unless blocking is False."""
+        fp = self.acquire_publish_lock(blocking)
+        try:
+            yield fp is not None
+        finally:
+            if fp is not None:
+                self.release_publish_lock(fp)
+
+    def spooldir(self):
+        return ensure_dir(os.path.join(self.basedir, 'spool'))
+
+    def spool_changes(self, changes_file):
+        """Copy a changes file and everything it lists to the spool
+
+        Returns the path of the spooled changes file."""
         remove_ddebs_from_changes(changes_file)
-        self._reprepro('--ignore=wrongdistribution', 'include', series_name, changes_file)
-        self.export()
+        with open(changes_file, 'r') as fp:
+            changes = deb822.Changes(fp)
+
+        dest = tempfile.mkdtemp(dir=self.spooldir())
+        srcdir = os.path.dirname(changes_file)
+        for path in [changes_file] + [os.path.join(srcdir, f['name']) for f in changes.get('Files', [])]:
+            link_or_copy(path, os.path.join(dest, os.path.basename(path)))
+        return os.path.join(dest, os.path.basename(changes_file))
+
+    def queue_include(self, series_name, changes_files, build_record=None):
+        for changes_file in changes_files:
+            PublishOperation.objects.create(repository=self,
+                                            build_record=build_record,
+                                            action=PublishOperation.INCLUDE,
+                                            series_name=series_name,
+                                            argument=self.spool_changes(changes_file))
+        self.schedule_publish()
+
+    def queue_remove(self, series_name, source_name):
+        PublishOperation.objects.create(repository=self,
+                                        action=PublishOperation.REMOVE,
+                                        series_name=series_name,
+                                        argument=source_name)
+        self.schedule_publish()
+
+    def schedule_publish(self, countdown=None):
+        if countdown is None:
+            countdown = getattr(settings, 'BUILDSVC_PUBLISH_DEBOUNCE', 5)
+        tasks.publish.apply_async((self.id,), countdown=countdown)
+
+    def apply_publish_operation(self, operation, driver):
+        if operation.action == PublishOperation.INCLUDE:
+            driver.include(operation.series_name, operation.argument)
+        elif operation.action == PublishOperation.REMOVE:
+            driver.remove(operation.series_name, operation.argument)
+
+    def publish_operation_failed(self, operation, error, logger=LOG):
+        """Retry operation later, or give up on it after too many attempts
+
+        An operation is tried BUILDSVC_PUBLISH_MAX_ATTEMPTS times, with
+        the delay between attempts doubling each time. Once it has run
+        out of attempts, its error is recorded on the operation and on
+        the build that queued it, and its spooled files are removed.
+        Returns whether it will be retried."""
+        attempts = operation.attempts + 1
+        max_attempts = getattr(settings, 'BUILDSVC_PUBLISH_MAX_ATTEMPTS', 3)
+        if attempts < max_attempts:
+            delay = getattr(settings, 'BUILDSVC_PUBLISH_RETRY_DELAY', 30) * 2 ** (attempts - 1)
+            args = (operation.action, operation.argument, self, attempts, max_attempts, delay, error)
+            logger.warning('Failed to %s %s in %s (attempt %d of %d). Retrying in %d seconds: %s' % args)
+            PublishOperation.objects.filter(id=operation.id).update(attempts=attempts,
+                                                                    retry_at=timezone.now() + datetime.timedelta(seconds=delay))
+            self.schedule_publish(countdown=delay)
+            return True
+
+        args = (operation.action, operation.argument, self, attempts, error)
+        logger.error('Failed to %s %s in %s after %d attempts. Giving up: %s' % args)
+        PublishOperation.objects.filter(id=operation.id).update(attempts=attempts, error=error)
+        if operation.action == PublishOperation.INCLUDE:
+            shutil.rmtree(os.path.dirname(operation.argument), ignore_errors=True)
+        if operation.build_record_id:
+            BuildRecord.objects.filter(id=operation.build_record_id).update(publish_error=error)
+        return False
+
+    def run_publish_queue(self, others=(), logger=LOG):
+        """Apply queued operations in order, then export once
+
+        Only one worker at a time does this for any given repository,
+        and a worker that finds it busy tries again later. Exports are
+        debounced: while operations keep arriving less than
+        BUILDSVC_PUBLISH_DEBOUNCE seconds apart, the run is put off, but
+        never for more than BUILDSVC_PUBLISH_MAX_DELAY seconds after
+        the oldest operation was queued.
+
+        The queues of the repositories in others are run too, if they
+        are due, and the Release files of every repository exported are
+        signed in one batch at the end. Each repository's publish lock
+        is held until its signatures are in place. If they cannot be
+        made, the operations behind the export count as failed (see
+        publish_operation_failed()). Returns the repositories that were
+        exported."""
+        held = []
+        processed = []
+        exported = []
+        try:
+            try:
+                with signing.get_signer().batch():
+                    for repository in [self] + list(others):
+                        fp = repository.acquire_publish_lock(blocking=False)
+                        if fp is None:
+                            if repository is self:
+                                # The current writer may be done before
+                                # it sees our operations, so try again
+                                self.schedule_publish()
+                            continue
+                        held.append(fp)
+                        # Its own publish task is turned away while we hold
+                        # the lock, so it is rescheduled if it is not due
+                        applied = repository.process_publish_queue(logger=logger)
+                        if applied:
+                            processed.append((repository, applied))
+                unsigned = []
+            except signing.SigningFailed as e:
+                unsigned = e.requests
+
+            for repository, applied in processed:
+                prefix = os.path.join(repository.outdir(), '')
+                errors = [request.error for request in unsigned if request.path.startswith(prefix)]
+                if repository.publish_finished(applied, '\n'.join(errors), logger=logger):
+                    exported.append(repository)
+        finally:
+            for fp in held:
+                self.release_publish_lock(fp)
+
+        # Anything queued while we held the locks may have had its publish
+        # task turned away
+        for repository in exported:
+            if PublishOperation.objects.filter(repository=repository, error='').exists():
+                repository.schedule_publish()
+        return exported
+
+    def process_publish_queue(self, reschedule=True, logger=LOG):
+        """The body of run_publish_queue(), for callers holding the lock
+
+        An operation that fails is retried later (see
+        publish_operation_failed()), and the operations queued after it
+        wait for it. If the export fails, all the operations behind it
+        count as failed. Returns the operations behind the export, if it
+        exported, for publish_finished() once it is signed."""
+        debounce = getattr(settings, 'BUILDSVC_PUBLISH_DEBOUNCE', 5)
+        max_delay = getattr(settings, 'BUILDSVC_PUBLISH_MAX_DELAY', 60)
+
+        operations = list(PublishOperation.objects.filter(repository=self, error=''))
+        if not operations:
+            return []
+
+        now = timezone.now()
+        if operations[0].retry_at and operations[0].retry_at > now:
+            # Later operations may depend on it, so they wait too
+            if reschedule:
+                self.schedule_publish(countdown=max((operations[0].retry_at - now).total_seconds(), 1))
+            return []
+
+        quiet_for = (now - operations[-1].created).total_seconds()
+        waited = (now - operations[0].created).total_seconds()
+        if quiet_for < debounce and waited < max_delay:
+            if reschedule:
+                self.schedule_publish(countdown=max(debounce - quiet_for, 1))
+            return []
+
+        driver = get_repo_driver(self)
+        driver.prepare()
+        applied = []
+        for operation in operations:
+            started, start = timezone.now(), time.time()
+            try:
+                self.apply_publish_operation(operation, driver)
+            except CommandFailed as e:
+                if self.publish_operation_failed(operation, str(e), logger=logger):
+                    break
+                continue
+            if operation.build_record_id:
+                BuildPhase.objects.create(build_record_id=operation.build_record_id, name=operation.action,
+                                          started=started, duration=time.time() - start)
+            applied.append(operation)
+
+        if not applied:
+            return []
+
+        Repository.objects.filter(id=self.id).update(include_generation=F('include_generation') + 1)
+        self.refresh_from_db(fields=['include_generation'])
+
+        started, start = timezone.now(), time.time()
+        try:
+            self.export()
+        except Exception as e:
+            logger.exception('Failed to export %s' % (self,))
+            for operation in applied:
+                self.publish_operation_failed(operation, 'Export failed: %s' % (e,), logger=logger)
+            return []
+        duration = time.time() - start
+        Repository.objects.filter(id=self.id).update(export_generation=self.include_generation)
+
+        for build_record_id in set(operation.build_record_id for operation in applied if operation.build_record_id):
+            BuildPhase.objects.create(build_record_id=build_record_id, name='export',
+                                      started=started, duration=duration)
+        return applied
+
+    def publish_finished(self, applied, error='', logger=LOG):
+        """Remove the operations behind an export from the queue
+
+        If the export could not be signed (error is set), they stay
+        queued and count as failed instead. Applying them again is
+        harmless, and exports carry on trying to sign the Release files
+        left unsigned. Returns whether the export was completed."""
+        if error:
+            for operation in applied:
+                self.publish_operation_failed(operation, error, logger=logger)
+            return False
+
+        for operation in applied:
+            if operation.action == PublishOperation.INCLUDE:
+                shutil.rmtree(os.path.dirname(operation.argument), ignore_errors=True)
+        PublishOperation.objects.filter(id__in=[operation.id for operation in applied]).delete()
+        return True
+
+    def process_changes(self, series_name, changes_file):
+        self.queue_include(series_name, [changes_file])
+
+    def build_phase_statistics(self, since=None):
+        phases = BuildPhase.objects.filter(build_record__source__series__repository=self)
+        if since:
+            phases = phases.filter(started__gte=since)
+        return BuildPhase.statistics(phases)
 
     @property
     def base_url(self):
@@ -205,6 +559,9 @@ class Series(models.Model):
     def process_changes(self, changes_file):
         self.repository.process_changes(self.name, changes_file)
 
+    def queue_include(self, changes_files, build_record=None):
+        self.repository.queue_include(self.name, changes_files, build_record=build_record)
+
     def export(self):
         self.repository.export()
 
@@ -228,12 +585,25 @@ class ExternalDependency(models.Model):
         return self.own_series.user_can_modify(user)
 
 
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of an already sorted list"""
+    rank = int(math.ceil(p / 100.0 * len(sorted_values)))
+    return sorted_values[max(rank, 1) - 1]
+
+
 class NotAValidGithubRepository(Exception):
     pass
 
 
 @python_2_unicode_compatible
 class PackageSource(models.Model):
+    CHECKOUT_FULL = 'full'
+    CHECKOUT_SHALLOW = 'shallow'
+    CHECKOUT_BLOBLESS = 'blobless'
+    CHECKOUT_MODE_CHOICES = ((CHECKOUT_FULL, 'Full history'),
+                             (CHECKOUT_SHALLOW, 'Shallow, single branch'),
+                             (CHECKOUT_BLOBLESS, 'Blobless partial clone'))
+
     uuid = models.UUIDField(unique=True, default=uuid.uuid4, editable=False)
     git_url = models.URLField()
     branch = models.CharField(max_length=100)
@@ -243,34 +613,41 @@ class PackageSource(models.Model):
     last_built_name = models.CharField(max_length=64, null=True, blank=True)
     build_counter = models.IntegerField(default=0)
     webhook_registered = models.BooleanField(default=False)
+    build_generation = models.PositiveIntegerField(default=0)
+    checkout_mode = models.CharField(max_length=16, choices=CHECKOUT_MODE_CHOICES, default=CHECKOUT_FULL)
+    checkout_depth = models.PositiveIntegerField(default=1, validators=[MinValueValidator(1)])
+    next_poll = models.DateTimeField(default=timezone.now)
+    poll_interval = models.PositiveIntegerField(default=0)
+    last_changed = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        index_together = (('webhook_registered', 'next_poll'),)
 
     def __str__(self):
         return '%s/%s' % (self.git_url, self.branch)
 
-    def poll(self):
-        cmd = ['git', 'ls-remote', self.git_url,
-               'refs/heads/%s' % self.branch]
-        stdout = run_cmd(cmd)
-        sha = stdout.split('\t')[0]
-
-        if sha == self.last_seen_revision:
-            return False
+    @classmethod
+    def due_for_poll(cls, now=None):
+        return cls.objects.filter(webhook_registered=False, next_poll__lte=now or timezone.now())
 
-        self.last_seen_revision = sha
-        self.save()
-        return True
+    def poll(self):
+        return bool(poller.poll_sources([self]))
 
-    def checkout(self, sha=None, logger=LOG):
-        tmpdir = tempfile.mkdtemp()
+    def checkout(self, sha=None, logger=LOG, tmpdir=None):
+        tmpdir = tmpdir or tempfile.mkdtemp()
         builddir = os.path.join(tmpdir, 'build')
         try:
-            run_cmd(['git',
-                     'clone', self.git_url,
-                     '-b', self.branch,
-                     'build'],
-                    cwd=tmpdir, logger=logger)
+            cache = gitcache.get_git_cache()
+            if cache:
+                # Clones from the local mirror are cheap whatever the
+                # checkout mode, so the mirror always has full history.
+                cache.checkout(self.git_url, self.branch, builddir, logger=logger)
+            else:
+                run_cmd(['git', 'clone'] + self.clone_args() + [self.git_url, '-b', self.branch, 'build'],
+                        cwd=tmpdir, logger=logger)
 
             if sha:
+                self.ensure_revision(builddir, sha, logger=logger)
                 run_cmd(['git', 'reset', '--hard', sha], cwd=builddir, logger=logger)
 
             stdout = run_cmd(['git', 'rev-parse', 'HEAD'], cwd=builddir, logger=logger)
@@ -279,6 +656,38 @@ class PackageSource(models.Model):
             shutil.rmtree(tmpdir)
             raise
 
+    def tree_sha(self, builddir, logger=LOG):
+        return run_cmd(['git', 'rev-parse', 'HEAD^{tree}'], cwd=builddir, logger=logger).strip().decode()
+
+    def clone_args(self):
+        if self.checkout_mode == self.CHECKOUT_SHALLOW:
+            return ['--depth', str(self.checkout_depth), '--single-branch']
+        elif self.checkout_mode == self.CHECKOUT_BLOBLESS:
+            return ['--filter=blob:none']
+        return []
+
+    def has_revision(self, builddir, sha, logger=LOG):
+        try:
+            run_cmd(['git', 'cat-file', '-e', '%s^{commit}' % (sha,)], cwd=builddir, logger=logger)
+            return True
+        except CommandFailed:
+            return False
+
+    def ensure_revision(self, builddir, sha, logger=LOG):
+        """Deepen a shallow clone until it contains sha"""
+        if self.checkout_mode != self.CHECKOUT_SHALLOW or self.has_revision(builddir, sha, logger=logger):
+            return
+
+        deepen_to = getattr(settings, 'BUILDSVC_SHALLOW_DEEPEN_DEPTH', 100)
+        if deepen_to > self.checkout_depth:
+            logger.info('%s not in shallow clone. Fetching %d commits' % (sha, deepen_to))
+            run_cmd(['git', 'fetch', '--depth', str(deepen_to), 'origin', self.branch], cwd=builddir, logger=logger)
+            if self.has_revision(builddir, sha, logger=logger):
+                return
+
+        logger.info('%s still not found. Fetching full history' % (sha,))
+        run_cmd(['git', 'fetch', '--unshallow', 'origin', self.branch], cwd=builddir, logger=logger)
+
     @property
     def long_name(self):
         return '_'.join(filter(bool, urlparse(self.git_url).path.split('/')))
@@ -287,37 +696,83 @@ class PackageSource(models.Model):
     def name(self):
         return self.git_url.split('/')[-1].replace('_', '-')
 
-    def build(self):
-        tasks.build.delay(self.id)
+    def build(self, priority=0):
+        """Queue a build, unless one is already queued
+
+        A queued build always builds the branch head as of when it
+        starts, so there is no need to queue more than one. Either way,
+        a build of this source that is already running is superseded."""
+        with transaction.atomic():
+            # The update also locks the row, so concurrent calls queue one build between them
+            PackageSource.objects.filter(id=self.id).update(build_generation=F('build_generation') + 1)
+            if self.pending_builds.filter(state=PendingBuild.QUEUED).exists():
+                return False
+            repository = self.series.repository
+            PendingBuild.objects.create(source=self,
+                                        repository=repository,
+                                        user_id=repository.user_id,
+                                        priority=priority)
+        tasks.dispatch_builds.delay()
+        return True
+
+    def next_build_counter(self):
+        PackageSource.objects.filter(id=self.id).update(build_counter=F('build_counter') + 1)
+        self.refresh_from_db(fields=['build_counter'])
+        return self.build_counter
+
+    def build_superseded(self):
+        """A newer build has been requested since the current one started
+
+        build_real() records the generation it builds. Any later call
+        to build() moves the source on to a newer one."""
+        return PackageSource.objects.filter(id=self.id, build_generation__gt=self.build_generation).exists()
 
     def build_real(self):
-        self.build_counter += 1
-        self.save()
+        from . import pkgbuild
 
-        br = BuildRecord(source=self, build_counter=self.build_counter)
-        br.save()
+        # Refuses to start (before touching anything) if the scratch
+        # space is short. The caller is expected to retry later.
+        scratch_dir = scratch.allocate(self)
 
-        tmpdir, self.builddir, br.sha = self.checkout(logger=br.logger)
-        br.save()
-        try:
-            from . import pkgbuild
-            builder_cls = pkgbuild.choose_builder(self.builddir)
-            builder = builder_cls(tmpdir, self, br)
+        # Taken before checking out, so anything pushed from now on
+        # supersedes this build.
+        self.refresh_from_db(fields=['build_generation'])
 
-            builder.build()
+        br = BuildRecord(source=self, build_counter=self.next_build_counter())
+        br.save()
 
-            changes_files = filter(lambda s: s.endswith('.changes'), os.listdir(tmpdir))
+        try:
+            with br.phase('checkout'):
+                tmpdir, self.builddir, br.sha = self.checkout(logger=br.logger, tmpdir=scratch_dir.path)
+            br.save()
+            scratch_dir.check()
 
-            for changes_file in changes_files:
-                self.series.process_changes(os.path.join(tmpdir, changes_file))
+            with br.phase('detect'):
+                tree_sha = self.tree_sha(self.builddir, logger=br.logger)
+                builder_cls = pkgbuild.choose_builder(self.builddir, tree_sha=tree_sha)
+            builder = builder_cls(tmpdir, self, br, tree_sha=tree_sha, scratch_dir=scratch_dir)
 
-            self.series.export()
+            builder.build()
+            builder.check_superseded()
+            scratch.record_usage(self, scratch_dir)
+
+            changes_files = sorted(os.path.join(tmpdir, f) for f in os.listdir(tmpdir) if f.endswith('.changes'))
+
+            # The repository's publish worker includes and exports these
+            with br.phase('spool'):
+                self.series.queue_include(changes_files, build_record=br)
+        except pkgbuild.BuildSuperseded:
+            br.logger.info('A newer revision has been pushed. Cancelling build.')
+        except scratch.ScratchQuotaExceeded as e:
+            br.logger.error('Build aborted: %s' % (e,))
         finally:
-            shutil.rmtree(tmpdir)
+            br.close_log()
+            BuildRecord.objects.filter(id=br.id).update(log_complete=True)
+            scratch_dir.remove()
 
     def delete_on_filesystem(self):
         if self.last_built_name:
-            tasks.reprepro.delay(self.series.repository.id, 'removesrc', self.series.name, self.last_built_name)
+            self.series.repository.queue_remove(self.series.name, self.last_built_name)
 
     def user_can_modify(self, user):
         return self.series.user_can_modify(user)
@@ -353,13 +808,13 @@ class PackageSource(models.Model):
                 if repo.create_hook(name='web', config={'url': settings.GITHUB_WEBHOOK_URL,
                                                         'content_type': 'json'}):
                     self.webhook_registered = True
-                    self.save()
+                    self.save(update_fields=['webhook_registered'])
                     return True
         except github3.GitHubError as exc:
             msgs = [e['message'] for e in exc.errors]
             if 'Hook already exists on this repository' in msgs:
                 self.webhook_registered = True
-                self.save()
+                self.save(update_fields=['webhook_registered'])
             else:
                 raise
 
@@ -374,47 +829,50 @@ class BuildRecord(models.Model):
     build_started = models.DateTimeField(auto_now_add=True)
     build_finished = models.DateTimeField(blank=True, null=True)
     sha = models.CharField(max_length=100, null=True, blank=True)
+    log_complete = models.BooleanField(default=False)
+    publish_error = models.TextField(blank=True)
 
     def __init__(self, *args, **kwargs):
         self._logger = None
-        self._saved_logpath = None
+        self._log_sink = None
         return super(BuildRecord, self).__init__(*args, **kwargs)
 
-    @property
-    def logger(self):
+    def _open_log(self):
         logpath = self.buildlog()
 
-        if not logpath == self._saved_logpath:
-            LOG.debug('logpath changed from %r to %r' % (self._saved_logpath, logpath))
-
-            # buildlog path changed, move it
-            if self._saved_logpath and os.path.exists(self._saved_logpath):
-                LOG.debug('Existing logfile found. Renaming')
-                os.rename(self._saved_logpath, self.buildlog())
-
-            logger = logging.getLogger('buildsvc.pkgbuild.%s_%s' % (self.source.name, self.build_counter))
-            logger.setLevel(logging.DEBUG)
+        if self._log_sink is None or self._log_sink.closed:
+            self._log_sink = buildlog.BuildLogSink(logpath)
+            self._logger = buildlog.make_logger('%s_%s' % (self.source.name, self.build_counter), self._log_sink)
+        elif self._log_sink.path != logpath:
+            # The version is known now, so the log gets its final name
+            LOG.debug('logpath changed from %r to %r' % (self._log_sink.path, logpath))
+            self._log_sink.move(logpath)
 
-            for handler in logger.handlers:
-                logger.removeHandler(handler)
-
-            formatter = logging.Formatter('%(asctime)s: %(message)s')
-            logfp = logging.FileHandler(logpath)
-            logfp.setLevel(logging.DEBUG)
-            logfp.setFormatter(formatter)
+    @property
+    def logger(self):
+        self._open_log()
+        return self._logger
 
-            logger.addHandler(logfp)
-            self._logger = logger
-            self._saved_logpath = logpath
+    @property
+    def log_sink(self):
+        """Where raw build output goes, interleaved with logger's records"""
+        self._open_log()
+        return self._log_sink
 
-        return self._logger
+    def close_log(self):
+        """Flush the build log and close its file"""
+        if self._log_sink is not None:
+            self._log_sink.close()
 
     def logpath(self):
         LOG.debug('Determining logpath for %s. version = %r' % (self, self.version))
         if self.version:
             return os.path.join(self.source.long_name, '%s_%s.log' % (self.source.long_name, self.version))
         else:
-            return os.path.join(self.source.long_name, '%s_%s.tmp.log' % (self.source.long_name, self.build_counter))
+            return self.tmp_logpath()
+
+    def tmp_logpath(self):
+        return os.path.join(self.source.long_name, '%s_%s.tmp.log' % (self.source.long_name, self.build_counter))
 
     def buildlog(self):
         path = os.path.join(self.source.series.repository.buildlogdir,
@@ -427,6 +885,18 @@ class BuildRecord(models.Model):
 
         return path
 
+    def buildlog_paths(self):
+        """Where the log may be: under its final name, or the one used until the version is known"""
+        paths = [self.buildlog()]
+        if self.version:
+            paths.append(os.path.join(self.source.series.repository.buildlogdir, self.tmp_logpath()))
+        return paths
+
+    def read_log(self, offset=0, limit=None):
+        """Log bytes from offset onwards, and the offset to read from next"""
+        data = buildlog.read(self.buildlog_paths(), offset, limit)
+        return data, offset + len(data)
+
     def buildlog_url(self):
         return '%s/buildlogs/%s' % (self.source.series.repository.base_url, self.logpath())
 
@@ -435,6 +905,152 @@ class BuildRecord(models.Model):
         if self.build_started and self.build_finished:
             return (self.build_finished - self.build_started).total_seconds()
 
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Time a phase of this build and record it as a BuildPhase"""
+        started = timezone.now()
+        start = time.time()
+        try:
+            yield
+        finally:
+            BuildPhase.objects.create(build_record=self, name=name, started=started,
+                                      duration=time.time() - start)
+
+
+class BuildPhase(models.Model):
+    build_record = models.ForeignKey(BuildRecord, related_name='phases')
+    name = models.CharField(max_length=32, db_index=True)
+    started = models.DateTimeField()
+    duration = models.FloatField()
+
+    class Meta:
+        ordering = ('started', 'id')
+
+    @classmethod
+    def statistics(cls, queryset, percentiles=(50, 90, 99)):
+        """Count, mean and percentiles of the phase durations in queryset, by phase"""
+        durations = {}
+        for name, duration in queryset.values_list('name', 'duration'):
+            durations.setdefault(name, []).append(duration)
+
+        result = {}
+        for name, values in durations.items():
+            values.sort()
+            stats = {'count': len(values),
+                     'mean': sum(values) / len(values)}
+            for p in percentiles:
+                stats['p%d' % (p,)] = percentile(values, p)
+            result[name] = stats
+        return result
+
+
+class PendingBuild(models.Model):
+    """A build waiting for, or occupying, a build slot"""
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    STATE_CHOICES = ((QUEUED, 'Queued'),
+                     (RUNNING, 'Running'))
+
+    source = models.ForeignKey(PackageSource, related_name='pending_builds')
+    repository = models.ForeignKey(Repository, related_name='pending_builds')
+    user = models.ForeignKey(auth_models.User, related_name='pending_builds')
+    priority = models.IntegerField(default=0)
+    state = models.CharField(max_length=16, choices=STATE_CHOICES, default=QUEUED)
+    queued_at = models.DateTimeField(default=timezone.now)
+    started_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        index_together = (('state', 'started_at'),)
+
+
+class SigningKey(models.Model):
+    """A generated signing key, waiting in the pool or in use
+
+    Keys without a repository are free for the taking (see keypool)."""
+    key_id = models.CharField(max_length=100)
+    created = models.DateTimeField(auto_now_add=True)
+    repository = models.ForeignKey(Repository, null=True, blank=True, related_name='signing_keys')
+
+
+class PublishOperation(models.Model):
+    """A change waiting for the repository's publish worker"""
+    INCLUDE = 'include'
+    REMOVE = 'remove'
+    ACTION_CHOICES = ((INCLUDE, 'Include changes file'),
+                      (REMOVE, 'Remove source package'))
+
+    repository = models.ForeignKey(Repository, related_name='publish_operations')
+    build_record = models.ForeignKey(BuildRecord, null=True, blank=True, on_delete=models.SET_NULL, related_name='+')
+    action = models.CharField(max_length=16, choices=ACTION_CHOICES)
+    series_name = models.CharField(max_length=100)
+    argument = models.CharField(max_length=255)
+    created = models.DateTimeField(default=timezone.now)
+    error = models.TextField(blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    retry_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ('id',)
+
+
+class PublishedPackage(models.Model):
+    """A package in a series, as published by AptIndexDriver
+
+    stanza is the package's entry in its Packages or Sources index, so
+    indexes can be written without opening any package files. Source
+    packages have 'source' as their architecture."""
+    series = models.ForeignKey(Series, related_name='published_packages')
+    component = models.CharField(max_length=32, default='main')
+    architecture = models.CharField(max_length=32)
+    name = models.CharField(max_length=100)
+    source = models.CharField(max_length=100, db_index=True)
+    version = models.CharField(max_length=100)
+    stanza = models.TextField()
+    files = models.TextField()
+
+    class Meta:
+        unique_together = (('series', 'component', 'architecture', 'name'),)
+
+    def file_list(self):
+        return self.files.split()
+
+
+class PublishedIndex(models.Model):
+    """A Packages or Sources index written by AptIndexDriver
+
+    Dirty indexes get rewritten on the next export. The checksums of
+    the others' files are reused for the Release file as they are."""
+    series = models.ForeignKey(Series, related_name='published_indexes')
+    component = models.CharField(max_length=32, default='main')
+    architecture = models.CharField(max_length=32)
+    dirty = models.BooleanField(default=True)
+
+    class Meta:
+        unique_together = (('series', 'component', 'architecture'),)
+
+    @property
+    def path(self):
+        if self.architecture == 'source':
+            return '%s/source/Sources' % (self.component,)
+        return '%s/binary-%s/Packages' % (self.component, self.architecture)
+
+
+class PublishedIndexFile(models.Model):
+    """One compressed (or uncompressed) variant of a PublishedIndex"""
+    index = models.ForeignKey(PublishedIndex, related_name='files')
+    path = models.CharField(max_length=255)
+    size = models.BigIntegerField()
+    md5sum = models.CharField(max_length=32)
+    sha1 = models.CharField(max_length=40)
+    sha256 = models.CharField(max_length=64)
+
+
+class BuildEnvironment(models.Model):
+    key = models.CharField(max_length=64, unique=True)
+    size = models.BigIntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True)
+    last_used = models.DateTimeField(default=timezone.now, db_index=True)
+
 
 @python_2_unicode_compatible
 class GithubRepository(models.Model):
@@ -0,0 +1,49 @@
+import contextlib
+import sys
+import threading
+
+_local = threading.local()
+_install_lock = threading.Lock()
+
+
+class ThreadLocalStream(object):
+    """Stand-in for sys.stdout that writes to the current thread's sink
+
+    Threads (or greenlets, when threading is monkey patched) that have
+    not registered a sink write to the stream this one replaced."""
+    def __init__(self, default):
+        self.default = default
+
+    def target(self):
+        return getattr(_local, 'sink', None) or self.default
+
+    def write(self, data):
+        return self.target().write(data)
+
+    def writelines(self, lines):
+        return self.target().writelines(lines)
+
+    def flush(self):
+        return self.target().flush()
+
+    def __getattr__(self, name):
+        return getattr(self.target(), name)
+
+
+def install():
+    """Put the dispatching stream in place of sys.stdout, once"""
+    with _install_lock:
+        if not isinstance(sys.stdout, ThreadLocalStream):
+            sys.stdout = ThreadLocalStream(sys.stdout)
+
+
+@contextlib.contextmanager
+def capture_stdout(sink):
+    """Send whatever the current thread prints to sink"""
+    install()
+    previous = getattr(_local, 'sink', None)
+    _local.sink = sink
+    try:
+        yield sink
+    finally:
+        _local.sink = previous
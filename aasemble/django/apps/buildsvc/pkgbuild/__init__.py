@@ -1,26 +1,36 @@
 from __future__ import absolute_import
 
 import os
-import sys
 
 import dbuild
 
 from debian.debian_support import version_compare
 
 from django.conf import settings
+from django.core.cache import cache
 from django.template.loader import render_to_string
 from django.utils import timezone
+from django.utils.functional import cached_property
 
-from ....utils import recursive_render
+from . import fingerprint
+from .. import buildcache, buildenv, output
+from ....utils import recursive_render, run_cmd
+
+
+class BuildSuperseded(Exception):
+    pass
 
 
 class PackageBuilder(object):
-    def __init__(self, basedir, package_source, build_record):
+    def __init__(self, basedir, package_source, build_record, tree_sha=None, scratch_dir=None):
         self.basedir = basedir
+        self.tree_sha = tree_sha
+        self.scratch_dir = scratch_dir
         self.build_dependencies = []
         self.runtime_dependencies = []
         self.package_source = package_source
         self.build_record = build_record
+        self.docker_base = None
 
     @property
     def builddir(self):
@@ -32,6 +42,10 @@ class PackageBuilder(object):
 
     def build(self):
         self.build_record.logger.debug('Using %s to build' % (type(self)))
+        self.build_record.logger.debug('Probing package metadata')
+        with self.build_record.phase('metadata'):
+            metadata = self.metadata
+        self.build_record.logger.info('Package metadata: %r' % (metadata,))
         package_version = self.package_version
 
         self.build_record.version = package_version
@@ -39,14 +53,12 @@ class PackageBuilder(object):
 
         self.package_source.last_built_version = package_version
         self.package_source.last_built_name = self.sanitized_package_name
-        self.package_source.save()
+        self.package_source.save(update_fields=['last_built_version', 'last_built_name'])
 
-        self.build_record.logger.debug('Detecting Build dependencies')
-        self.build_dependencies += self.detect_build_dependencies()
+        self.build_dependencies += self.metadata['build_dependencies']
         self.build_record.logger.info('Build dependencies: %s' % (', '.join(self.build_dependencies)))
 
-        self.build_record.logger.debug('Detecting run-time dependencies')
-        self.runtime_dependencies += self.detect_runtime_dependencies()
+        self.runtime_dependencies += self.metadata['runtime_dependencies']
         self.build_record.logger.info('Runtime dependencies: %s' % (', '.join(self.runtime_dependencies)))
 
         self.populate_debian_dir()
@@ -55,11 +67,32 @@ class PackageBuilder(object):
 
         self.build_external_dependency_repo_keys()
         self.build_external_dependency_repo_sources()
-        self.docker_build_source_package()
-        self.docker_build_binary_package()
+        with self.build_record.phase('build_cache'):
+            republished = self.republish_cached_build()
+
+        if not republished:
+            with self.build_record.phase('build_environment'):
+                self.prepare_build_environment()
+            self.check_superseded()
+            with self.build_record.phase('source_build'):
+                self.docker_build_source_package()
+            self.check_scratch_quota()
+            self.check_superseded()
+            with self.build_record.phase('binary_build'):
+                self.docker_build_binary_package()
+            self.check_scratch_quota()
+            self.store_in_build_cache()
         self.build_record.build_finished = timezone.now()
         self.build_record.save()
 
+    def check_superseded(self):
+        if self.package_source.build_superseded():
+            raise BuildSuperseded()
+
+    def check_scratch_quota(self):
+        if self.scratch_dir:
+            self.scratch_dir.check()
+
     def build_external_dependency_repo_keys(self):
         """create a file which has all external dependency repos keys"""
         extdeps = self.package_source.series.externaldependency_set.all()
@@ -76,31 +109,118 @@ class PackageBuilder(object):
         with open(os.path.join(self.basedir, 'repos'), 'w') as fp:
             fp.write('\n'.join(lines))
 
+    def prepare_build_environment(self):
+        """Use a prepared image with our build dependencies, if enabled"""
+        cache = buildenv.get_build_environment_cache()
+        if cache:
+            self.docker_base = cache.prepare(self.build_dependencies, self.basedir,
+                                             self.package_source.series.name,
+                                             logger=self.build_record.logger)
+
+    def docker_build_args(self):
+        if self.docker_base:
+            dist, release = self.docker_base
+            return {'dist': dist, 'release': release}
+        return {}
+
     def docker_build_source_package(self):
         """Build source package in docker"""
         source_dir = os.path.basename(self.builddir)
-        with open(self.build_record.buildlog(), 'a+') as fp:
-            try:
-                stdout_orig = sys.stdout
-                sys.stdout = fp
-                dbuild.docker_build(build_dir=self.basedir,
-                                    build_type='source',
-                                    source_dir=source_dir,
-                                    build_owner=os.getuid())
-            finally:
-                sys.stdout = stdout_orig
+        with output.capture_stdout(self.build_record.log_sink):
+            dbuild.docker_build(build_dir=self.basedir,
+                                build_type='source',
+                                source_dir=source_dir,
+                                build_owner=os.getuid(),
+                                **self.docker_build_args())
 
     def docker_build_binary_package(self):
         """Build binary packages in docker"""
-        with open(self.build_record.buildlog(), 'a+') as fp:
-            try:
-                stdout_orig = sys.stdout
-                sys.stdout = fp
-                dbuild.docker_build(build_dir=self.basedir,
-                                    build_type='binary',
-                                    build_owner=os.getuid())
-            finally:
-                sys.stdout = stdout_orig
+        with output.capture_stdout(self.build_record.log_sink):
+            dbuild.docker_build(build_dir=self.basedir,
+                                build_type='binary',
+                                build_owner=os.getuid(),
+                                **self.docker_build_args())
+
+    def build_cache_key(self):
+        return buildcache.build_key(self.tree_sha, type(self).__name__,
+                                    self.build_dependencies, self.runtime_dependencies,
+                                    buildenv.read_file(os.path.join(self.basedir, 'repos')),
+                                    buildenv.read_file(os.path.join(self.basedir, 'keys')),
+                                    self.package_source.series.name,
+                                    buildenv.base_image())
+
+    def republish_cached_build(self):
+        """Reuse the binary packages of an identical earlier build
+
+        The stored packages get the version of this build. The source
+        package is cheap to build, so it is built from the tree, which
+        already has the new changelog entry."""
+        cache = buildcache.get_build_cache()
+        if not cache or not self.tree_sha:
+            return False
+
+        debs = cache.republish(self.build_cache_key(), self.package_version, self.basedir,
+                               logger=self.build_record.logger)
+        if debs is None:
+            return False
+
+        self.build_record.logger.info('Republishing %s as %s' % (', '.join(f for f, _ in debs), self.package_version))
+        self.build_source_package()
+        self.generate_binary_changes(debs)
+        return True
+
+    def store_in_build_cache(self):
+        cache = buildcache.get_build_cache()
+        if not cache or not self.tree_sha:
+            return
+
+        debs = [os.path.join(self.basedir, f) for f in os.listdir(self.basedir) if f.endswith('.deb')]
+        if debs:
+            cache.store(self.build_cache_key(), debs, logger=self.build_record.logger)
+
+    def changes_path(self, arch):
+        version = self.package_version.split(':', 1)[-1]
+        return os.path.join(self.basedir, '%s_%s_%s.changes' % (self.sanitized_package_name, version, arch))
+
+    def build_source_package(self):
+        """Build the source package directly, without docker"""
+        logger = self.build_record.logger
+        run_cmd(['dpkg-source', '-b', os.path.basename(self.builddir)], cwd=self.basedir, logger=logger)
+        with open(self.changes_path('source'), 'wb') as fp:
+            run_cmd(['dpkg-genchanges', '-S'], cwd=self.builddir, stdout=fp, discard_stderr=True, logger=logger)
+
+    def generate_binary_changes(self, debs):
+        logger = self.build_record.logger
+        arches = set()
+        for filename, control in debs:
+            run_cmd(['dpkg-distaddfile', filename, control.get('Section', 'misc'), control.get('Priority', 'optional')],
+                    cwd=self.builddir, logger=logger)
+            if control['Architecture'] != 'all':
+                arches.add(control['Architecture'])
+
+        if len(arches) == 1:
+            arch = arches.pop()
+        elif arches:
+            arch = 'multi'
+        else:
+            arch = 'all'
+
+        with open(self.changes_path(arch), 'wb') as fp:
+            run_cmd(['dpkg-genchanges', '-b'], cwd=self.builddir, stdout=fp, discard_stderr=True, logger=logger)
+
+    @cached_property
+    def metadata(self):
+        """Name, version and dependencies of the code being built
+
+        Probing may mean running code from the source tree, so it is
+        only done once per build."""
+        return self.probe_metadata()
+
+    def probe_metadata(self):
+        return {'name': self.name,
+                'version': None,
+                'build_dependencies': list(self.detect_build_dependencies()),
+                'runtime_dependencies': list(self.detect_runtime_dependencies())}
 
     def detect_runtime_dependencies(self):
         return []
@@ -109,7 +229,7 @@ class PackageBuilder(object):
         reqfile = os.path.join(self.builddir, '.extra_build_packages')
         if os.path.exists(reqfile):
             with open(reqfile, 'r') as fp:
-                return filter(lambda s: s, fp.read().split('\n'))
+                return [s for s in fp.read().split('\n') if s]
         return []
 
     def populate_debian_dir(self):
@@ -153,7 +273,7 @@ class PackageBuilder(object):
 
     @property
     def package_name(self):
-        return self.name
+        return self.metadata['name']
 
     @property
     def binary_pkg_name(self):
@@ -163,7 +283,7 @@ class PackageBuilder(object):
     def name(self):
         return self.package_source.name
 
-    @property
+    @cached_property
     def package_version(self):
         native_version = self.native_version
         if native_version:
@@ -191,10 +311,10 @@ class PackageBuilder(object):
 
     @property
     def native_version(self):
-        return None
+        return self.metadata['version']
 
     @classmethod
-    def is_suitable(cls, path):
+    def is_suitable(cls, fingerprint):
         return False
 
 
@@ -205,12 +325,39 @@ class PackageBuilderRegistry(object):
     def register_builder(cls, builder):
         cls.builders.append(builder)
 
+    @classmethod
+    def lookup(cls, name):
+        for builder in cls.builders:
+            if builder.__name__ == name:
+                return builder
 
-def choose_builder(path):
-    for builder in PackageBuilderRegistry.builders:
-        if builder.is_suitable(path):
+
+def builder_cache_key(tree_sha):
+    return 'buildsvc:builder:%s' % (tree_sha,)
+
+
+def choose_builder(path, tree_sha=None):
+    """Pick the builder for the source tree at path
+
+    If the git tree sha is given, the choice is cached against it, so
+    rebuilds of an identical tree skip detection entirely."""
+    if tree_sha:
+        builder = PackageBuilderRegistry.lookup(cache.get(builder_cache_key(tree_sha)))
+        if builder:
             return builder
 
+    fp = fingerprint.scan(path)
+    for builder in PackageBuilderRegistry.builders:
+        if builder.is_suitable(fp):
+            break
+    else:
+        return None
+
+    if tree_sha:
+        cache.set(builder_cache_key(tree_sha), builder.__name__,
+                  getattr(settings, 'BUILDSVC_BUILDER_CACHE_TIMEOUT', 7 * 24 * 3600))
+    return builder
+
 from . import debian  # noqa
 from . import python  # noqa
 from . import golang  # noqa
@@ -10,23 +10,28 @@ from ....utils import run_cmd
 
 class DebianBuilder(PackageBuilder):
     @classmethod
-    def is_suitable(cls, path):
-        return os.path.isdir(os.path.join(path, 'debian'))
+    def is_suitable(cls, fingerprint):
+        return fingerprint.has_dir('debian')
 
-    @property
-    def native_version(self):
-        cmd = ['dpkg-parsechangelog', '--show-field', 'Version']
-        v = run_cmd(cmd, cwd=self.builddir).strip().decode()
+    def probe_metadata(self):
+        metadata = super(DebianBuilder, self).probe_metadata()
+
+        with open(os.path.join(self.builddir, 'debian/control'), 'r') as fp:
+            ctrl = debian.deb822.Deb822(fp)
+
+        metadata['name'] = ctrl['Source']
+        for relation in debian.deb822.PkgRelation.parse_relations(ctrl.get('Build-Depends', '')):
+            metadata['build_dependencies'].append(relation[0]['name'])
+
+        changelog = run_cmd(['dpkg-parsechangelog'], cwd=self.builddir, logger=self.build_record.logger)
+        v = debian.deb822.Deb822(changelog.decode().split('\n'))['Version']
         if ':' in v:
             v = v.split(':')[1]
         if '-' in v:
             v = v.split('-')[0]
-        return v
+        metadata['version'] = v
 
-    @property
-    def package_name(self):
-        ctrl = debian.deb822.Deb822(open(os.path.join(self.builddir, 'debian/control'), 'r'))
-        return ctrl['Source']
+        return metadata
 
     def populate_debian_dir(self):
         pass
@@ -0,0 +1,72 @@
+import collections
+import os
+import os.path
+
+from django.conf import settings
+
+DEFAULT_PRUNE_DIRS = ('.git', '.hg', '.svn', '.tox', 'node_modules', 'vendor', 'Godeps')
+
+
+class ProjectFingerprint(object):
+    """What a quick look at a source tree turned up
+
+    Paths are relative to the top of the tree and always use '/'."""
+    def __init__(self):
+        self.files = set()
+        self.dirs = set()
+        self.extensions = collections.Counter()
+        self.truncated = False
+
+    def has_file(self, path):
+        return path in self.files
+
+    def has_dir(self, path):
+        return path in self.dirs
+
+    def count(self, extension):
+        return self.extensions[extension]
+
+
+def scan(path, prune_dirs=None, max_depth=None, max_entries=None):
+    """Walk a source tree once and fingerprint it
+
+    Directories named in prune_dirs are skipped entirely. The walk stops
+    descending below max_depth and stops altogether after max_entries
+    entries, in which case the fingerprint is marked as truncated."""
+    if prune_dirs is None:
+        prune_dirs = getattr(settings, 'BUILDSVC_SCAN_PRUNE_DIRS', DEFAULT_PRUNE_DIRS)
+    if max_depth is None:
+        max_depth = getattr(settings, 'BUILDSVC_SCAN_MAX_DEPTH', 6)
+    if max_entries is None:
+        max_entries = getattr(settings, 'BUILDSVC_SCAN_MAX_ENTRIES', 20000)
+
+    fingerprint = ProjectFingerprint()
+    entries = 0
+
+    for root, dirs, files in os.walk(path):
+        relroot = os.path.relpath(root, path)
+        if relroot == '.':
+            prefix, depth = '', 0
+        else:
+            prefix, depth = relroot.replace(os.sep, '/') + '/', relroot.count(os.sep) + 1
+
+        dirs[:] = sorted(d for d in dirs if d not in prune_dirs)
+
+        for d in dirs:
+            fingerprint.dirs.add(prefix + d)
+
+        for f in files:
+            fingerprint.files.add(prefix + f)
+            extension = os.path.splitext(f)[1]
+            if extension:
+                fingerprint.extensions[extension] += 1
+
+        entries += len(dirs) + len(files)
+        if entries >= max_entries:
+            fingerprint.truncated = True
+            break
+
+        if depth >= max_depth:
+            del dirs[:]
+
+    return fingerprint
@@ -1,35 +1,33 @@
-import os.path
-
 from ..pkgbuild import PackageBuilder, PackageBuilderRegistry
 from ....utils import run_cmd
 
 
 class PythonBuilder(PackageBuilder):
     @classmethod
-    def is_suitable(cls, path):
-        return os.path.exists(os.path.join(path, 'setup.py'))
+    def is_suitable(cls, fingerprint):
+        return fingerprint.has_file('setup.py')
+
+    def setup_py_fields(self, *fields):
+        """Query several setup.py fields with a single run
 
-    def retry_if_has_newlines(self, cmd, logger):
-        """Sometimes the first run will have noise in it"""
+        Sometimes the first run will have noise in it, so we only trust
+        output with exactly one line per field."""
         def run_it():
-            return run_cmd(cmd, cwd=self.builddir, discard_stderr=True, logger=logger).strip()
+            out = run_cmd(['python', 'setup.py'] + ['--%s' % (f,) for f in fields],
+                          cwd=self.builddir, discard_stderr=True, logger=self.build_record.logger)
+            return out.strip().decode().split('\n')
 
-        out = run_it()
+        lines = run_it()
 
-        if '\n' in out:
-            out = run_it()
+        if len(lines) != len(fields):
+            lines = run_it()
 
-        return out.decode()
+        return [line.strip() for line in lines[-len(fields):]]
 
-    @property
-    def native_version(self):
-        return self.retry_if_has_newlines(['python', 'setup.py', '--version'],
-                                          logger=self.build_record.logger)
-
-    @property
-    def package_name(self):
-        return self.retry_if_has_newlines(['python', 'setup.py', '--name'],
-                                          logger=self.build_record.logger)
+    def probe_metadata(self):
+        metadata = super(PythonBuilder, self).probe_metadata()
+        metadata['name'], metadata['version'] = self.setup_py_fields('name', 'version')
+        return metadata
 
     @property
     def binary_pkg_name(self):
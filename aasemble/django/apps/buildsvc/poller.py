@@ -0,0 +1,202 @@
+import collections
+import datetime
+import logging
+import os
+import subprocess
+import tempfile
+import time
+
+from django.conf import settings
+from django.db.models import Case, CharField, Value, When
+from django.utils import timezone
+
+from six.moves.urllib.parse import urlparse
+
+LOG = logging.getLogger(__name__)
+
+
+def parse_ls_remote(output):
+    """Parse git ls-remote output into a dict mapping refs to shas"""
+    if isinstance(output, bytes):
+        output = output.decode('utf-8')
+
+    heads = {}
+    for line in output.splitlines():
+        if '\t' not in line:
+            continue
+        sha, ref = line.split('\t', 1)
+        heads[ref.strip()] = sha.strip()
+    return heads
+
+
+def head_ref(source):
+    return 'refs/heads/%s' % (source.branch,)
+
+
+def group_by_remote(sources):
+    remotes = {}
+    for source in sources:
+        remotes.setdefault(source.git_url, []).append(source)
+    return remotes
+
+
+def remote_host(url):
+    return urlparse(url).netloc or url
+
+
+class LsRemoteEngine(object):
+    """Runs many git ls-remote processes at once from a single thread
+
+    At most concurrency processes run at any time, and at most per_host
+    of them against the same host. Processes that run for longer than
+    timeout seconds are killed. Output goes to temporary files rather
+    than pipes, so a remote with many refs can never block on a full
+    pipe while we are busy with other processes."""
+    tick = 0.05
+
+    def __init__(self, concurrency=None, per_host=None, timeout=None, logger=LOG):
+        self.concurrency = concurrency or getattr(settings, 'BUILDSVC_POLL_CONCURRENCY', 100)
+        self.per_host = per_host or getattr(settings, 'BUILDSVC_POLL_PER_HOST_CONCURRENCY', 20)
+        self.timeout = timeout or getattr(settings, 'BUILDSVC_POLL_TIMEOUT', 30)
+        self.logger = logger
+
+    def start(self, url, refs):
+        env = dict(os.environ)
+        env['GIT_TERMINAL_PROMPT'] = '0'
+        outfile = tempfile.TemporaryFile()
+        with open(os.devnull, 'r+') as devnull:
+            proc = subprocess.Popen(['git', 'ls-remote', url] + sorted(refs),
+                                    stdin=devnull, stdout=outfile, stderr=devnull, env=env)
+        return proc, outfile, time.time() + self.timeout
+
+    def finish(self, url, proc, outfile):
+        try:
+            if proc.returncode != 0:
+                self.logger.warning('git ls-remote %s returned %d' % (url, proc.returncode))
+                return None
+            outfile.seek(0)
+            return parse_ls_remote(outfile.read())
+        finally:
+            outfile.close()
+
+    def run(self, requests):
+        """Run ls-remote for each url in requests (a dict mapping urls to refs)
+
+        Returns a dict mapping each url to its parsed heads, or to None
+        if the remote failed or timed out."""
+        pending = collections.OrderedDict()
+        for url in sorted(requests):
+            pending.setdefault(remote_host(url), collections.deque()).append(url)
+
+        running = {}
+        per_host = collections.defaultdict(int)
+        results = {}
+
+        while pending or running:
+            for host in list(pending):
+                queue = pending[host]
+                while queue and len(running) < self.concurrency and per_host[host] < self.per_host:
+                    url = queue.popleft()
+                    running[url] = self.start(url, requests[url])
+                    per_host[host] += 1
+                if not queue:
+                    del pending[host]
+
+            for url, (proc, outfile, deadline) in list(running.items()):
+                if proc.poll() is None:
+                    if time.time() < deadline:
+                        continue
+                    self.logger.warning('git ls-remote %s timed out' % (url,))
+                    proc.kill()
+                    proc.wait()
+                del running[url]
+                per_host[remote_host(url)] -= 1
+                results[url] = self.finish(url, proc, outfile)
+
+            if running:
+                time.sleep(self.tick)
+
+        return results
+
+
+def ls_remote_many(requests, logger=LOG):
+    return LsRemoteEngine(logger=logger).run(requests)
+
+
+def min_poll_interval():
+    return getattr(settings, 'BUILDSVC_POLL_MIN_INTERVAL', 10)
+
+
+def max_poll_interval():
+    return getattr(settings, 'BUILDSVC_POLL_MAX_INTERVAL', 3600)
+
+
+def backoff_interval(interval):
+    """Next polling interval for a source that did not change"""
+    factor = getattr(settings, 'BUILDSVC_POLL_BACKOFF_FACTOR', 2)
+    return min(max(interval, min_poll_interval()) * factor, max_poll_interval())
+
+
+def record_revisions(sources, now):
+    """Store last_seen_revision for all the given sources in one query
+
+    The sources just changed, so they go back to the shortest polling
+    interval."""
+    if not sources:
+        return
+
+    model = type(sources[0])
+    revision = Case(*[When(id=source.id, then=Value(source.last_seen_revision)) for source in sources],
+                    output_field=CharField())
+    interval = min_poll_interval()
+    qs = model.objects.filter(id__in=[source.id for source in sources])
+    qs.update(last_seen_revision=revision,
+              last_changed=now,
+              poll_interval=interval,
+              next_poll=now + datetime.timedelta(seconds=interval))
+
+
+def back_off(sources, now):
+    """Push out the next poll of sources that did not change
+
+    Sources are grouped by their new interval, so this takes one query
+    per distinct interval rather than one per source."""
+    by_interval = {}
+    for source in sources:
+        by_interval.setdefault(backoff_interval(source.poll_interval), []).append(source)
+
+    for interval, interval_sources in by_interval.items():
+        qs = type(interval_sources[0]).objects.filter(id__in=[source.id for source in interval_sources])
+        qs.update(poll_interval=interval,
+                  next_poll=now + datetime.timedelta(seconds=interval))
+
+
+def poll_sources(sources, logger=LOG):
+    """Poll sources, running one ls-remote per remote, all concurrently
+
+    Returns the sources whose branch head moved."""
+    now = timezone.now()
+    changed = []
+    unchanged = []
+    remotes = group_by_remote(sources)
+    results = ls_remote_many(dict((url, set(head_ref(source) for source in remote_sources))
+                                  for url, remote_sources in remotes.items()),
+                             logger=logger)
+
+    for url, remote_sources in remotes.items():
+        heads = results.get(url)
+        if heads is None:
+            unchanged += remote_sources
+            continue
+
+        for source in remote_sources:
+            sha = heads.get(head_ref(source))
+            if sha and sha != source.last_seen_revision:
+                source.last_seen_revision = sha
+                changed.append(source)
+            else:
+                unchanged.append(source)
+
+    record_revisions(changed, now)
+    back_off(unchanged, now)
+    return changed
@@ -0,0 +1,157 @@
+import datetime
+import errno
+import logging
+import os
+import os.path
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+LOG = logging.getLogger(__name__)
+
+
+def batch_size():
+    return getattr(settings, 'BUILDSVC_RETENTION_BATCH_SIZE', 100)
+
+
+def file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return 0
+
+
+def logfile(repository, build_record):
+    return os.path.join(repository.buildlogdir, build_record.logpath())
+
+
+def protected(repository, now):
+    """Builds that are never removed, whatever the policy says
+
+    These are the latest build of each source, which is the one that
+    is published, and builds that may still be running."""
+    from .models import BuildRecord
+
+    builds = BuildRecord.objects.filter(source__series__repository=repository)
+    keep = set()
+    for source_id in set(builds.values_list('source_id', flat=True)):
+        keep.add(builds.filter(source_id=source_id).order_by('-build_counter', '-id').values_list('id', flat=True)[0])
+
+    timeout = getattr(settings, 'BUILDSVC_BUILD_TIMEOUT', 6 * 3600)
+    running = builds.filter(build_finished__isnull=True,
+                            build_started__gte=now - datetime.timedelta(seconds=timeout))
+    keep.update(running.values_list('id', flat=True))
+    return keep
+
+
+def expired(repository, now=None):
+    """The builds repository's retention policy says should go
+
+    Returns a list of (build record, log file, log size) tuples, oldest
+    build first."""
+    from .models import BuildRecord
+
+    now = now or timezone.now()
+    keep = protected(repository, now)
+    builds = list(BuildRecord.objects.filter(source__series__repository=repository)
+                                     .select_related('source')
+                                     .order_by('-build_started', '-id'))
+
+    expire = set()
+    if repository.retain_builds is not None:
+        seen = {}
+        for br in builds:
+            seen[br.source_id] = seen.get(br.source_id, 0) + 1
+            if seen[br.source_id] > repository.retain_builds:
+                expire.add(br.id)
+
+    if repository.retain_days is not None:
+        cutoff = now - datetime.timedelta(days=repository.retain_days)
+        expire.update(br.id for br in builds if br.build_started < cutoff)
+
+    expire -= keep
+
+    logs = [(br, logfile(repository, br)) for br in reversed(builds)]
+    logs = [(br, path, file_size(path)) for br, path in logs]
+
+    if repository.retain_log_bytes is not None:
+        total = sum(size for br, path, size in logs if br.id not in expire)
+        for br, path, size in logs:
+            if total <= repository.retain_log_bytes:
+                break
+            if br.id not in expire and br.id not in keep:
+                expire.add(br.id)
+                total -= size
+
+    return [(br, path, size) for br, path, size in logs if br.id in expire]
+
+
+def sweep_repository(repository, now=None, logger=LOG):
+    """Apply repository's retention policy
+
+    Expired builds are removed in batches of BUILDSVC_RETENTION_BATCH_SIZE.
+    The logs of a batch are moved aside before its BuildRecord rows are
+    deleted, and put back if that fails, so a build is never left
+    without its log. They are only removed once the rows are gone.
+    Returns the number of bytes reclaimed."""
+    from .models import BuildRecord, Repository
+
+    now = now or timezone.now()
+    candidates = expired(repository, now)
+    reclaimed = 0
+    size = batch_size()
+    for i in range(0, len(candidates), size):
+        batch = candidates[i:i + size]
+        moved = []
+        try:
+            for br, path, log_size in batch:
+                aside = '%s.expired' % (path,)
+                try:
+                    os.rename(path, aside)
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                    continue
+                moved.append(aside)
+            with transaction.atomic():
+                BuildRecord.objects.filter(id__in=[br.id for br, path, log_size in batch]).delete()
+        except Exception:
+            for aside in moved:
+                os.rename(aside, aside[:-len('.expired')])
+            raise
+
+        freed = 0
+        for aside in moved:
+            try:
+                log_size = os.path.getsize(aside)
+                os.unlink(aside)
+            except OSError as e:
+                logger.warning('Could not remove expired build log %s: %s' % (aside, e))
+                continue
+            freed += log_size
+        Repository.objects.filter(id=repository.id).update(reclaimed_bytes=F('reclaimed_bytes') + freed)
+        reclaimed += freed
+
+    Repository.objects.filter(id=repository.id).update(last_retention_sweep=now)
+    if candidates:
+        logger.info('Removed %d old builds of %s, reclaiming %d bytes' % (len(candidates), repository, reclaimed))
+    return reclaimed
+
+
+def sweep(logger=LOG):
+    """Apply the retention policy of every repository that has one
+
+    Returns the number of bytes reclaimed."""
+    from .models import Repository
+
+    reclaimed = 0
+    policy = Q(retain_builds__isnull=False) | Q(retain_days__isnull=False) | Q(retain_log_bytes__isnull=False)
+    repositories = Repository.objects.filter(policy)
+    for repository in repositories:
+        reclaimed += sweep_repository(repository, logger=logger)
+    logger.info('Retention sweep reclaimed %d bytes' % (reclaimed,))
+    return reclaimed
@@ -0,0 +1,199 @@
+import collections
+import datetime
+import logging
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+LOG = logging.getLogger(__name__)
+
+
+def max_concurrent_builds():
+    return getattr(settings, 'BUILDSVC_MAX_CONCURRENT_BUILDS', 10)
+
+
+def max_builds_per_repository():
+    return getattr(settings, 'BUILDSVC_MAX_BUILDS_PER_REPOSITORY', 2)
+
+
+def max_builds_per_user():
+    return getattr(settings, 'BUILDSVC_MAX_BUILDS_PER_USER', 4)
+
+
+def user_weight(username):
+    return getattr(settings, 'BUILDSVC_SCHEDULER_USER_WEIGHTS', {}).get(username, 1)
+
+
+def queue_order(pending_build):
+    return (-pending_build.priority, pending_build.queued_at, pending_build.id)
+
+
+class FairQueue(object):
+    """Weighted fair queue of pending builds
+
+    Every user with queued builds gets a share of the build slots in
+    proportion to their weight. The next build always comes from the
+    user with the fewest running builds relative to that weight, so a
+    user with a single build gets the next free slot however many builds
+    somebody else has queued. A user's own builds start in order of
+    priority, then age. No more than max_total builds run at once, and
+    no more than max_per_user/max_per_repository for any one user or
+    repository."""
+    def __init__(self, queued, running, max_total=None, max_per_user=None, max_per_repository=None):
+        self.max_total = max_total or max_concurrent_builds()
+        self.max_per_user = max_per_user or max_builds_per_user()
+        self.max_per_repository = max_per_repository or max_builds_per_repository()
+
+        self.queues = collections.OrderedDict()
+        self.weights = {}
+        for pending_build in sorted(queued, key=queue_order):
+            self.queues.setdefault(pending_build.user_id, []).append(pending_build)
+            self.weights[pending_build.user_id] = user_weight(pending_build.user.username)
+
+        self.running = []
+        self.per_user = collections.Counter()
+        self.per_repository = collections.Counter()
+        for pending_build in running:
+            self.start(pending_build)
+
+    def __len__(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    def start(self, pending_build):
+        self.running.append(pending_build)
+        self.per_user[pending_build.user_id] += 1
+        self.per_repository[pending_build.repository_id] += 1
+
+    def finish(self, pending_build):
+        self.running.remove(pending_build)
+        self.per_user[pending_build.user_id] -= 1
+        self.per_repository[pending_build.repository_id] -= 1
+
+    def may_start(self, pending_build):
+        if self.per_user[pending_build.user_id] >= self.max_per_user:
+            return False
+        return self.per_repository[pending_build.repository_id] < self.max_per_repository
+
+    def share(self, user_id):
+        return float(self.per_user[user_id] + 1) / self.weights[user_id]
+
+    def pop(self):
+        """Start the next build, or return None if none may start now"""
+        if len(self.running) >= self.max_total:
+            return None
+
+        best = None
+        for user_id, queue in self.queues.items():
+            candidate = next((pending_build for pending_build in queue if self.may_start(pending_build)), None)
+            if candidate is None:
+                continue
+            key = (self.share(user_id),) + queue_order(candidate)
+            if best is None or key < best[0]:
+                best = (key, candidate)
+
+        if best is None:
+            return None
+
+        pending_build = best[1]
+        queue = self.queues[pending_build.user_id]
+        queue.remove(pending_build)
+        if not queue:
+            del self.queues[pending_build.user_id]
+        self.start(pending_build)
+        return pending_build
+
+    def estimate_start_times(self, duration, now):
+        """Simulate the rest of the queue, assuming every build takes duration
+
+        Returns a dict mapping pending build ids to estimated start times.
+        This consumes the queue."""
+        finish_times = dict((pending_build.id, max((pending_build.started_at or now) + duration, now))
+                            for pending_build in self.running)
+        estimates = {}
+        clock = now
+        while self.queues:
+            pending_build = self.pop()
+            if pending_build is None:
+                if not self.running:
+                    break
+                done = min(self.running, key=lambda pb: finish_times[pb.id])
+                clock = max(clock, finish_times[done.id])
+                self.finish(done)
+                continue
+            estimates[pending_build.id] = clock
+            finish_times[pending_build.id] = clock + duration
+        return estimates
+
+
+def expected_build_duration(sample_size=50):
+    """Average duration of recent builds"""
+    from .models import BuildRecord
+
+    recent = BuildRecord.objects.filter(build_finished__isnull=False).order_by('-build_started')[:sample_size]
+    durations = [br.duration for br in recent]
+    if not durations:
+        return datetime.timedelta(seconds=getattr(settings, 'BUILDSVC_DEFAULT_BUILD_DURATION', 600))
+    return datetime.timedelta(seconds=sum(durations) / len(durations))
+
+
+def remove_stale(now, logger=LOG):
+    """Forget running builds whose worker must have died"""
+    from .models import PendingBuild
+
+    timeout = getattr(settings, 'BUILDSVC_BUILD_TIMEOUT', 6 * 3600)
+    stale = PendingBuild.objects.filter(state=PendingBuild.RUNNING,
+                                        started_at__lt=now - datetime.timedelta(seconds=timeout))
+    for pending_build in stale:
+        logger.warning('Build of %s started at %s never finished. Releasing its slot.' % (pending_build.source, pending_build.started_at))
+    stale.delete()
+
+
+def dispatch(logger=LOG):
+    """Hand as many queued builds to workers as the limits allow"""
+    from . import tasks
+    from .models import PendingBuild
+
+    now = timezone.now()
+    remove_stale(now, logger=logger)
+
+    with transaction.atomic():
+        pending = list(PendingBuild.objects.select_for_update().select_related('user'))
+        queue = FairQueue([pb for pb in pending if pb.state == PendingBuild.QUEUED],
+                          [pb for pb in pending if pb.state == PendingBuild.RUNNING])
+        started = []
+        while True:
+            pending_build = queue.pop()
+            if pending_build is None:
+                break
+            started.append(pending_build)
+
+        if started:
+            PendingBuild.objects.filter(id__in=[pb.id for pb in started]).update(state=PendingBuild.RUNNING, started_at=now)
+
+    for pending_build in started:
+        tasks.build.delay(pending_build.source_id, pending_build.id)
+
+    return started
+
+
+def queue_status(now=None):
+    """All pending builds, each with an estimated_start attribute
+
+    Running builds come first, then queued builds in the order they are
+    expected to start."""
+    from .models import PendingBuild
+
+    now = now or timezone.now()
+    pending = list(PendingBuild.objects.select_related('user', 'source'))
+    running = [pb for pb in pending if pb.state == PendingBuild.RUNNING]
+    queued = [pb for pb in pending if pb.state == PendingBuild.QUEUED]
+
+    estimates = FairQueue(queued, running).estimate_start_times(expected_build_duration(), now)
+
+    for pb in running:
+        pb.estimated_start = pb.started_at
+    for pb in queued:
+        pb.estimated_start = estimates.get(pb.id)
+
+    return running + sorted(queued, key=lambda pb: (pb.estimated_start is None, pb.estimated_start, queue_order(pb)))
@@ -0,0 +1,158 @@
+import errno
+import logging
+import os
+import os.path
+import shutil
+import socket
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .lrustore import dir_size
+
+LOG = logging.getLogger(__name__)
+
+OWNER_FILE = '.owner'
+
+
+class InsufficientScratchSpace(Exception):
+    pass
+
+
+class ScratchQuotaExceeded(Exception):
+    pass
+
+
+def scratch_root():
+    return getattr(settings, 'BUILDSVC_SCRATCH_DIR', None) or os.path.join(tempfile.gettempdir(), 'aasemble-scratch')
+
+
+def tmpfs_root():
+    return getattr(settings, 'BUILDSVC_SCRATCH_TMPFS_DIR', None)
+
+
+def roots():
+    return [root for root in (scratch_root(), tmpfs_root()) if root]
+
+
+def host_dir(root):
+    """Where this host keeps its build trees under root
+
+    The scratch root may be shared between hosts, but only the host that
+    created a tree can tell whether its build is still running."""
+    return os.path.join(root, socket.gethostname())
+
+
+def free_space(path):
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+
+def size_key(package_source_id):
+    return 'buildsvc:scratch-size:%d' % (package_source_id,)
+
+
+def expected_size(package_source):
+    """Space the last build of package_source took, if known"""
+    return cache.get(size_key(package_source.id))
+
+
+def record_usage(package_source, scratch):
+    cache.set(size_key(package_source.id), scratch.usage(), None)
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+class ScratchDir(object):
+    """A build tree in the scratch space, with an optional size limit"""
+    def __init__(self, path, quota=None):
+        self.path = path
+        self.quota = quota
+
+    def usage(self):
+        return dir_size(self.path)
+
+    def check(self):
+        """Raise ScratchQuotaExceeded if the tree has outgrown its quota"""
+        if self.quota:
+            usage = self.usage()
+            if usage > self.quota:
+                raise ScratchQuotaExceeded('%s uses %d bytes. Limit is %d bytes' % (self.path, usage, self.quota))
+
+    def remove(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+def choose_root(expected):
+    """tmpfs for sources known to be small, disk for everything else"""
+    tmpfs = tmpfs_root()
+    if tmpfs and expected is not None:
+        if expected <= getattr(settings, 'BUILDSVC_SCRATCH_TMPFS_MAX_SIZE', 256 * 1024 * 1024):
+            if os.path.isdir(tmpfs) and free_space(tmpfs) >= 2 * expected:
+                return tmpfs
+    return scratch_root()
+
+
+def allocate(package_source, logger=LOG):
+    """Set aside a build tree for a build of package_source
+
+    Raises InsufficientScratchSpace if there is not enough free space
+    to start the build, based on what its previous build used."""
+    sweep(logger=logger)
+
+    expected = expected_size(package_source)
+    root = choose_root(expected)
+    hostdir = host_dir(root)
+    if not os.path.isdir(hostdir):
+        os.makedirs(hostdir)
+
+    needed = getattr(settings, 'BUILDSVC_SCRATCH_MIN_FREE', 1024 * 1024 * 1024) + (expected or 0)
+    available = free_space(hostdir)
+    if available < needed:
+        raise InsufficientScratchSpace('%d bytes free in %s. Need %d bytes' % (available, root, needed))
+
+    path = tempfile.mkdtemp(prefix='build-', dir=hostdir)
+    with open(os.path.join(path, OWNER_FILE), 'w') as fp:
+        fp.write('%d\n' % (os.getpid(),))
+
+    logger.debug('Allocated %s for building %s' % (path, package_source))
+    return ScratchDir(path, getattr(settings, 'BUILDSVC_SCRATCH_QUOTA', None))
+
+
+def is_orphaned(path, max_age):
+    """The process that allocated path is gone, or has run for too long"""
+    owner = os.path.join(path, OWNER_FILE)
+    try:
+        with open(owner, 'r') as fp:
+            pid = int(fp.read().strip())
+        started = os.path.getmtime(owner)
+    except (IOError, OSError, ValueError):
+        # Either half way through being allocated or left in a bad state
+        return time.time() - os.path.getmtime(path) > 60
+
+    return not pid_alive(pid) or time.time() - started > max_age
+
+
+def sweep(logger=LOG):
+    """Remove this host's build trees whose build is no longer running"""
+    max_age = getattr(settings, 'BUILDSVC_BUILD_TIMEOUT', 6 * 3600)
+    removed = []
+    for root in roots():
+        hostdir = host_dir(root)
+        if not os.path.isdir(hostdir):
+            continue
+        for d in os.listdir(hostdir):
+            path = os.path.join(hostdir, d)
+            if os.path.isdir(path) and is_orphaned(path, max_age):
+                logger.info('Removing orphaned build tree %s' % (path,))
+                shutil.rmtree(path, ignore_errors=True)
+                removed.append(path)
+    return removed
@@ -3,7 +3,7 @@ from django.contrib.auth.models import User
 from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 
-from . import models
+from . import keypool, models
 
 
 @receiver(post_save, sender=User)
@@ -21,6 +21,16 @@ def user_save_handler(sender, **kwargs):
                 series.save()
 
 
+@receiver(post_save, sender=models.Repository)
+def repository_post_save_handler(sender, instance, created, raw=False, **kwargs):
+    """Give new repositories a key from the pool, so they never wait for one"""
+    if created and not raw and not instance.key_id:
+        key_id = keypool.claim(instance)
+        if key_id:
+            models.Repository.objects.filter(id=instance.id).update(key_id=key_id)
+            instance.key_id = key_id
+
+
 @receiver(post_delete, sender=models.PackageSource)
 def package_source_post_delete_handler(sender, instance, **kwargs):
     instance.delete_on_filesystem()
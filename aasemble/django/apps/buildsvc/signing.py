@@ -0,0 +1,195 @@
+import contextlib
+import logging
+import os
+import os.path
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from ...exceptions import CommandFailed
+from ...utils import run_cmd
+
+LOG = logging.getLogger(__name__)
+
+COUNT_KEY = 'buildsvc:signing:count'
+SAMPLES_KEY = 'buildsvc:signing:samples'
+MAX_SAMPLES = 1000
+
+
+class SigningFailed(Exception):
+    """Raised once a batch is signed, if any of its requests failed"""
+    def __init__(self, requests):
+        self.requests = requests
+        super(SigningFailed, self).__init__('Failed to sign %s' % (', '.join(request.path for request in requests),))
+
+
+def record_latency(seconds):
+    cache.add(COUNT_KEY, 0, None)
+    cache.incr(COUNT_KEY)
+    samples = cache.get(SAMPLES_KEY, [])[-(MAX_SAMPLES - 1):]
+    samples.append(seconds)
+    cache.set(SAMPLES_KEY, samples, None)
+
+
+def stats():
+    """Number of signatures made, and latency of the recent ones"""
+    from .models import percentile
+
+    samples = sorted(cache.get(SAMPLES_KEY, []))
+    result = {'count': cache.get(COUNT_KEY, 0)}
+    if samples:
+        result['mean'] = sum(samples) / len(samples)
+        for p in (50, 90, 99):
+            result['p%d' % (p,)] = percentile(samples, p)
+    return result
+
+
+class SignRequest(object):
+    """A file to sign, and where to put the signatures
+
+    Either or both of clearsign_to and detach_sign_to may be given.
+    done, if given, is called once the signatures are written. If
+    they cannot be, error says why."""
+    def __init__(self, key_id, path, clearsign_to=None, detach_sign_to=None, done=None):
+        self.key_id = key_id
+        self.path = path
+        self.clearsign_to = clearsign_to
+        self.detach_sign_to = detach_sign_to
+        self.done = done
+        self.latency = None
+        self.error = None
+
+
+class Signer(object):
+    """Signs files with the keys in one keyring
+
+    The keyring's gpg-agent is started once and left running, so the
+    secret keys stay loaded between signatures instead of being read
+    for every gpg process. Inside batch(), requests are collected and
+    signed together when the batch ends, grouped by key."""
+    def __init__(self, gpghome=None):
+        self.gpghome = gpghome
+        self.agent_running = False
+        self.public_keys = {}
+        self.pending = []
+        self.batch_depth = 0
+        self.lock = threading.RLock()
+
+    def env(self):
+        if self.gpghome:
+            return {'GNUPGHOME': self.gpghome}
+        return None
+
+    def gpg(self, *args, **kwargs):
+        return run_cmd(['gpg', '--batch', '--yes'] + list(args), override_env=self.env(), **kwargs)
+
+    def start_agent(self):
+        if self.agent_running:
+            return
+        try:
+            run_cmd(['gpgconf', '--launch', 'gpg-agent'], override_env=self.env())
+        except (CommandFailed, OSError) as e:
+            # GnuPG 1.x has no agent to keep warm
+            LOG.warning('Could not start gpg-agent: %s' % (e,))
+        self.agent_running = True
+
+    def submit(self, request):
+        with self.lock:
+            self.pending.append(request)
+            if not self.batch_depth:
+                self.flush()
+
+    @contextlib.contextmanager
+    def batch(self):
+        with self.lock:
+            self.batch_depth += 1
+        try:
+            yield self
+        finally:
+            with self.lock:
+                self.batch_depth -= 1
+                if not self.batch_depth:
+                    self.flush()
+
+    def sign(self, request):
+        start = time.time()
+        if request.clearsign_to:
+            self.gpg('-u', request.key_id, '--clearsign', '-o', request.clearsign_to, request.path)
+        if request.detach_sign_to:
+            self.gpg('-u', request.key_id, '--detach-sign', '--armor', '-o', request.detach_sign_to, request.path)
+        request.latency = time.time() - start
+        record_latency(request.latency)
+
+    def flush(self):
+        """Sign everything submitted so far. Returns the requests signed.
+
+        A request that fails to sign does not stop the others. Once they
+        have all been tried, SigningFailed is raised for the failures."""
+        with self.lock:
+            requests, self.pending = self.pending, []
+            if not requests:
+                return requests
+
+            self.start_agent()
+            signed = []
+            failed = []
+            for request in sorted(requests, key=lambda r: r.key_id):
+                try:
+                    self.sign(request)
+                except CommandFailed as e:
+                    request.error = 'Failed to sign %s with %s: %s' % (request.path, request.key_id, e)
+                    LOG.error(request.error)
+                    failed.append(request)
+                    continue
+                LOG.debug('Signed %s with %s in %.3fs' % (request.path, request.key_id, request.latency))
+                if request.done:
+                    request.done()
+                signed.append(request)
+            if failed:
+                raise SigningFailed(failed)
+            return signed
+
+    def export_public_key(self, key_id):
+        with self.lock:
+            if key_id not in self.public_keys:
+                output = self.gpg('-a', '--export', key_id)
+                if not output.strip():
+                    # Not in this keyring (yet), so do not remember it
+                    return output
+                self.public_keys[key_id] = output
+            return self.public_keys[key_id]
+
+
+_signers = {}
+_signers_lock = threading.Lock()
+
+
+def get_signer(gpghome=None):
+    """The process's Signer for gpghome (BUILDSVC_GNUPGHOME by default)"""
+    gpghome = gpghome or getattr(settings, 'BUILDSVC_GNUPGHOME', None)
+    with _signers_lock:
+        if gpghome not in _signers:
+            _signers[gpghome] = Signer(gpghome)
+        return _signers[gpghome]
+
+
+def sign_release(key_id, distdir):
+    """Sign distdir/Release.new, then put it in place as Release
+
+    InRelease and Release.gpg are written under temporary names and
+    renamed into place together with Release once both exist, so
+    clients never see a Release that does not match its signatures."""
+    def path(name):
+        return os.path.join(distdir, name)
+
+    def done():
+        os.rename(path('InRelease.new'), path('InRelease'))
+        os.rename(path('Release.gpg.new'), path('Release.gpg'))
+        os.rename(path('Release.new'), path('Release'))
+
+    get_signer().submit(SignRequest(key_id, path('Release.new'),
+                                    clearsign_to=path('InRelease.new'),
+                                    detach_sign_to=path('Release.gpg.new'),
+                                    done=done))
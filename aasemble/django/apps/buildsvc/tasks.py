@@ -1,5 +1,7 @@
 from celery import shared_task
 
+from django.conf import settings
+
 
 @shared_task(ignore_result=True)
 def reprepro(repository_id, *args):
@@ -9,10 +11,35 @@ def reprepro(repository_id, *args):
 
 
 @shared_task(ignore_result=True)
-def build(package_source_id):
-    from .models import PackageSource
-    ps = PackageSource.objects.get(id=package_source_id)
-    ps.build_real()
+def publish(repository_id):
+    from .models import Repository
+    # Whatever else is due goes along, so signing is batched
+    others = Repository.objects.filter(publish_operations__error='').exclude(id=repository_id).distinct()
+    Repository.objects.get(id=repository_id).run_publish_queue(others=others)
+
+
+@shared_task(bind=True, ignore_result=True, max_retries=None)
+def build(self, package_source_id, pending_build_id=None):
+    from .models import PackageSource, PendingBuild
+    from .scratch import InsufficientScratchSpace
+    retrying = False
+    try:
+        ps = PackageSource.objects.get(id=package_source_id)
+        ps.build_real()
+    except InsufficientScratchSpace as exc:
+        # Hold on to the build slot while waiting for space to free up
+        retrying = True
+        raise self.retry(exc=exc, countdown=getattr(settings, 'BUILDSVC_SCRATCH_RETRY_DELAY', 60))
+    finally:
+        if pending_build_id is not None and not retrying:
+            PendingBuild.objects.filter(id=pending_build_id).delete()
+            dispatch_builds.delay()
+
+
+@shared_task(ignore_result=True)
+def dispatch_builds():
+    from .scheduler import dispatch
+    dispatch()
 
 
 @shared_task(ignore_result=True)
@@ -26,5 +53,46 @@ def poll_one(package_source_id):
 @shared_task(ignore_result=True)
 def poll_all():
     from .models import PackageSource
-    for ps in PackageSource.objects.filter(webhook_registered=False):
-        poll_one.delay(ps.id)
+    from .poller import poll_sources
+    for ps in poll_sources(PackageSource.due_for_poll()):
+        ps.build()
+
+
+@shared_task(ignore_result=True)
+def evict_build_environments():
+    from .buildenv import get_build_environment_cache
+    cache = get_build_environment_cache()
+    if cache:
+        cache.evict()
+
+
+@shared_task(ignore_result=True)
+def sweep_scratch():
+    from .scratch import sweep
+    sweep()
+
+
+@shared_task(ignore_result=True)
+def refill_key_pool():
+    from .keypool import refill
+    refill()
+
+
+@shared_task(ignore_result=True)
+def generate_pool_key(slot):
+    from .keypool import generate
+    generate(slot)
+
+
+@shared_task(ignore_result=True)
+def collect_artifacts():
+    from .artifactstore import get_artifact_store
+    store = get_artifact_store()
+    if store:
+        store.collect()
+
+
+@shared_task(ignore_result=True)
+def apply_retention():
+    from .retention import sweep
+    sweep()
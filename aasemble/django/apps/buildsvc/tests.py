@@ -1,19 +1,46 @@
+import contextlib
+import datetime
+import errno
+import gc
+import gzip
+import io
+import logging
 import os.path
+import shutil
 import subprocess
+import tarfile
+import tempfile
+import threading
 import time
+import weakref
 
 from django.contrib.auth import models as auth_models
+from django.core.cache import cache
 from django.db.utils import IntegrityError
 from django.test import override_settings
 from django.test.utils import skipIf
+from django.utils import timezone
 
 import github3
 
 import mock
 
+from aasemble.django.exceptions import CommandFailed
 from aasemble.django.tests import AasembleTestCase as TestCase
 
-from .models import BuildRecord, NotAValidGithubRepository, PackageSource, Repository, Series
+from .aptindex import AptIndexDriver
+from .artifactstore import ArtifactStore
+from .buildcache import BuildCache, build_key, read_ar, rewrite_deb_version, stats, write_ar
+from .buildenv import BuildEnvironmentCache, BuildEnvironmentFailed, environment_key
+from .buildlog import tail
+from .gitcache import GitCache, normalize_git_url
+from .keypool import claim, generate, refill
+from .models import BuildEnvironment, BuildPhase, BuildRecord, NotAValidGithubRepository, PackageSource, PendingBuild, PublishOperation, PublishedIndex, PublishedIndexFile, PublishedPackage, Repository, Series, SigningKey
+from .poller import LsRemoteEngine, backoff_interval, parse_ls_remote, poll_sources
+from .retention import sweep as sweep_retention, sweep_repository
+from .scheduler import FairQueue, dispatch, queue_status, remove_stale
+from .scratch import InsufficientScratchSpace, ScratchDir, ScratchQuotaExceeded
+from .signing import SignRequest, Signer, SigningFailed, stats as signing_stats
 
 try:
     subprocess.check_call(['docker', 'ps'])
@@ -21,6 +48,46 @@ try:
 except:
     docker_available = False
 
+try:
+    subprocess.check_call(['gpg', '--version'])
+    gpg_available = True
+except (OSError, subprocess.CalledProcessError):
+    gpg_available = False
+
+THROWAWAY_KEY_PARAMS = b'''Key-Type: RSA
+Key-Length: 1024
+Name-Real: Throwaway test key
+Expire-Date: 0
+%no-protection
+%commit
+'''
+
+
+def make_throwaway_keyring(testcase):
+    """Create a keyring holding one new key, for the duration of testcase
+
+    Returns the keyring's directory and the key's id."""
+    gpghome = tempfile.mkdtemp()
+    os.chmod(gpghome, 0o700)
+    env = dict(os.environ, GNUPGHOME=gpghome)
+    testcase.addCleanup(shutil.rmtree, gpghome, True)
+    testcase.addCleanup(subprocess.call, ['gpgconf', '--kill', 'gpg-agent'], env=env)
+
+    proc = subprocess.Popen(['gpg', '--batch', '--gen-key'], stdin=subprocess.PIPE, env=env)
+    proc.communicate(THROWAWAY_KEY_PARAMS)
+    output = subprocess.check_output(['gpg', '--batch', '--with-colons', '--list-secret-keys'], env=env)
+    key_id = [line.split(':')[4] for line in output.decode('ascii').splitlines() if line.startswith('sec:')][0]
+    return gpghome, key_id
+
+
+def verify_signature(gpghome, *args):
+    """Whether gpgv accepts the signature, checked against gpghome's public keys"""
+    env = dict(os.environ, GNUPGHOME=gpghome)
+    keyring = os.path.join(gpghome, 'trusted.gpg')
+    with open(keyring, 'wb') as fp:
+        fp.write(subprocess.check_output(['gpg', '--batch', '--export'], env=env))
+    return subprocess.call(['gpgv', '--keyring', keyring] + list(args)) == 0
+
 
 class PkgBuildTestCase(TestCase):
     @skipIf(not docker_available, 'Docker unavailable')
@@ -57,6 +124,124 @@ class PkgBuildTestCase(TestCase):
         self.assertTrue(os.path.exists(os.path.join(basedir, 'buildsvctest_0.1+10_amd64.changes')))
 
 
+class ChooseBuilderTestCase(TestCase):
+    def setUp(self):
+        super(ChooseBuilderTestCase, self).setUp()
+        self.tree = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tree)
+
+    def _touch(self, *parts):
+        path = os.path.join(self.tree, *parts)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        open(path, 'w').close()
+
+    def test_scan_prunes_dirs(self):
+        from .pkgbuild import fingerprint
+
+        self._touch('setup.py')
+        self._touch('.git', 'objects', 'foo.go')
+        self._touch('vendor', 'bar.go')
+        self._touch('src', 'pkg', 'baz.py')
+
+        fp = fingerprint.scan(self.tree)
+
+        self.assertTrue(fp.has_file('setup.py'))
+        self.assertTrue(fp.has_file('src/pkg/baz.py'))
+        self.assertTrue(fp.has_dir('src/pkg'))
+        self.assertFalse(fp.has_dir('.git'))
+        self.assertEquals(fp.count('.go'), 0)
+        self.assertEquals(fp.count('.py'), 2)
+
+    def test_scan_max_depth(self):
+        from .pkgbuild import fingerprint
+
+        self._touch('a', 'b', 'c', 'deep.go')
+
+        self.assertEquals(fingerprint.scan(self.tree, max_depth=1).count('.go'), 0)
+        self.assertEquals(fingerprint.scan(self.tree, max_depth=3).count('.go'), 1)
+
+    def test_scan_max_entries(self):
+        from .pkgbuild import fingerprint
+
+        for i in range(10):
+            self._touch('d%d' % (i,), 'file.go')
+
+        fp = fingerprint.scan(self.tree, max_entries=5)
+
+        self.assertTrue(fp.truncated)
+        self.assertLess(fp.count('.go'), 10)
+
+    def test_choose_builder(self):
+        from . import pkgbuild
+
+        self._touch('main.go')
+        self.assertEquals(pkgbuild.choose_builder(self.tree), pkgbuild.golang.GolangBuilder)
+
+        self._touch('setup.py')
+        self.assertEquals(pkgbuild.choose_builder(self.tree), pkgbuild.python.PythonBuilder)
+
+        self._touch('debian', 'control')
+        self.assertEquals(pkgbuild.choose_builder(self.tree), pkgbuild.debian.DebianBuilder)
+
+    def test_choose_builder_cached_by_tree_sha(self):
+        from . import pkgbuild
+
+        self._touch('setup.py')
+        self.assertEquals(pkgbuild.choose_builder(self.tree, tree_sha='abc123'), pkgbuild.python.PythonBuilder)
+
+        with mock.patch('aasemble.django.apps.buildsvc.pkgbuild.fingerprint.scan') as scan:
+            self.assertEquals(pkgbuild.choose_builder(self.tree, tree_sha='abc123'), pkgbuild.python.PythonBuilder)
+            self.assertFalse(scan.called)
+
+
+class PackageBuilderMetadataTestCase(TestCase):
+    def _builder(self, builder_cls):
+        source = PackageSource.objects.get(id=1)
+        br = mock.MagicMock(build_counter=3)
+        return builder_cls(tempfile.gettempdir(), source, br)
+
+    @mock.patch('aasemble.django.apps.buildsvc.pkgbuild.python.run_cmd')
+    def test_python_builder_probes_once(self, run_cmd):
+        from .pkgbuild.python import PythonBuilder
+
+        run_cmd.return_value = b'my_package\n1.2.3\n'
+        builder = self._builder(PythonBuilder)
+
+        self.assertEquals(builder.package_version, '1.2.3+3')
+        self.assertEquals(builder.sanitized_package_name, 'my-package')
+        self.assertEquals(builder.binary_pkg_name, 'python-my_package')
+        self.assertEquals(builder.package_version, '1.2.3+3')
+
+        run_cmd.assert_called_once_with(['python', 'setup.py', '--name', '--version'],
+                                        cwd=builder.builddir, discard_stderr=True, logger=mock.ANY)
+
+    @mock.patch('aasemble.django.apps.buildsvc.pkgbuild.python.run_cmd')
+    def test_python_builder_retries_noisy_output(self, run_cmd):
+        from .pkgbuild.python import PythonBuilder
+
+        run_cmd.side_effect = [b'some warning\nmy_package\n1.2.3\n', b'my_package\n1.2.3\n']
+        builder = self._builder(PythonBuilder)
+
+        self.assertEquals(builder.metadata['name'], 'my_package')
+        self.assertEquals(builder.metadata['version'], '1.2.3')
+        self.assertEquals(run_cmd.call_count, 2)
+
+    @mock.patch('aasemble.django.apps.buildsvc.pkgbuild.debian.run_cmd')
+    def test_debian_builder_probes_once(self, run_cmd):
+        from .pkgbuild.debian import DebianBuilder
+
+        run_cmd.return_value = b'Source: buildsvctest\nVersion: 1:0.1-2\nDistribution: trusty\n'
+        basedir = os.path.join(os.path.dirname(__file__), 'test_data', 'debian')
+        builder = DebianBuilder(basedir, PackageSource.objects.get(id=1), mock.MagicMock(build_counter=3))
+
+        self.assertEquals(builder.package_version, '0.1+3')
+        self.assertEquals(builder.package_name, 'buildsvctest')
+        self.assertEquals(builder.package_version, '0.1+3')
+
+        self.assertEquals(run_cmd.call_count, 1)
+
+
 class RepositoryTestCase(TestCase):
     def test_unicode(self):
         repo = Repository.objects.get(id=12)
@@ -98,6 +283,24 @@ class RepositoryTestCase(TestCase):
         repo.ensure_key()
         self.assertEquals(repo.key_id, 'FAKEID')
 
+    def test_generate_key_uses_signing_keyring(self):
+        from .models import RepreproDriver
+        output = b'gpg: key 0123ABCD marked as ultimately trusted\n'
+        with mock.patch('aasemble.django.apps.buildsvc.signing.Signer.gpg', return_value=output) as gpg:
+            self.assertEquals(RepreproDriver(None).generate_key(), '0123ABCD')
+        self.assertEquals(gpg.call_args[0], ('--gen-key',))
+
+    def test_export_key_skips_missing_key(self):
+        repo = Repository.objects.get(id=1)
+        basedir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, basedir)
+
+        with override_settings(BUILDSVC_REPOS_BASE_PUBLIC_DIR=basedir), \
+                mock.patch('aasemble.django.apps.buildsvc.signing.Signer.gpg', return_value=b''):
+            os.makedirs(repo.outdir())
+            repo.export_key()
+            self.assertFalse(os.path.exists(os.path.join(repo.outdir(), 'repo.key')))
+
     def test_first_series(self):
         """
         What exactly constitutes the "first" series is poorly defined.
@@ -157,18 +360,45 @@ class RepositoryTestCase(TestCase):
         repo = Repository.objects.get(id=12)
         self.assertEquals(repo.gpghome(), '/some/dir/eric/eric5/.gnupg')
 
-    @override_settings(BUILDSVC_REPOS_BASE_DIR='/some/public/dir')
-    @mock.patch('aasemble.django.apps.buildsvc.models.ensure_dir', lambda s: s)
     def test_ensure_directory_structure(self):
-        with mock.patch('aasemble.django.apps.buildsvc.models.recursive_render') as recursive_render:
+        basedir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, basedir)
+        with override_settings(BUILDSVC_REPOS_BASE_DIR=basedir), \
+                mock.patch('aasemble.django.apps.buildsvc.models.recursive_render') as recursive_render:
             repo = Repository.objects.get(id=12)
-            repo.ensure_directory_structure()
+            self.assertTrue(repo.ensure_directory_structure())
 
             srcdir = os.path.join(os.path.dirname(__file__), 'templates', 'buildsvc', 'reprepro')
-            dstdir = '/some/public/dir/eric/eric5'
+            dstdir = os.path.join(basedir, 'eric', 'eric5')
             context = {'repository': repo}
             recursive_render.assert_called_with(srcdir, dstdir, context)
 
+    def test_ensure_directory_structure_skips_unchanged_repository(self):
+        basedir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, basedir)
+        with override_settings(BUILDSVC_REPOS_BASE_DIR=basedir):
+            repo = Repository.objects.get(id=12)
+            self.assertTrue(repo.ensure_directory_structure())
+
+            with mock.patch('aasemble.django.apps.buildsvc.models.recursive_render') as recursive_render:
+                self.assertFalse(repo.ensure_directory_structure())
+                self.assertFalse(recursive_render.called)
+
+                Series.objects.create(name='other', repository=repo)
+                self.assertTrue(repo.ensure_directory_structure())
+                self.assertTrue(recursive_render.called)
+
+    def test_ensure_directory_structure_rerenders_missing_conf(self):
+        basedir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, basedir)
+        with override_settings(BUILDSVC_REPOS_BASE_DIR=basedir):
+            repo = Repository.objects.get(id=12)
+            repo.ensure_directory_structure()
+            shutil.rmtree(repo.confdir())
+
+            self.assertTrue(repo.ensure_directory_structure())
+            self.assertTrue(os.path.exists(os.path.join(repo.confdir(), 'distributions')))
+
     def test_export(self):
         repo = Repository.objects.get(id=2)
         with mock.patch.multiple(repo,
@@ -183,26 +413,305 @@ class RepositoryTestCase(TestCase):
             mocks['export_key'].ensure_called_with()
             mocks['_reprepro'].ensure_called_with('export')
 
+    def test_process_changes(self):
+        repo = Repository.objects.get(id=2)
+        with mock.patch.object(repo, 'queue_include') as queue_include:
+            repo.process_changes('myseries', '/path/to/changes')
+
+        queue_include.assert_called_once_with('myseries', ['/path/to/changes'])
+
+    def _queue(self, repo, *operations):
+        for action, argument in operations:
+            PublishOperation.objects.create(repository=repo, action=action,
+                                            series_name='myseries', argument=argument,
+                                            created=timezone.now() - datetime.timedelta(seconds=30))
+
     @mock.patch('aasemble.django.apps.buildsvc.models.remove_ddebs_from_changes')
-    def test_process_changes(self, remove_ddebs_from_changes):
+    @mock.patch('aasemble.django.apps.buildsvc.tasks.publish')
+    def test_queue_include_spools_changes(self, publish, remove_ddebs_from_changes):
         repo = Repository.objects.get(id=2)
-        with mock.patch.multiple(repo,
-                                 export=mock.DEFAULT,
-                                 ensure_directory_structure=mock.DEFAULT,
-                                 _reprepro=mock.DEFAULT) as mocks:
+        basedir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, basedir)
+        builddir = os.path.join(basedir, 'build')
+        os.mkdir(builddir)
+        with open(os.path.join(builddir, 'foo_1.0_amd64.changes'), 'w') as fp:
+            fp.write('Source: foo\nFiles:\n 0123 10 main optional foo_1.0_amd64.deb\n')
+        with open(os.path.join(builddir, 'foo_1.0_amd64.deb'), 'w') as fp:
+            fp.write('deb')
+
+        with override_settings(BUILDSVC_REPOS_BASE_DIR=basedir, BUILDSVC_PUBLISH_DEBOUNCE=7):
+            repo.queue_include('myseries', [os.path.join(builddir, 'foo_1.0_amd64.changes')])
+            spooldir = os.path.join(repo.basedir, 'spool')
+
+        op = PublishOperation.objects.get(repository=repo)
+        self.assertEquals(op.action, PublishOperation.INCLUDE)
+        self.assertTrue(op.argument.startswith(spooldir))
+        self.assertTrue(os.path.exists(os.path.join(os.path.dirname(op.argument), 'foo_1.0_amd64.deb')))
+        publish.apply_async.assert_called_with((2,), countdown=7)
+
+    def test_run_publish_queue_in_order_with_one_export(self):
+        repo = Repository.objects.get(id=2)
+        basedir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, basedir)
+        self._queue(repo,
+                    (PublishOperation.INCLUDE, '/spool/a/a.changes'),
+                    (PublishOperation.REMOVE, 'foo'),
+                    (PublishOperation.INCLUDE, '/spool/b/b.changes'))
+
+        with override_settings(BUILDSVC_REPOS_BASE_DIR=basedir), \
+                mock.patch.multiple(repo,
+                                    export=mock.DEFAULT,
+                                    ensure_directory_structure=mock.DEFAULT,
+                                    _reprepro=mock.DEFAULT) as mocks:
+            self.assertTrue(repo.run_publish_queue())
+
+            self.assertEquals(mocks['_reprepro'].call_args_list,
+                              [mock.call('--export=never', '--ignore=wrongdistribution', 'include', 'myseries', '/spool/a/a.changes'),
+                               mock.call('--export=never', 'removesrc', 'myseries', 'foo'),
+                               mock.call('--export=never', '--ignore=wrongdistribution', 'include', 'myseries', '/spool/b/b.changes')])
+            mocks['export'].assert_called_once_with()
+
+        self.assertFalse(PublishOperation.objects.filter(repository=repo).exists())
+        repo = Repository.objects.get(id=2)
+        self.assertEquals(repo.export_generation, repo.include_generation)
 
-            # Ensure that ensure_directory_structure() is called and ddebs are removed before _reprepro
-            mocks['_reprepro'].side_effect = lambda *args: self.assertTrue(mocks['ensure_directory_structure'].called and remove_ddebs_from_changes.called)
+    @mock.patch('aasemble.django.apps.buildsvc.tasks.publish')
+    def test_run_publish_queue_debounces(self, publish):
+        repo = Repository.objects.get(id=2)
+        basedir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, basedir)
+        PublishOperation.objects.create(repository=repo, action=PublishOperation.REMOVE,
+                                        series_name='myseries', argument='foo')
+
+        with override_settings(BUILDSVC_REPOS_BASE_DIR=basedir, BUILDSVC_PUBLISH_DEBOUNCE=10), \
+                mock.patch.multiple(repo, export=mock.DEFAULT, _reprepro=mock.DEFAULT) as mocks:
+            self.assertFalse(repo.run_publish_queue())
+
+            self.assertFalse(mocks['_reprepro'].called)
+            self.assertFalse(mocks['export'].called)
+            self.assertTrue(publish.apply_async.called)
+        self.assertEquals(PublishOperation.objects.filter(repository=repo).count(), 1)
+
+    @mock.patch('aasemble.django.apps.buildsvc.tasks.publish')
+    def test_run_publish_queue_does_not_wait_forever(self, publish):
+        repo = Repository.objects.get(id=2)
+        basedir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, basedir)
+        self._queue(repo, (PublishOperation.REMOVE, 'foo'))
+        PublishOperation.objects.create(repository=repo, action=PublishOperation.REMOVE,
+                                        series_name='myseries', argument='bar')
+
+        with override_settings(BUILDSVC_REPOS_BASE_DIR=basedir, BUILDSVC_PUBLISH_DEBOUNCE=10, BUILDSVC_PUBLISH_MAX_DELAY=20), \
+                mock.patch.multiple(repo,
+                                    export=mock.DEFAULT,
+                                    ensure_directory_structure=mock.DEFAULT,
+                                    _reprepro=mock.DEFAULT) as mocks:
+            self.assertTrue(repo.run_publish_queue())
+            self.assertEquals(mocks['_reprepro'].call_count, 2)
+            mocks['export'].assert_called_once_with()
+
+    def _run_failing_queue(self, repo, basedir):
+        def reprepro(*args):
+            if args[-1] == 'foo':
+                raise CommandFailed('removesrc failed', ['reprepro', 'removesrc'], 255, '', '')
+
+        with override_settings(BUILDSVC_REPOS_BASE_DIR=basedir), \
+                mock.patch.multiple(repo,
+                                    export=mock.DEFAULT,
+                                    ensure_directory_structure=mock.DEFAULT,
+                                    _reprepro=mock.DEFAULT) as mocks:
+            mocks['_reprepro'].side_effect = reprepro
+            exported = repo.run_publish_queue()
+        PublishOperation.objects.filter(repository=repo).update(retry_at=timezone.now() - datetime.timedelta(seconds=1))
+        return exported, mocks
+
+    @override_settings(BUILDSVC_PUBLISH_RETRY_DELAY=10, BUILDSVC_PUBLISH_MAX_ATTEMPTS=3)
+    @mock.patch('aasemble.django.apps.buildsvc.tasks.publish')
+    def test_run_publish_queue_retries_failed_operations(self, publish):
+        repo = Repository.objects.get(id=2)
+        basedir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, basedir)
+        self._queue(repo,
+                    (PublishOperation.REMOVE, 'foo'),
+                    (PublishOperation.REMOVE, 'bar'))
+
+        # The operations after the failed one wait for it
+        exported, mocks = self._run_failing_queue(repo, basedir)
+        self.assertEquals(exported, [])
+        self.assertEquals(mocks['_reprepro'].call_count, 1)
+        self.assertFalse(mocks['export'].called)
+        publish.apply_async.assert_called_with((repo.id,), countdown=10)
+
+        exported, mocks = self._run_failing_queue(repo, basedir)
+        self.assertEquals(exported, [])
+        publish.apply_async.assert_called_with((repo.id,), countdown=20)
+        self.assertEquals(PublishOperation.objects.get(argument='foo').attempts, 2)
+
+        # Out of attempts, so it is given up on and the rest goes ahead
+        exported, mocks = self._run_failing_queue(repo, basedir)
+        self.assertEquals(exported, [repo])
+        self.assertEquals(mocks['_reprepro'].call_count, 2)
+        mocks['export'].assert_called_once_with()
+
+        failed = PublishOperation.objects.get(repository=repo)
+        self.assertEquals(failed.argument, 'foo')
+        self.assertEquals(failed.error, 'removesrc failed')
+
+    @override_settings(BUILDSVC_PUBLISH_RETRY_DELAY=10)
+    @mock.patch('aasemble.django.apps.buildsvc.tasks.publish')
+    def test_run_publish_queue_retries_unsigned_exports(self, publish):
+        repo = Repository.objects.get(id=2)
+        basedir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, basedir)
+        self._queue(repo, (PublishOperation.REMOVE, 'foo'))
+
+        def fail_to_sign():
+            request = SignRequest('DEADBEEF', os.path.join(repo.outdir(), 'dists', 'myseries', 'Release.new'))
+            request.error = 'Failed to sign Release.new'
+            raise SigningFailed([request])
+
+        with override_settings(BUILDSVC_REPOS_BASE_DIR=basedir), \
+                mock.patch.multiple(repo, export=mock.DEFAULT, ensure_directory_structure=mock.DEFAULT, _reprepro=mock.DEFAULT), \
+                mock.patch('aasemble.django.apps.buildsvc.signing.Signer.flush', side_effect=fail_to_sign):
+            self.assertEquals(repo.run_publish_queue(), [])
+
+        operation = PublishOperation.objects.get(repository=repo)
+        self.assertEquals(operation.attempts, 1)
+        self.assertEquals(operation.error, '')
+        publish.apply_async.assert_called_with((repo.id,), countdown=10)
+
+    @mock.patch('aasemble.django.apps.buildsvc.tasks.publish')
+    def test_run_publish_queue_waits_for_retry(self, publish):
+        repo = Repository.objects.get(id=2)
+        basedir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, basedir)
+        self._queue(repo, (PublishOperation.REMOVE, 'foo'))
+        PublishOperation.objects.filter(repository=repo).update(attempts=1, retry_at=timezone.now() + datetime.timedelta(seconds=60))
 
-            # Ensure that _reprepro() is called before export
-            mocks['export'].side_effect = lambda: self.assertTrue(mocks['_reprepro'].called)
+        with override_settings(BUILDSVC_REPOS_BASE_DIR=basedir), \
+                mock.patch.object(repo, '_reprepro') as _reprepro:
+            self.assertEquals(repo.run_publish_queue(), [])
 
-            repo.process_changes('myseries', '/path/to/changes')
+        self.assertFalse(_reprepro.called)
+        self.assertTrue(publish.apply_async.called)
 
-            remove_ddebs_from_changes.assert_called_with('/path/to/changes')
-            mocks['export'].assert_called_with()
-            mocks['ensure_directory_structure'].ensure_called_with()
-            mocks['_reprepro'].ensure_called_with('--ignore=wrongdistribution', 'include', 'myseries', '/path/to/changes')
+    @override_settings(BUILDSVC_PUBLISH_MAX_ATTEMPTS=1)
+    def test_failed_include_is_reported_and_cleaned_up(self):
+        repo = Repository.objects.get(id=2)
+        basedir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, basedir)
+        spooldir = os.path.join(basedir, 'spooled')
+        os.mkdir(spooldir)
+        br = BuildRecord.objects.create(source_id=2, build_counter=3, sha='abcdef')
+        PublishOperation.objects.create(repository=repo, action=PublishOperation.INCLUDE, build_record=br,
+                                        series_name='myseries', argument=os.path.join(spooldir, 'a.changes'),
+                                        created=timezone.now() - datetime.timedelta(seconds=30))
+
+        with override_settings(BUILDSVC_REPOS_BASE_DIR=basedir), \
+                mock.patch.multiple(repo,
+                                    export=mock.DEFAULT,
+                                    ensure_directory_structure=mock.DEFAULT,
+                                    _reprepro=mock.DEFAULT) as mocks:
+            mocks['_reprepro'].side_effect = CommandFailed('include failed', ['reprepro', 'include'], 255, '', '')
+            self.assertEquals(repo.run_publish_queue(), [])
+
+        self.assertFalse(os.path.exists(spooldir))
+        self.assertEquals(BuildRecord.objects.get(id=br.id).publish_error, 'include failed')
+        self.assertEquals(PublishOperation.objects.get(build_record=br).error, 'include failed')
+
+    def test_run_publish_queue_includes_other_due_repositories(self):
+        repo = Repository.objects.get(id=2)
+        other = Repository.objects.get(id=12)
+        basedir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, basedir)
+        self._queue(repo, (PublishOperation.REMOVE, 'foo'))
+        self._queue(other, (PublishOperation.REMOVE, 'bar'))
+
+        with override_settings(BUILDSVC_REPOS_BASE_DIR=basedir), \
+                mock.patch.multiple(repo, export=mock.DEFAULT, ensure_directory_structure=mock.DEFAULT, _reprepro=mock.DEFAULT), \
+                mock.patch.multiple(other, export=mock.DEFAULT, ensure_directory_structure=mock.DEFAULT, _reprepro=mock.DEFAULT) as other_mocks, \
+                mock.patch('aasemble.django.apps.buildsvc.signing.Signer.flush') as flush:
+            def check_locked():
+                for r in (repo, other):
+                    with r.publish_lock(blocking=False) as locked:
+                        self.assertFalse(locked)
+            flush.side_effect = check_locked
+
+            self.assertEquals(repo.run_publish_queue(others=[other]), [repo, other])
+
+            other_mocks['_reprepro'].assert_called_once_with('--export=never', 'removesrc', 'myseries', 'bar')
+            # Everything was signed in one go, with both locks still held
+            flush.assert_called_once_with()
+
+            with repo.publish_lock(blocking=False) as locked:
+                self.assertTrue(locked)
+            with other.publish_lock(blocking=False) as locked:
+                self.assertTrue(locked)
+
+    @mock.patch('aasemble.django.apps.buildsvc.tasks.publish')
+    def test_run_publish_queue_reschedules_others_that_are_not_due(self, publish):
+        repo = Repository.objects.get(id=2)
+        other = Repository.objects.get(id=12)
+        basedir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, basedir)
+        PublishOperation.objects.create(repository=other, action=PublishOperation.REMOVE,
+                                        series_name='myseries', argument='bar')
+
+        # other's own publish task is turned away while its lock is held
+        with override_settings(BUILDSVC_REPOS_BASE_DIR=basedir, BUILDSVC_PUBLISH_DEBOUNCE=10):
+            self.assertEquals(repo.run_publish_queue(others=[other]), [])
+        self.assertEquals(publish.apply_async.call_args[0][0], (other.id,))
+
+    @mock.patch('aasemble.django.apps.buildsvc.tasks.publish')
+    def test_run_publish_queue_retries_when_busy(self, publish):
+        repo = Repository.objects.get(id=2)
+        basedir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, basedir)
+        self._queue(repo, (PublishOperation.REMOVE, 'foo'))
+
+        with override_settings(BUILDSVC_REPOS_BASE_DIR=basedir, BUILDSVC_PUBLISH_DEBOUNCE=7), \
+                mock.patch.object(repo, '_reprepro') as _reprepro:
+            with repo.publish_lock():
+                self.assertEquals(repo.run_publish_queue(), [])
+
+        self.assertFalse(_reprepro.called)
+        publish.apply_async.assert_called_once_with((repo.id,), countdown=7)
+
+    @override_settings(BUILDSVC_PUBLISH_RETRY_DELAY=10)
+    @mock.patch('aasemble.django.apps.buildsvc.tasks.publish')
+    def test_run_publish_queue_retries_failed_exports(self, publish):
+        repo = Repository.objects.get(id=2)
+        basedir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, basedir)
+        self._queue(repo, (PublishOperation.REMOVE, 'foo'))
+
+        with override_settings(BUILDSVC_REPOS_BASE_DIR=basedir), \
+                mock.patch.multiple(repo, export=mock.DEFAULT, ensure_directory_structure=mock.DEFAULT, _reprepro=mock.DEFAULT) as mocks:
+            mocks['export'].side_effect = IOError('disk full')
+            self.assertEquals(repo.run_publish_queue(), [])
+
+        operation = PublishOperation.objects.get(repository=repo)
+        self.assertEquals(operation.attempts, 1)
+        self.assertEquals(operation.error, '')
+        publish.apply_async.assert_called_with((repo.id,), countdown=10)
+
+    def test_run_publish_queue_records_phases(self):
+        repo = Repository.objects.get(id=2)
+        basedir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, basedir)
+        br = BuildRecord.objects.create(source_id=2, build_counter=3, sha='abcdef')
+        PublishOperation.objects.create(repository=repo, action=PublishOperation.INCLUDE, build_record=br,
+                                        series_name='myseries', argument='/spool/a/a.changes',
+                                        created=timezone.now() - datetime.timedelta(seconds=30))
+
+        with override_settings(BUILDSVC_REPOS_BASE_DIR=basedir), \
+                mock.patch.multiple(repo,
+                                    export=mock.DEFAULT,
+                                    ensure_directory_structure=mock.DEFAULT,
+                                    _reprepro=mock.DEFAULT):
+            repo.run_publish_queue()
+
+        self.assertEquals([phase.name for phase in br.phases.all()], ['include', 'export'])
 
     @override_settings(BUILDSVC_REPOS_BASE_URL='http://example.com/some/dir')
     def test_baseurl(self):
@@ -211,14 +720,17 @@ class RepositoryTestCase(TestCase):
 
 
 class PackageSourceTestCase(TestCase):
-    @mock.patch('aasemble.django.apps.buildsvc.tasks.reprepro')
-    def test_post_delete(self, reprepro):
+    @mock.patch('aasemble.django.apps.buildsvc.tasks.publish')
+    def test_post_delete(self, publish):
         ps = PackageSource.objects.create(series_id=1,
                                           git_url='https://example.com/git',
                                           branch='master',
                                           last_built_name='something')
         ps.delete()
-        reprepro.delay.assert_called_with(1, 'removesrc', 'aasemble', 'something')
+        op = PublishOperation.objects.get(repository_id=1)
+        self.assertEquals((op.action, op.series_name, op.argument),
+                          (PublishOperation.REMOVE, 'aasemble', 'something'))
+        self.assertEquals(publish.apply_async.call_args[0][0], (1,))
 
     def test_github_owner_repo(self):
         ps = PackageSource.objects.create(series_id=1,
@@ -248,6 +760,128 @@ class PackageSourceTestCase(TestCase):
                                           last_built_name='something')
         self.assertRaises(NotAValidGithubRepository, ps.github_owner_repo)
 
+    @mock.patch('aasemble.django.apps.buildsvc.tasks.dispatch_builds')
+    def test_build_is_coalesced(self, dispatch_builds):
+        ps = PackageSource.objects.get(id=1)
+
+        self.assertTrue(ps.build())
+        self.assertFalse(ps.build())
+
+        dispatch_builds.delay.assert_called_once_with()
+        self.assertEquals(PendingBuild.objects.filter(source=ps, state=PendingBuild.QUEUED).count(), 1)
+        self.assertTrue(ps.build_superseded())
+
+    @mock.patch('aasemble.django.apps.buildsvc.tasks.dispatch_builds')
+    def test_lost_build_does_not_block_new_builds(self, dispatch_builds):
+        ps = PackageSource.objects.get(id=1)
+        ps.build()
+
+        # Dispatched, but the worker died before the build started
+        PendingBuild.objects.filter(source=ps).update(state=PendingBuild.RUNNING,
+                                                      started_at=timezone.now() - datetime.timedelta(days=1))
+        remove_stale(timezone.now())
+
+        self.assertTrue(ps.build())
+
+    @mock.patch('aasemble.django.apps.buildsvc.tasks.dispatch_builds')
+    def test_older_build_stays_superseded_when_newer_one_starts(self, dispatch_builds):
+        older = PackageSource.objects.get(id=1)
+        newer = PackageSource.objects.get(id=1)
+
+        older.build()
+        older.refresh_from_db(fields=['build_generation'])
+        newer.build()
+        newer.refresh_from_db(fields=['build_generation'])
+
+        self.assertTrue(older.build_superseded())
+        self.assertFalse(newer.build_superseded())
+
+    def test_next_build_counter(self):
+        ps = PackageSource.objects.get(id=1)
+        stale = PackageSource.objects.get(id=1)
+
+        first = ps.next_build_counter()
+        second = stale.next_build_counter()
+
+        self.assertEquals(second, first + 1)
+
+    @mock.patch('aasemble.django.apps.buildsvc.tasks.dispatch_builds')
+    def test_build_real_cancels_superseded_build(self, dispatch_builds):
+        from . import pkgbuild
+
+        ps = PackageSource.objects.get(id=1)
+        ps.build()
+
+        tmpdir = tempfile.mkdtemp()
+        basedir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, basedir)
+        builder = mock.MagicMock()
+        builder.check_superseded.side_effect = pkgbuild.BuildSuperseded()
+
+        with override_settings(BUILDSVC_REPOS_BASE_DIR=os.path.join(basedir, 'repos'),
+                               BUILDSVC_REPOS_BASE_PUBLIC_DIR=os.path.join(basedir, 'public')), \
+                mock.patch.object(ps, 'checkout') as checkout, \
+                mock.patch.object(ps, 'tree_sha', return_value='treesha'), \
+                mock.patch.object(ps.series, 'queue_include') as queue_include, \
+                mock.patch('aasemble.django.apps.buildsvc.scratch.allocate', return_value=ScratchDir(tmpdir)), \
+                mock.patch('aasemble.django.apps.buildsvc.pkgbuild.choose_builder') as choose_builder:
+            checkout.return_value = (tmpdir, os.path.join(tmpdir, 'build'), 'abcdef')
+            choose_builder.return_value.return_value = builder
+            ps.build_real()
+
+        self.assertFalse(queue_include.called)
+        self.assertFalse(os.path.exists(tmpdir))
+        self.assertFalse(ps.build_superseded())
+
+    @mock.patch('aasemble.django.apps.buildsvc.tasks.dispatch_builds')
+    def test_build_real_refuses_without_scratch_space(self, dispatch_builds):
+        ps = PackageSource.objects.get(id=1)
+        ps.build()
+        counter = PackageSource.objects.get(id=1).build_counter
+
+        with mock.patch('aasemble.django.apps.buildsvc.scratch.allocate', side_effect=InsufficientScratchSpace()):
+            self.assertRaises(InsufficientScratchSpace, ps.build_real)
+
+        self.assertTrue(ps.build_superseded())
+        self.assertEquals(PackageSource.objects.get(id=1).build_counter, counter)
+
+    def test_clone_args_full(self):
+        ps = PackageSource(git_url='https://example.com/git', branch='master')
+        self.assertEquals(ps.clone_args(), [])
+
+    def test_clone_args_shallow(self):
+        ps = PackageSource(git_url='https://example.com/git', branch='master',
+                           checkout_mode=PackageSource.CHECKOUT_SHALLOW, checkout_depth=3)
+        self.assertEquals(ps.clone_args(), ['--depth', '3', '--single-branch'])
+
+    def test_clone_args_blobless(self):
+        ps = PackageSource(git_url='https://example.com/git', branch='master',
+                           checkout_mode=PackageSource.CHECKOUT_BLOBLESS)
+        self.assertEquals(ps.clone_args(), ['--filter=blob:none'])
+
+    @mock.patch('aasemble.django.apps.buildsvc.models.run_cmd')
+    def test_ensure_revision_noop_for_full_clone(self, run_cmd):
+        ps = PackageSource(git_url='https://example.com/git', branch='master')
+        ps.ensure_revision('/some/dir', 'abcdef')
+        self.assertFalse(run_cmd.called)
+
+    @override_settings(BUILDSVC_SHALLOW_DEEPEN_DEPTH=50)
+    @mock.patch('aasemble.django.apps.buildsvc.models.run_cmd')
+    def test_ensure_revision_falls_back_to_unshallow(self, run_cmd):
+        from aasemble.django.exceptions import CommandFailed
+
+        def fake_run_cmd(cmd, **kwargs):
+            if cmd[1] == 'cat-file':
+                raise CommandFailed('missing', cmd, 1, '', '')
+
+        run_cmd.side_effect = fake_run_cmd
+        ps = PackageSource(git_url='https://example.com/git', branch='master',
+                           checkout_mode=PackageSource.CHECKOUT_SHALLOW)
+        ps.ensure_revision('/some/dir', 'abcdef')
+
+        run_cmd.assert_any_call(['git', 'fetch', '--depth', '50', 'origin', 'master'], cwd='/some/dir', logger=mock.ANY)
+        run_cmd.assert_called_with(['git', 'fetch', '--unshallow', 'origin', 'master'], cwd='/some/dir', logger=mock.ANY)
+
     @mock.patch('github3.GitHub')
     @override_settings(GITHUB_WEBHOOK_URL='https://example.com/api/github/')
     def test_register_webhook(self, GitHub):
@@ -340,3 +974,1278 @@ class PackageSourceTestCase(TestCase):
 
         self.assertTrue(ps.register_webhook())
         GitHub.assert_not_called()
+
+
+class BuildPhaseTestCase(TestCase):
+    def test_phase_is_recorded(self):
+        br = BuildRecord.objects.get(id=1)
+
+        with br.phase('checkout'):
+            pass
+
+        with mock.patch('aasemble.django.apps.buildsvc.models.time') as time_:
+            time_.time.side_effect = [100.0, 102.5]
+            with br.phase('source_build'):
+                pass
+
+        self.assertEquals([(p.name, p.duration) for p in br.phases.all()[1:]], [('source_build', 2.5)])
+        self.assertEquals(br.phases.first().name, 'checkout')
+
+    def test_failed_phase_is_recorded(self):
+        br = BuildRecord.objects.get(id=1)
+
+        def fail():
+            with br.phase('binary_build'):
+                raise Exception('boom')
+
+        self.assertRaises(Exception, fail)
+        self.assertTrue(br.phases.filter(name='binary_build').exists())
+
+    def test_statistics(self):
+        br = BuildRecord.objects.get(id=1)
+        for duration in range(1, 101):
+            br.phases.create(name='export', started=timezone.now(), duration=float(duration))
+
+        stats = BuildPhase.statistics(BuildPhase.objects.all())
+
+        self.assertEquals(stats, {'export': {'count': 100, 'mean': 50.5, 'p50': 50.0, 'p90': 90.0, 'p99': 99.0}})
+
+
+class BuildLogTestCase(TestCase):
+    def setUp(self):
+        super(BuildLogTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        settings = override_settings(BUILDSVC_REPOS_BASE_PUBLIC_DIR=self.tmpdir)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        self.br = BuildRecord(source_id=1, build_counter=12)
+        self.addCleanup(lambda: self.br.close_log())
+
+    def read(self, path):
+        with open(path, 'r') as fp:
+            return fp.read()
+
+    def test_log_is_written(self):
+        self.br.logger.info('Hello')
+        self.br.close_log()
+
+        self.assertTrue(self.read(self.br.buildlog()).endswith(': Hello\n'))
+
+    def test_log_moves_when_version_is_known(self):
+        self.br.logger.info('Before')
+        tmppath = self.br.buildlog()
+        self.br.version = '1.2+12'
+        self.br.logger.info('After')
+        self.br.close_log()
+
+        self.assertFalse(os.path.exists(tmppath))
+        self.assertTrue(self.br.buildlog().endswith('_1.2+12.log'))
+        self.assertEquals([line.split(': ', 1)[1] for line in self.read(self.br.buildlog()).splitlines()], ['Before', 'After'])
+
+    @override_settings(BUILDSVC_BUILD_LOG_FLUSH_INTERVAL=3600)
+    def test_log_is_buffered(self):
+        self.br.logger.info('Buffered')
+        self.assertEquals(self.read(self.br.buildlog()), '')
+
+        self.br.logger.error('Urgent')
+        self.assertIn('Urgent', self.read(self.br.buildlog()))
+
+    @override_settings(BUILDSVC_BUILD_LOG_FLUSH_INTERVAL=3600)
+    def test_output_is_interleaved_with_records(self):
+        from .output import capture_stdout
+
+        self.br.logger.info('first')
+        with capture_stdout(self.br.log_sink):
+            print('docker output')
+        self.br.logger.info('after')
+        self.br.close_log()
+
+        lines = self.read(self.br.buildlog()).splitlines()
+        self.assertEquals([lines[0].split(': ', 1)[1], lines[1], lines[2].split(': ', 1)[1]],
+                          ['first', 'docker output', 'after'])
+
+    @override_settings(BUILDSVC_BUILD_LOG_FLUSH_INTERVAL=0.5)
+    def test_log_is_flushed_when_quiet(self):
+        self.br.logger.info('First')
+        self.br.logger.info('Quiet')
+        self.assertNotIn('Quiet', self.read(self.br.buildlog()))
+
+        deadline = time.time() + 5
+        while 'Quiet' not in self.read(self.br.buildlog()) and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertIn('Quiet', self.read(self.br.buildlog()))
+
+    def test_logger_is_not_kept_by_logging(self):
+        logger = weakref.ref(self.br.logger)
+        self.br.close_log()
+
+        self.assertNotIn(logger().name, logging.Logger.manager.loggerDict)
+        self.br = BuildRecord(source_id=1, build_counter=13)
+        gc.collect()
+        self.assertIsNone(logger())
+
+    def test_tail_reads_in_chunks_until_complete(self):
+        self.br.save()
+        self.br.logger.info('Hello')
+        self.br.close_log()
+        BuildRecord.objects.filter(id=self.br.id).update(log_complete=True)
+        size = os.path.getsize(self.br.buildlog())
+
+        chunks = list(tail(self.br, limit=size - 1))
+
+        self.assertEquals([(next_offset, complete) for data, next_offset, complete in chunks],
+                          [(size - 1, False), (size, True)])
+        self.assertEquals(b''.join(data for data, next_offset, complete in chunks), self.read(self.br.buildlog()).encode('utf-8'))
+
+    def test_tail_gives_up_after_timeout(self):
+        self.br.save()
+
+        with mock.patch('aasemble.django.apps.buildsvc.buildlog.time') as time_:
+            time_.time.side_effect = [0, 0, 5, 11]
+            self.assertEquals(list(tail(self.br, offset=0, timeout=10)), [(b'', 0, False)])
+        self.assertEquals(time_.sleep.call_count, 2)
+
+    def test_tail_does_not_split_characters(self):
+        self.br.save()
+        with open(self.br.buildlog(), 'wb') as fp:
+            fp.write(b'caf\xc3')
+
+        self.assertEquals(next(tail(self.br)), (b'caf', 3, False))
+
+    def test_records_propagate(self):
+        handler = mock.Mock(level=logging.DEBUG)
+        parent = logging.getLogger('buildsvc.pkgbuild')
+        parent.addHandler(handler)
+        self.addCleanup(parent.removeHandler, handler)
+
+        self.br.logger.info('Hello')
+
+        self.assertEquals(handler.handle.call_args[0][0].getMessage(), 'Hello')
+
+
+class RetentionTestCase(TestCase):
+    def setUp(self):
+        super(RetentionTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        settings = override_settings(BUILDSVC_REPOS_BASE_PUBLIC_DIR=self.tmpdir)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        self.repo = BuildRecord.objects.get(id=1).source.series.repository
+        self.logs = {}
+        for br in BuildRecord.objects.filter(source_id=1):
+            self.logs[br.id] = br.buildlog()
+            with open(self.logs[br.id], 'w') as fp:
+                fp.write('x' * 100)
+
+    def remaining(self):
+        return set(BuildRecord.objects.filter(source_id=1).values_list('id', flat=True))
+
+    def test_retain_builds(self):
+        self.repo.retain_builds = 3
+
+        self.assertEquals(sweep_repository(self.repo), 700)
+
+        self.assertEquals(self.remaining(), set([10, 9, 4]))
+        self.assertFalse(os.path.exists(self.logs[1]))
+        self.assertTrue(os.path.exists(self.logs[4]))
+        repo = Repository.objects.get(id=self.repo.id)
+        self.assertEquals(repo.reclaimed_bytes, 700)
+        self.assertIsNotNone(repo.last_retention_sweep)
+
+    def test_retain_days_keeps_latest_build(self):
+        self.repo.retain_days = 30
+
+        sweep_repository(self.repo, now=datetime.datetime(2016, 1, 1, tzinfo=timezone.utc))
+
+        self.assertEquals(self.remaining(), set([10]))
+
+    def test_retain_days_keeps_running_builds(self):
+        self.repo.retain_days = 1
+        now = datetime.datetime(2016, 1, 1, tzinfo=timezone.utc)
+        BuildRecord.objects.filter(id=2).update(build_started=now - datetime.timedelta(days=2))
+
+        with override_settings(BUILDSVC_BUILD_TIMEOUT=3 * 86400):
+            sweep_repository(self.repo, now=now)
+
+        self.assertEquals(self.remaining(), set([2, 10]))
+
+    def test_retain_log_bytes(self):
+        self.repo.retain_log_bytes = 250
+
+        self.assertEquals(sweep_repository(self.repo), 800)
+
+        self.assertEquals(self.remaining(), set([10, 9]))
+
+    def assertLogsIntact(self):
+        self.assertEquals(len(self.remaining()), 10)
+        for path in self.logs.values():
+            self.assertTrue(os.path.exists(path))
+            self.assertFalse(os.path.exists(path + '.expired'))
+        self.assertEquals(Repository.objects.get(id=self.repo.id).reclaimed_bytes, 0)
+
+    @override_settings(BUILDSVC_RETENTION_BATCH_SIZE=4)
+    def test_logs_stay_if_rows_cannot_be_deleted(self):
+        self.repo.retain_builds = 1
+
+        with mock.patch('django.db.models.query.QuerySet.delete', side_effect=IntegrityError('boom')):
+            self.assertRaises(IntegrityError, sweep_repository, self.repo)
+
+        self.assertLogsIntact()
+
+    @override_settings(BUILDSVC_RETENTION_BATCH_SIZE=4)
+    def test_rows_stay_if_a_log_cannot_be_moved(self):
+        self.repo.retain_builds = 1
+        real_rename = os.rename
+
+        def rename(src, dst):
+            if src == self.logs[3]:
+                raise OSError(errno.EACCES, 'Permission denied')
+            real_rename(src, dst)
+
+        with mock.patch('aasemble.django.apps.buildsvc.retention.os.rename', side_effect=rename):
+            self.assertRaises(OSError, sweep_repository, self.repo)
+
+        self.assertLogsIntact()
+
+    def test_only_removed_logs_are_counted(self):
+        self.repo.retain_builds = 1
+        real_unlink = os.unlink
+
+        def unlink(path):
+            if path == self.logs[1] + '.expired':
+                raise OSError(errno.EACCES, 'Permission denied')
+            real_unlink(path)
+
+        with mock.patch('aasemble.django.apps.buildsvc.retention.os.unlink', side_effect=unlink):
+            self.assertEquals(sweep_repository(self.repo), 800)
+
+        self.assertEquals(self.remaining(), set([10]))
+        self.assertEquals(Repository.objects.get(id=self.repo.id).reclaimed_bytes, 800)
+
+    @override_settings(BUILDSVC_RETENTION_BATCH_SIZE=4)
+    def test_batches(self):
+        self.repo.retain_builds = 1
+
+        with mock.patch('aasemble.django.apps.buildsvc.retention.transaction') as transaction:
+            sweep_repository(self.repo)
+
+        self.assertEquals(transaction.atomic.call_count, 3)
+        self.assertEquals(self.remaining(), set([10]))
+
+    def test_sweep_skips_repositories_without_policy(self):
+        Repository.objects.filter(id=self.repo.id).update(retain_builds=5)
+
+        with mock.patch('aasemble.django.apps.buildsvc.retention.sweep_repository', return_value=100) as sweep_repository:
+            self.assertEquals(sweep_retention(), 100)
+
+        self.assertEquals([args[0].id for args, kwargs in sweep_repository.call_args_list], [self.repo.id])
+
+
+class ScratchTestCase(TestCase):
+    def setUp(self):
+        super(ScratchTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.disk = os.path.join(self.tmpdir, 'disk')
+        self.tmpfs = os.path.join(self.tmpdir, 'tmpfs')
+        os.makedirs(self.tmpfs)
+        self.settings_override = override_settings(BUILDSVC_SCRATCH_DIR=self.disk,
+                                                   BUILDSVC_SCRATCH_TMPFS_DIR=self.tmpfs,
+                                                   BUILDSVC_SCRATCH_TMPFS_MAX_SIZE=1000,
+                                                   BUILDSVC_SCRATCH_MIN_FREE=0)
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+        self.ps = PackageSource.objects.get(id=1)
+
+    def test_allocate_on_disk_when_size_unknown(self):
+        from . import scratch
+
+        scratch_dir = scratch.allocate(self.ps)
+
+        self.assertTrue(scratch_dir.path.startswith(scratch.host_dir(self.disk)))
+        self.assertTrue(os.path.isdir(scratch_dir.path))
+
+    def test_allocate_on_tmpfs_for_small_sources(self):
+        from . import scratch
+
+        scratch_dir = scratch.allocate(self.ps)
+        with open(os.path.join(scratch_dir.path, 'file'), 'w') as fp:
+            fp.write('x' * 100)
+        scratch.record_usage(self.ps, scratch_dir)
+        scratch_dir.remove()
+
+        self.assertTrue(scratch.allocate(self.ps).path.startswith(scratch.host_dir(self.tmpfs)))
+
+        with mock.patch('aasemble.django.apps.buildsvc.scratch.expected_size', return_value=5000):
+            self.assertTrue(scratch.allocate(self.ps).path.startswith(scratch.host_dir(self.disk)))
+
+    def test_admission_control(self):
+        from . import scratch
+
+        with override_settings(BUILDSVC_SCRATCH_MIN_FREE=10 * 1024 * 1024):
+            with mock.patch('aasemble.django.apps.buildsvc.scratch.free_space', return_value=1024 * 1024):
+                self.assertRaises(InsufficientScratchSpace, scratch.allocate, self.ps)
+
+    def test_quota(self):
+        scratch_dir = ScratchDir(tempfile.mkdtemp(dir=self.tmpdir), quota=50)
+        scratch_dir.check()
+
+        with open(os.path.join(scratch_dir.path, 'file'), 'w') as fp:
+            fp.write('x' * 100)
+
+        self.assertRaises(ScratchQuotaExceeded, scratch_dir.check)
+
+    def test_sweep(self):
+        from . import scratch
+
+        live = scratch.allocate(self.ps)
+        dead = scratch.allocate(self.ps)
+        with open(os.path.join(dead.path, scratch.OWNER_FILE), 'w') as fp:
+            fp.write('1234567\n')
+
+        with mock.patch('aasemble.django.apps.buildsvc.scratch.pid_alive', side_effect=lambda pid: pid == os.getpid()):
+            self.assertEquals(scratch.sweep(), [dead.path])
+
+        self.assertTrue(os.path.isdir(live.path))
+        self.assertFalse(os.path.exists(dead.path))
+
+    @mock.patch('aasemble.django.apps.buildsvc.tasks.dispatch_builds')
+    def test_build_task_retries_without_space(self, dispatch_builds):
+        from celery.exceptions import Retry
+        from . import tasks
+
+        pending_build = PendingBuild.objects.create(source=self.ps, repository_id=4, user_id=5, state=PendingBuild.RUNNING)
+
+        with mock.patch.object(PackageSource, 'build_real', side_effect=InsufficientScratchSpace()), \
+                mock.patch.object(tasks.build, 'retry', side_effect=Retry()) as retry:
+            self.assertRaises(Retry, tasks.build, 1, pending_build.id)
+
+        retry.assert_called_once_with(exc=mock.ANY, countdown=60)
+        self.assertTrue(PendingBuild.objects.filter(id=pending_build.id).exists())
+        self.assertFalse(dispatch_builds.delay.called)
+
+
+class SchedulerTestCase(TestCase):
+    def queue(self, source_id, state=PendingBuild.QUEUED, priority=0, age=0):
+        ps = PackageSource.objects.get(id=source_id)
+        repository = ps.series.repository
+        return PendingBuild.objects.create(source=ps,
+                                           repository=repository,
+                                           user=repository.user,
+                                           state=state,
+                                           priority=priority,
+                                           queued_at=timezone.now() - datetime.timedelta(seconds=age),
+                                           started_at=state == PendingBuild.RUNNING and timezone.now() or None)
+
+    def test_small_user_goes_ahead_of_busy_user(self):
+        running = [self.queue(1, state=PendingBuild.RUNNING)]
+        queued = [self.queue(2, age=30), self.queue(3, age=20), self.queue(13, age=10)]
+
+        fq = FairQueue(queued, running, max_total=10, max_per_user=10, max_per_repository=10)
+
+        self.assertEquals([fq.pop().source_id for i in range(3)], [13, 2, 3])
+        self.assertIsNone(fq.pop())
+
+    def test_priority_within_user(self):
+        queued = [self.queue(2, age=30), self.queue(3, priority=5, age=10)]
+
+        fq = FairQueue(queued, [], max_total=10, max_per_user=10, max_per_repository=10)
+
+        self.assertEquals(fq.pop().source_id, 3)
+
+    @override_settings(BUILDSVC_SCHEDULER_USER_WEIGHTS={'eric': 2})
+    def test_weights(self):
+        queued = [self.queue(2, age=40), self.queue(3, age=30), self.queue(4, age=20), self.queue(13, age=10)]
+
+        fq = FairQueue(queued, [], max_total=10, max_per_user=10, max_per_repository=10)
+
+        self.assertEquals([fq.pop().source_id for i in range(4)], [2, 3, 13, 4])
+
+    def test_limits(self):
+        # Sources 1 and 8 share a repository
+        queued = [self.queue(1, age=30), self.queue(8, age=20), self.queue(2, age=10), self.queue(13)]
+
+        fq = FairQueue(queued, [], max_total=2, max_per_user=10, max_per_repository=1)
+        self.assertEquals([fq.pop().source_id for i in range(2)], [1, 13])
+        self.assertIsNone(fq.pop())
+
+        fq = FairQueue(queued, [], max_total=10, max_per_user=2, max_per_repository=1)
+        self.assertEquals([fq.pop().source_id for i in range(3)], [1, 13, 2])
+        self.assertIsNone(fq.pop())
+
+    def test_estimate_start_times(self):
+        now = timezone.now()
+        queued = [self.queue(1, age=20), self.queue(8, age=10)]
+
+        fq = FairQueue(queued, [], max_total=10, max_per_user=10, max_per_repository=1)
+        estimates = fq.estimate_start_times(datetime.timedelta(minutes=10), now)
+
+        self.assertEquals(estimates[queued[0].id], now)
+        self.assertEquals(estimates[queued[1].id], now + datetime.timedelta(minutes=10))
+
+    @override_settings(BUILDSVC_MAX_CONCURRENT_BUILDS=2)
+    @mock.patch('aasemble.django.apps.buildsvc.tasks.build')
+    def test_dispatch(self, build):
+        first, second, third = self.queue(1, age=30), self.queue(2, age=20), self.queue(3, age=10)
+
+        self.assertEquals([pb.id for pb in dispatch()], [first.id, second.id])
+
+        build.delay.assert_has_calls([mock.call(1, first.id), mock.call(2, second.id)])
+        self.assertEquals(PendingBuild.objects.get(id=first.id).state, PendingBuild.RUNNING)
+        self.assertEquals(PendingBuild.objects.get(id=third.id).state, PendingBuild.QUEUED)
+        self.assertEquals(dispatch(), [])
+
+    @override_settings(BUILDSVC_BUILD_TIMEOUT=60)
+    @mock.patch('aasemble.django.apps.buildsvc.tasks.build')
+    def test_dispatch_releases_stale_builds(self, build):
+        stale = self.queue(1, state=PendingBuild.RUNNING)
+        PendingBuild.objects.filter(id=stale.id).update(started_at=timezone.now() - datetime.timedelta(hours=1))
+        queued = self.queue(8)
+
+        with override_settings(BUILDSVC_MAX_BUILDS_PER_REPOSITORY=1):
+            self.assertEquals([pb.id for pb in dispatch()], [queued.id])
+        self.assertFalse(PendingBuild.objects.filter(id=stale.id).exists())
+
+    @mock.patch('aasemble.django.apps.buildsvc.tasks.dispatch_builds')
+    def test_build_task_releases_slot(self, dispatch_builds):
+        from . import tasks
+
+        pending_build = self.queue(1, state=PendingBuild.RUNNING)
+
+        with mock.patch.object(PackageSource, 'build_real', side_effect=Exception('boom')):
+            self.assertRaises(Exception, tasks.build, 1, pending_build.id)
+
+        self.assertFalse(PendingBuild.objects.filter(id=pending_build.id).exists())
+        dispatch_builds.delay.assert_called_once_with()
+
+    def test_queue_status(self):
+        running = self.queue(1, state=PendingBuild.RUNNING)
+        queued = self.queue(2)
+
+        status = queue_status()
+
+        self.assertEquals([pb.id for pb in status], [running.id, queued.id])
+        self.assertEquals(status[0].estimated_start, running.started_at)
+        self.assertIsNotNone(status[1].estimated_start)
+
+
+class KeyPoolTestCase(TestCase):
+    def setUp(self):
+        super(KeyPoolTestCase, self).setUp()
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    def test_claim_takes_oldest_key(self):
+        SigningKey.objects.create(key_id='AAAA0001')
+        SigningKey.objects.create(key_id='AAAA0002')
+        repo = Repository.objects.get(id=13)
+
+        self.assertEquals(claim(repo), 'AAAA0001')
+        self.assertEquals(SigningKey.objects.get(key_id='AAAA0001').repository, repo)
+        self.assertEquals(claim(Repository.objects.get(id=12)), 'AAAA0002')
+        self.assertIsNone(claim(Repository.objects.get(id=11)))
+
+    def test_new_repository_takes_pooled_key(self):
+        SigningKey.objects.create(key_id='AAAA0001')
+        repo = Repository.objects.create(user_id=5, name='eric7')
+
+        self.assertEquals(repo.key_id, 'AAAA0001')
+        self.assertEquals(Repository.objects.get(id=repo.id).key_id, 'AAAA0001')
+
+    def test_new_repository_without_pooled_key(self):
+        repo = Repository.objects.create(user_id=5, name='eric7')
+        self.assertEquals(repo.key_id, '')
+
+    def test_ensure_key_prefers_pool(self):
+        SigningKey.objects.create(key_id='AAAA0001')
+        repo = Repository.objects.get(id=13)
+        with mock.patch('aasemble.django.apps.buildsvc.models.FakeDriver.generate_key') as generate_key:
+            repo.ensure_key()
+        self.assertFalse(generate_key.called)
+        self.assertEquals(Repository.objects.get(id=13).key_id, 'AAAA0001')
+
+    @override_settings(BUILDSVC_KEY_POOL_SIZE=5, BUILDSVC_KEY_POOL_PARALLELISM=3)
+    @mock.patch('aasemble.django.apps.buildsvc.tasks.generate_pool_key')
+    def test_refill_is_limited_by_parallelism(self, generate_pool_key):
+        self.assertEquals(refill(), [0, 1, 2])
+        self.assertEquals(generate_pool_key.delay.call_args_list, [mock.call(0), mock.call(1), mock.call(2)])
+
+        # All slots are busy
+        self.assertEquals(refill(), [])
+
+    @override_settings(BUILDSVC_KEY_POOL_SIZE=2, BUILDSVC_KEY_POOL_PARALLELISM=3)
+    @mock.patch('aasemble.django.apps.buildsvc.tasks.generate_pool_key')
+    def test_refill_only_what_is_missing(self, generate_pool_key):
+        SigningKey.objects.create(key_id='AAAA0001')
+        SigningKey.objects.create(key_id='AAAA0002', repository_id=12)
+        self.assertEquals(refill(), [0])
+
+    @override_settings(BUILDSVC_KEY_POOL_SIZE=1)
+    @mock.patch('aasemble.django.apps.buildsvc.tasks.generate_pool_key')
+    def test_generate(self, generate_pool_key):
+        self.assertEquals(refill(), [0])
+        generate(0)
+
+        self.assertEquals(list(SigningKey.objects.values_list('key_id', 'repository')), [('FAKEID', None)])
+        # The slot is free again, but the pool is full
+        self.assertEquals(generate_pool_key.delay.call_count, 1)
+        generate_pool_key.delay.reset_mock()
+        SigningKey.objects.update(repository_id=12)
+        self.assertEquals(refill(), [0])
+
+    def test_pooled_key_name(self):
+        from .models import RepreproDriver
+        self.assertEquals(RepreproDriver(None).key_name(), 'aaSemble repository')
+        self.assertEquals(RepreproDriver(Repository.objects.get(id=12)).key_name(), 'eric5 repository')
+
+
+class GitCacheTestCase(TestCase):
+    def setUp(self):
+        super(GitCacheTestCase, self).setUp()
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+
+    def test_normalize_git_url(self):
+        self.assertEquals(normalize_git_url('https://GitHub.com/owner/repo.git/'),
+                          'https://github.com/owner/repo')
+        self.assertEquals(normalize_git_url('https://github.com/owner/repo'),
+                          'https://github.com/owner/repo')
+
+    def test_equivalent_urls_share_mirror(self):
+        cache = GitCache(self.root)
+        self.assertEquals(cache.mirror_path('https://github.com/owner/repo.git'),
+                          cache.mirror_path('https://github.com/owner/repo'))
+
+    @mock.patch('aasemble.django.apps.buildsvc.gitcache.run_cmd')
+    def test_checkout_creates_mirror(self, run_cmd):
+        cache = GitCache(self.root)
+        path = cache.mirror_path('https://github.com/owner/repo')
+
+        def fake_run_cmd(cmd, **kwargs):
+            if cmd[:3] == ['git', 'clone', '--mirror']:
+                os.mkdir(cmd[-1])
+
+        run_cmd.side_effect = fake_run_cmd
+        cache.checkout('https://github.com/owner/repo', 'master', '/some/dest')
+
+        run_cmd.assert_any_call(['git', 'clone', '--mirror', 'https://github.com/owner/repo', '%s.tmp' % (path,)], logger=mock.ANY)
+        run_cmd.assert_any_call(['git', 'clone', '--local', '-b', 'master', path, '/some/dest'], logger=mock.ANY)
+        self.assertTrue(os.path.isdir(path))
+
+    @mock.patch('aasemble.django.apps.buildsvc.gitcache.run_cmd')
+    def test_checkout_fetches_existing_mirror(self, run_cmd):
+        cache = GitCache(self.root)
+        path = cache.mirror_path('https://github.com/owner/repo')
+        os.mkdir(path)
+
+        cache.checkout('https://github.com/owner/repo', 'master', '/some/dest')
+
+        run_cmd.assert_any_call(['git', 'fetch', '--prune', 'origin'], cwd=path, logger=mock.ANY)
+
+    @mock.patch('aasemble.django.apps.buildsvc.gitcache.run_cmd')
+    def test_checkout_holds_lock_until_cloned(self, run_cmd):
+        cache = GitCache(self.root)
+        path = cache.mirror_path('https://github.com/owner/repo')
+        os.mkdir(path)
+        events = []
+
+        @contextlib.contextmanager
+        def fake_locked(p):
+            events.append(('lock', p))
+            yield
+            events.append(('unlock', p))
+
+        run_cmd.side_effect = lambda cmd, **kwargs: events.append(tuple(cmd[:3]))
+
+        with mock.patch.object(cache, 'locked', fake_locked):
+            cache.checkout('https://github.com/owner/repo', 'master', '/some/dest')
+
+        self.assertEquals(events[:5], [('lock', path),
+                                       ('git', 'remote', 'set-url'),
+                                       ('git', 'fetch', '--prune'),
+                                       ('git', 'clone', '--local'),
+                                       ('unlock', path)])
+
+    def test_evict_removes_least_recently_used(self):
+        cache = GitCache(self.root, max_size=150)
+        for i, name in enumerate(['old.git', 'new.git']):
+            os.mkdir(os.path.join(self.root, name))
+            with open(os.path.join(self.root, name, 'pack'), 'w') as fp:
+                fp.write('x' * 100)
+            os.utime(os.path.join(self.root, name), (i, i))
+
+        evicted = cache.evict()
+
+        self.assertEquals(evicted, [os.path.join(self.root, 'old.git')])
+        self.assertTrue(os.path.isdir(os.path.join(self.root, 'new.git')))
+
+
+class PollerTestCase(TestCase):
+    def test_parse_ls_remote(self):
+        output = (b'1111111111111111111111111111111111111111\trefs/heads/master\n'
+                  b'2222222222222222222222222222222222222222\trefs/heads/stable\n')
+        self.assertEquals(parse_ls_remote(output),
+                          {'refs/heads/master': '1111111111111111111111111111111111111111',
+                           'refs/heads/stable': '2222222222222222222222222222222222222222'})
+
+    @mock.patch('aasemble.django.apps.buildsvc.poller.ls_remote_many')
+    def test_poll_sources_one_ls_remote_per_remote(self, ls_remote_many):
+        master = PackageSource.objects.create(series_id=1, git_url='https://example.com/git', branch='master')
+        stable = PackageSource.objects.create(series_id=1, git_url='https://example.com/git', branch='stable',
+                                              last_seen_revision='2' * 40)
+        other = PackageSource.objects.create(series_id=1, git_url='https://example.com/other', branch='master')
+
+        ls_remote_many.return_value = {'https://example.com/git': {'refs/heads/master': '1' * 40,
+                                                                   'refs/heads/stable': '2' * 40},
+                                       'https://example.com/other': None}
+
+        changed = poll_sources([master, stable, other])
+
+        ls_remote_many.assert_called_once_with({'https://example.com/git': set(['refs/heads/master', 'refs/heads/stable']),
+                                                'https://example.com/other': set(['refs/heads/master'])},
+                                               logger=mock.ANY)
+        self.assertEquals(changed, [master])
+
+        master.refresh_from_db()
+        stable.refresh_from_db()
+        other.refresh_from_db()
+        self.assertEquals(master.last_seen_revision, '1' * 40)
+        self.assertEquals(stable.last_seen_revision, '2' * 40)
+        self.assertEquals(other.last_seen_revision, None)
+
+    @mock.patch('aasemble.django.apps.buildsvc.models.PackageSource.build')
+    @mock.patch('aasemble.django.apps.buildsvc.poller.ls_remote_many')
+    def test_poll_all_builds_changed_sources(self, ls_remote_many, build):
+        from .tasks import poll_all
+        PackageSource.objects.update(branch='master', last_seen_revision='1' * 40)
+        PackageSource.objects.filter(id=1).update(last_seen_revision=None)
+        ls_remote_many.side_effect = lambda requests, logger: dict((url, {'refs/heads/master': '1' * 40}) for url in requests)
+
+        poll_all()
+
+        self.assertEquals(build.call_count, 1)
+
+    @override_settings(BUILDSVC_POLL_MIN_INTERVAL=10, BUILDSVC_POLL_MAX_INTERVAL=100, BUILDSVC_POLL_BACKOFF_FACTOR=2)
+    def test_backoff_interval(self):
+        self.assertEquals(backoff_interval(0), 20)
+        self.assertEquals(backoff_interval(20), 40)
+        self.assertEquals(backoff_interval(80), 100)
+        self.assertEquals(backoff_interval(100), 100)
+
+    @override_settings(BUILDSVC_POLL_MIN_INTERVAL=10, BUILDSVC_POLL_MAX_INTERVAL=100)
+    @mock.patch('aasemble.django.apps.buildsvc.poller.ls_remote_many')
+    def test_poll_sources_reschedules(self, ls_remote_many):
+        changed = PackageSource.objects.create(series_id=1, git_url='https://example.com/git', branch='master',
+                                               poll_interval=80)
+        unchanged = PackageSource.objects.create(series_id=1, git_url='https://example.com/git', branch='stable',
+                                                 last_seen_revision='2' * 40, poll_interval=20)
+        ls_remote_many.return_value = {'https://example.com/git': {'refs/heads/master': '1' * 40,
+                                                                   'refs/heads/stable': '2' * 40}}
+
+        poll_sources([changed, unchanged])
+
+        changed.refresh_from_db()
+        unchanged.refresh_from_db()
+        self.assertEquals(changed.poll_interval, 10)
+        self.assertIsNotNone(changed.last_changed)
+        self.assertEquals(unchanged.poll_interval, 40)
+        self.assertIsNone(unchanged.last_changed)
+        self.assertGreater(unchanged.next_poll, changed.next_poll)
+
+    def test_due_for_poll(self):
+        now = timezone.now()
+        PackageSource.objects.update(next_poll=now + datetime.timedelta(minutes=5))
+        due = PackageSource.objects.create(series_id=1, git_url='https://example.com/git', branch='master',
+                                           next_poll=now - datetime.timedelta(seconds=1))
+        PackageSource.objects.create(series_id=1, git_url='https://example.com/git', branch='hooked',
+                                     next_poll=now - datetime.timedelta(seconds=1), webhook_registered=True)
+
+        self.assertEquals(list(PackageSource.due_for_poll(now)), [due])
+
+
+class LsRemoteEngineTestCase(TestCase):
+    def setUp(self):
+        super(LsRemoteEngineTestCase, self).setUp()
+        self.gitdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.gitdir)
+        subprocess.check_call(['git', 'init', '-q', self.gitdir])
+        subprocess.check_call(['git', '-c', 'user.name=Test', '-c', 'user.email=test@example.com',
+                               'commit', '-q', '--allow-empty', '-m', 'Initial'], cwd=self.gitdir)
+        self.head = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=self.gitdir).strip().decode()
+        self.branch = subprocess.check_output(['git', 'rev-parse', '--abbrev-ref', 'HEAD'], cwd=self.gitdir).strip().decode()
+
+    def test_run(self):
+        ref = 'refs/heads/%s' % (self.branch,)
+        missing = os.path.join(self.gitdir, 'does-not-exist')
+        engine = LsRemoteEngine(concurrency=1, per_host=1, timeout=30)
+
+        results = engine.run({self.gitdir: [ref], missing: [ref]})
+
+        self.assertEquals(results, {self.gitdir: {ref: self.head},
+                                    missing: None})
+
+
+def make_tarball(files):
+    out = io.BytesIO()
+    with tarfile.open(fileobj=out, mode='w:gz') as tf:
+        for name, data in files:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tf.addfile(info, io.BytesIO(data))
+    return out.getvalue()
+
+
+class BuildCacheTestCase(TestCase):
+    def setUp(self):
+        super(BuildCacheTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.cache = BuildCache(os.path.join(self.tmpdir, 'cache'))
+
+    def make_deb(self, name, version, data=b'payload', extra=''):
+        control = ('Package: %s\nVersion: %s\nArchitecture: amd64\nSource: src (0.9)\n%s' % (name, version, extra)).encode('utf-8')
+        path = os.path.join(self.tmpdir, '%s_%s_amd64.deb' % (name, version))
+        write_ar(path, [('debian-binary', b'2.0\n'),
+                        ('control.tar.gz', make_tarball([('./control', control)])),
+                        ('data.tar.gz', make_tarball([('./usr/share/doc/%s/README' % (name,), data)]))])
+        return path
+
+    def test_build_key(self):
+        args = ['treesha', 'PythonBuilder', ['b', 'a'], ['c'], 'repos', 'keys', 'aasemble', 'ubuntu:trusty']
+        key = build_key(*args)
+
+        self.assertEquals(key, build_key('treesha', 'PythonBuilder', ['a', 'b', 'a'], ['c'], 'repos', 'keys', 'aasemble', 'ubuntu:trusty'))
+        self.assertNotEquals(key, build_key('othersha', *args[1:]))
+        self.assertNotEquals(key, build_key('treesha', 'GolangBuilder', *args[2:]))
+        self.assertNotEquals(key, build_key('treesha', 'PythonBuilder', ['a', 'b', 'd'], *args[3:]))
+        self.assertNotEquals(key, build_key(*(args[:4] + ['other repos'] + args[5:])))
+
+    def test_rewrite_deb_version(self):
+        deb = self.make_deb('foo', '1.0+3')
+        outdir = tempfile.mkdtemp(dir=self.tmpdir)
+
+        filename, control = rewrite_deb_version(deb, '1:1.0+7', outdir)
+
+        self.assertEquals(filename, 'foo_1.0+7_amd64.deb')
+        self.assertEquals(control['Version'], '1:1.0+7')
+        self.assertEquals(control['Source'], 'src')
+
+        old, new = dict(read_ar(deb)), dict(read_ar(os.path.join(outdir, filename)))
+        self.assertEquals(old['data.tar.gz'], new['data.tar.gz'])
+        self.assertEquals(old['debian-binary'], new['debian-binary'])
+        with tarfile.open(fileobj=io.BytesIO(new['control.tar.gz'])) as tf:
+            self.assertIn(b'Version: 1:1.0+7', tf.extractfile('./control').read())
+
+    def test_miss_then_hit(self):
+        before = stats()
+        outdir = tempfile.mkdtemp(dir=self.tmpdir)
+
+        self.assertIsNone(self.cache.republish('k1', '1.0+2', outdir))
+
+        self.cache.store('k1', [self.make_deb('foo', '1.0+1'), self.make_deb('foo-doc', '1.0+1')])
+        debs = self.cache.republish('k1', '1.0+2', outdir)
+
+        self.assertEquals(sorted(filename for filename, control in debs),
+                          ['foo-doc_1.0+2_amd64.deb', 'foo_1.0+2_amd64.deb'])
+        self.assertTrue(os.path.exists(os.path.join(outdir, 'foo_1.0+2_amd64.deb')))
+        self.assertEquals(stats(), {'hits': before['hits'] + 1, 'misses': before['misses'] + 1})
+
+    def test_hit_moves_relations_between_siblings(self):
+        outdir = tempfile.mkdtemp(dir=self.tmpdir)
+        relations = 'Depends: foo-common:any (= 1.0+1), bar (= 1.0+1), libc6 (>= 2.19)\nBreaks: foo-common (<< 1.0)\n'
+        self.cache.store('k1', [self.make_deb('foo', '1.0+1', extra=relations), self.make_deb('foo-common', '1.0+1')])
+
+        debs = dict(self.cache.republish('k1', '1.0+2', outdir))
+
+        control = debs['foo_1.0+2_amd64.deb']
+        self.assertEquals(control['Depends'], 'foo-common:any (= 1.0+2), bar (= 1.0+1), libc6 (>= 2.19)')
+        self.assertEquals(control['Breaks'], 'foo-common (<< 1.0)')
+        with tarfile.open(fileobj=io.BytesIO(dict(read_ar(os.path.join(outdir, 'foo_1.0+2_amd64.deb')))['control.tar.gz'])) as tf:
+            self.assertIn(b'foo-common:any (= 1.0+2)', tf.extractfile('./control').read())
+
+    def test_evict(self):
+        cache = BuildCache(self.cache.root, max_size=1500)
+        cache.store('old', [self.make_deb('foo', '1', data=os.urandom(1000))])
+        os.utime(cache.entry_path('old'), (1, 1))
+        cache.store('new', [self.make_deb('foo', '2', data=os.urandom(1000))])
+
+        self.assertEquals(cache.entries(), [cache.entry_path('new')])
+
+    @mock.patch('aasemble.django.apps.buildsvc.pkgbuild.buildcache.get_build_cache')
+    def test_builder_republishes_on_hit(self, get_build_cache):
+        from .pkgbuild.generic import GenericBuilder
+
+        builder = GenericBuilder(self.tmpdir, PackageSource.objects.get(id=1), mock.MagicMock(build_counter=3), tree_sha='abc')
+        get_build_cache.return_value.republish.return_value = [('foo_3_amd64.deb', {'Architecture': 'amd64'})]
+
+        with mock.patch.object(builder, 'build_source_package') as build_source_package, \
+                mock.patch.object(builder, 'generate_binary_changes') as generate_binary_changes:
+            self.assertTrue(builder.republish_cached_build())
+
+        build_source_package.assert_called_once_with()
+        generate_binary_changes.assert_called_once_with([('foo_3_amd64.deb', {'Architecture': 'amd64'})])
+
+    @mock.patch('aasemble.django.apps.buildsvc.pkgbuild.buildcache.get_build_cache')
+    def test_builder_without_tree_sha_skips_cache(self, get_build_cache):
+        from .pkgbuild.generic import GenericBuilder
+
+        builder = GenericBuilder(self.tmpdir, PackageSource.objects.get(id=1), mock.MagicMock(build_counter=3))
+
+        self.assertFalse(builder.republish_cached_build())
+        self.assertFalse(get_build_cache.return_value.republish.called)
+
+
+class AptIndexDriverTestCase(TestCase):
+    def setUp(self):
+        super(AptIndexDriverTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        settings = override_settings(BUILDSVC_REPOS_BASE_DIR=os.path.join(self.tmpdir, 'repos'),
+                                     BUILDSVC_REPOS_BASE_PUBLIC_DIR=os.path.join(self.tmpdir, 'public'),
+                                     BUILDSVC_ARTIFACT_STORE_DIR=os.path.join(self.tmpdir, 'store'))
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        # eric6 has no signing key
+        self.repo = Repository.objects.get(id=13)
+        self.driver = AptIndexDriver(self.repo)
+        self.distdir = os.path.join(self.repo.outdir(), 'dists', 'aasemble')
+
+    def write(self, name, data):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'wb') as fp:
+            fp.write(data)
+        return path
+
+    def make_upload(self, source, version, binaries=('amd64',)):
+        """Write a changes file for a source package and its binaries"""
+        files = []
+        for arch in binaries:
+            control = ('Package: %s\nVersion: %s\nArchitecture: %s\nSource: %s\nDescription: test\n' % (source, version, arch, source)).encode('utf-8')
+            deb = '%s_%s_%s.deb' % (source, version, arch)
+            path = os.path.join(self.tmpdir, deb)
+            write_ar(path, [('debian-binary', b'2.0\n'),
+                            ('control.tar.gz', make_tarball([('./control', control)])),
+                            ('data.tar.gz', make_tarball([]))])
+            files.append(deb)
+
+        tarball = '%s_%s.tar.gz' % (source, version)
+        self.write(tarball, b'source')
+        dsc = '%s_%s.dsc' % (source, version)
+        self.write(dsc, ('Format: 3.0 (native)\nSource: %s\nBinary: %s\nVersion: %s\n'
+                         'Files:\n 0f8e 6 %s\nChecksums-Sha256:\n 1a2b 6 %s\n' % (source, source, version, tarball, tarball)).encode('utf-8'))
+        files.append(dsc)
+        files.append(tarball)
+
+        changes = 'Source: %s\nVersion: %s\nFiles:\n' % (source, version)
+        changes += ''.join(' 0123 1 main optional %s\n' % (f,) for f in files)
+        return self.write('%s_%s_source.changes' % (source, version), changes.encode('utf-8'))
+
+    def read(self, path):
+        with open(os.path.join(self.distdir, path), 'r') as fp:
+            return fp.read()
+
+    def test_include_and_export(self):
+        self.driver.include('aasemble', self.make_upload('foo', '1.0'))
+        self.driver.export()
+
+        packages = self.read('main/binary-amd64/Packages')
+        self.assertIn('Package: foo\n', packages)
+        self.assertIn('Filename: pool/main/f/foo/foo_1.0_amd64.deb\n', packages)
+        self.assertTrue(os.path.exists(os.path.join(self.repo.outdir(), 'pool/main/f/foo/foo_1.0_amd64.deb')))
+
+        sources = self.read('main/source/Sources')
+        self.assertIn('Package: foo\n', sources)
+        self.assertIn('Directory: pool/main/f/foo\n', sources)
+        self.assertIn(' foo_1.0.dsc\n', sources)
+        self.assertTrue(os.path.exists(os.path.join(self.repo.outdir(), 'pool/main/f/foo/foo_1.0.tar.gz')))
+
+        release = self.read('Release')
+        f = PublishedIndexFile.objects.get(index__series_id=10, path='main/binary-amd64/Packages')
+        self.assertIn(' %s %d main/binary-amd64/Packages\n' % (f.sha256, f.size), release)
+        self.assertEquals(f.size, len(packages))
+
+    def test_compressed_indexes(self):
+        self.driver.include('aasemble', self.make_upload('foo', '1.0'))
+        self.driver.export()
+
+        packages = self.read('main/binary-amd64/Packages').encode('utf-8')
+        with gzip.open(os.path.join(self.distdir, 'main/binary-amd64/Packages.gz'), 'rb') as fp:
+            self.assertEquals(fp.read(), packages)
+        self.assertEquals(subprocess.check_output(['xz', '-dc', os.path.join(self.distdir, 'main/binary-amd64/Packages.xz')]), packages)
+
+        release = self.read('Release')
+        for path in ('Packages', 'Packages.gz', 'Packages.xz'):
+            self.assertIn(' main/binary-amd64/%s\n' % (path,), release)
+
+    def test_by_hash(self):
+        self.driver.include('aasemble', self.make_upload('foo', '1.0'))
+        self.driver.export()
+
+        self.assertIn('Acquire-By-Hash: yes\n', self.read('Release'))
+        for f in PublishedIndexFile.objects.filter(index__series_id=10):
+            by_hash = os.path.join(self.distdir, os.path.dirname(f.path), 'by-hash', 'SHA256', f.sha256)
+            with open(by_hash, 'rb') as fp, open(os.path.join(self.distdir, f.path), 'rb') as fp2:
+                self.assertEquals(fp.read(), fp2.read())
+
+    def test_superseded_by_hash_files_kept_for_grace_period(self):
+        self.driver.include('aasemble', self.make_upload('foo', '1.0'))
+        self.driver.export()
+        old = PublishedIndexFile.objects.get(index__series_id=10, path='main/source/Sources')
+        old_path = os.path.join(self.distdir, 'main/source/by-hash/SHA256', old.sha256)
+
+        self.driver.include('aasemble', self.make_upload('bar', '1.0', binaries=()))
+        self.driver.export()
+        new = PublishedIndexFile.objects.get(index__series_id=10, path='main/source/Sources')
+        self.assertNotEquals(old.sha256, new.sha256)
+        self.assertTrue(os.path.exists(old_path))
+
+        with override_settings(BUILDSVC_BY_HASH_GRACE_PERIOD=3600):
+            self.assertEquals(self.driver.expire_by_hash(self.repo.series.get(), now=time.time() + 60), [])
+            removed = self.driver.expire_by_hash(self.repo.series.get(), now=time.time() + 7200)
+        self.assertIn(old_path, removed)
+        self.assertFalse(os.path.exists(old_path))
+        self.assertTrue(os.path.exists(os.path.join(self.distdir, 'main/source/by-hash/SHA256', new.sha256)))
+
+    def test_new_version_replaces_old(self):
+        self.driver.include('aasemble', self.make_upload('foo', '1.0'))
+        self.driver.include('aasemble', self.make_upload('foo', '1.1'))
+        self.driver.export()
+
+        self.assertEquals(set(PublishedPackage.objects.filter(series_id=10).values_list('version', flat=True)), set(['1.1']))
+        self.assertNotIn('1.0', self.read('main/binary-amd64/Packages'))
+        self.assertFalse(os.path.exists(os.path.join(self.repo.outdir(), 'pool/main/f/foo/foo_1.0_amd64.deb')))
+
+    def test_export_only_rewrites_changed_indexes(self):
+        self.driver.include('aasemble', self.make_upload('foo', '1.0'))
+        self.driver.export()
+
+        self.driver.include('aasemble', self.make_upload('bar', '1.0', binaries=()))
+        with mock.patch.object(self.driver, 'write_index', wraps=self.driver.write_index) as write_index:
+            self.driver.export()
+
+        self.assertEquals([c[0][1].architecture for c in write_index.call_args_list], ['source'])
+        self.assertIn('Package: bar\n', self.read('main/source/Sources'))
+        self.assertIn('Package: foo\n', self.read('main/source/Sources'))
+
+    def test_export_without_changes_does_nothing(self):
+        self.driver.include('aasemble', self.make_upload('foo', '1.0'))
+        self.driver.export()
+
+        with mock.patch.object(self.driver, 'write_release') as write_release:
+            self.driver.export()
+        self.assertFalse(write_release.called)
+
+    def test_architecture_all_goes_in_every_binary_index(self):
+        self.driver.include('aasemble', self.make_upload('foo', '1.0', binaries=('all',)))
+        self.driver.export()
+
+        self.assertIn('Architecture: all\n', self.read('main/binary-amd64/Packages'))
+
+    def test_remove(self):
+        self.driver.include('aasemble', self.make_upload('foo', '1.0'))
+        self.driver.include('aasemble', self.make_upload('bar', '1.0'))
+        self.driver.export()
+
+        self.driver.remove('aasemble', 'foo')
+        self.driver.export()
+
+        self.assertNotIn('Package: foo\n', self.read('main/binary-amd64/Packages'))
+        self.assertNotIn('Package: foo\n', self.read('main/source/Sources'))
+        self.assertIn('Package: bar\n', self.read('main/source/Sources'))
+        self.assertFalse(os.path.exists(os.path.join(self.repo.outdir(), 'pool/main/f/foo/foo_1.0.dsc')))
+
+    def test_pool_files_are_matched_whole(self):
+        series = self.repo.series.get(name='aasemble')
+        PublishedPackage.objects.create(series=series, architecture='source', name='bar', source='bar', version='1.0', stanza='',
+                                        files='pool/main/f/foo/foo_1.0.dsc\npool/main/f/foo/foo_1.0.tar.gz.asc')
+        pool = os.path.join(self.repo.outdir(), 'pool/main/f/foo')
+        os.makedirs(pool)
+        for name in ('foo_1.0.tar.gz', 'foo_1.0.dsc'):
+            self.write(name, b'source')
+            os.rename(os.path.join(self.tmpdir, name), os.path.join(pool, name))
+
+        self.driver.remove_from_pool(['pool/main/f/foo/foo_1.0.tar.gz', 'pool/main/f/foo/foo_1.0.dsc'])
+
+        self.assertFalse(os.path.exists(os.path.join(pool, 'foo_1.0.tar.gz')))
+        self.assertTrue(os.path.exists(os.path.join(pool, 'foo_1.0.dsc')))
+
+    def test_index_files_are_kept_if_writing_an_index_fails(self):
+        self.driver.include('aasemble', self.make_upload('foo', '1.0'))
+        self.driver.export()
+        index = PublishedIndex.objects.get(series__name='aasemble', architecture='amd64')
+        before = sorted(index.files.values_list('path', 'sha256'))
+
+        self.driver.include('aasemble', self.make_upload('foo', '1.1'))
+        with mock.patch('aasemble.django.apps.buildsvc.aptindex.file_hashes', side_effect=[(1, 'md5', 'sha1', 'sha256'), IOError('disk gone')]):
+            self.assertRaises(IOError, self.driver.write_index, index.series, index)
+
+        self.assertEquals(sorted(index.files.values_list('path', 'sha256')), before)
+        self.assertTrue(PublishedIndex.objects.get(id=index.id).dirty)
+
+    def test_repositories_share_pool_files(self):
+        upload = self.make_upload('foo', '1.0')
+        other = Repository.objects.get(id=12)
+        other.key_id = ''
+        self.driver.include('aasemble', upload)
+        AptIndexDriver(other).include('aasemble', upload)
+
+        deb = 'pool/main/f/foo/foo_1.0_amd64.deb'
+        self.assertTrue(os.path.samefile(os.path.join(self.repo.outdir(), deb),
+                                         os.path.join(other.outdir(), deb)))
+
+        self.driver.remove('aasemble', 'foo')
+        self.assertTrue(os.path.exists(os.path.join(other.outdir(), deb)))
+
+    @skipIf(not gpg_available, 'gpg unavailable')
+    def test_release_is_signed(self):
+        gpghome, key_id = make_throwaway_keyring(self)
+        self.repo.key_id = key_id
+        with override_settings(BUILDSVC_GNUPGHOME=gpghome):
+            self.driver.include('aasemble', self.make_upload('foo', '1.0'))
+            self.driver.export()
+
+        release = os.path.join(self.distdir, 'Release')
+        self.assertTrue(verify_signature(gpghome, os.path.join(self.distdir, 'InRelease')))
+        self.assertTrue(verify_signature(gpghome, os.path.join(self.distdir, 'Release.gpg'), release))
+        self.assertFalse(os.path.exists(release + '.new'))
+
+    @override_settings(BUILDSVC_REPODRIVER='aasemble.django.apps.buildsvc.aptindex.AptIndexDriver')
+    def test_selected_by_setting(self):
+        with mock.patch.multiple(self.repo, ensure_key=mock.DEFAULT, export_key=mock.DEFAULT), \
+                mock.patch('aasemble.django.apps.buildsvc.aptindex.AptIndexDriver.export') as export:
+            self.repo.export()
+        export.assert_called_once_with()
+
+
+@skipIf(not gpg_available, 'gpg unavailable')
+class SignerTestCase(TestCase):
+    def setUp(self):
+        super(SignerTestCase, self).setUp()
+        self.gpghome, self.key_id = make_throwaway_keyring(self)
+        self.signer = Signer(self.gpghome)
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    def request(self, name, key_id=None, **kwargs):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'w') as fp:
+            fp.write('Origin: %s\n' % (name,))
+        return SignRequest(key_id or self.key_id, path,
+                           clearsign_to=path + '.asc', detach_sign_to=path + '.gpg', **kwargs)
+
+    def test_sign(self):
+        done = mock.Mock()
+        request = self.request('Release', done=done)
+        self.signer.submit(request)
+
+        self.assertTrue(verify_signature(self.gpghome, request.path + '.asc'))
+        self.assertTrue(verify_signature(self.gpghome, request.path + '.gpg', request.path))
+        done.assert_called_once_with()
+        self.assertIsNotNone(request.latency)
+
+    def test_batch_signs_at_the_end(self):
+        requests = [self.request('Release%d' % (i,)) for i in range(3)]
+        with self.signer.batch():
+            for request in requests:
+                self.signer.submit(request)
+            self.assertFalse(any(os.path.exists(request.path + '.asc') for request in requests))
+
+        self.assertTrue(all(verify_signature(self.gpghome, request.path + '.asc') for request in requests))
+
+    def test_failed_request_does_not_stop_the_batch(self):
+        bad = self.request('Bad', key_id='DEADBEEF', done=mock.Mock())
+        good = self.request('Good')
+        with self.assertRaises(SigningFailed) as cm:
+            with self.signer.batch():
+                self.signer.submit(bad)
+                self.signer.submit(good)
+
+        self.assertEquals(cm.exception.requests, [bad])
+        self.assertIn('DEADBEEF', bad.error)
+        self.assertFalse(bad.done.called)
+        self.assertTrue(verify_signature(self.gpghome, good.path + '.asc'))
+
+    def test_latency_is_reported(self):
+        for i in range(2):
+            self.signer.submit(self.request('Release%d' % (i,)))
+
+        result = signing_stats()
+        self.assertEquals(result['count'], 2)
+        self.assertGreater(result['p99'], 0)
+        self.assertGreaterEqual(result['p99'], result['p50'])
+
+    def test_public_keys_are_exported_once(self):
+        with mock.patch.object(self.signer, 'gpg', wraps=self.signer.gpg) as gpg:
+            first = self.signer.export_public_key(self.key_id)
+            self.assertEquals(self.signer.export_public_key(self.key_id), first)
+        self.assertEquals(gpg.call_count, 1)
+        self.assertIn(b'BEGIN PGP PUBLIC KEY BLOCK', first)
+
+
+class ArtifactStoreTestCase(TestCase):
+    def setUp(self):
+        super(ArtifactStoreTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.store = ArtifactStore(os.path.join(self.tmpdir, 'store'))
+
+    def write(self, name, data=b'package contents'):
+        path = os.path.join(self.tmpdir, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as fp:
+            fp.write(data)
+        return path
+
+    def test_identical_files_are_stored_once(self):
+        src = self.write('build/foo.deb')
+        first = os.path.join(self.tmpdir, 'repo1', 'pool', 'foo.deb')
+        second = os.path.join(self.tmpdir, 'repo2', 'pool', 'foo.deb')
+
+        sha256 = self.store.link(src, first)
+        self.assertEquals(self.store.link(self.write('build2/foo.deb'), second), sha256)
+
+        self.assertTrue(os.path.samefile(first, second))
+        self.assertTrue(os.path.samefile(first, self.store.path(sha256)))
+
+    def test_last_unlink_frees_storage(self):
+        sha256 = self.store.link(self.write('build/foo.deb'), os.path.join(self.tmpdir, 'repo1', 'foo.deb'))
+        self.store.link(self.write('build/foo.deb'), os.path.join(self.tmpdir, 'repo2', 'foo.deb'))
+        os.unlink(os.path.join(self.tmpdir, 'build/foo.deb'))
+        self.assertEquals(self.store.references(sha256), 2)
+
+        self.assertEquals(self.store.unlink(os.path.join(self.tmpdir, 'repo1', 'foo.deb')), 0)
+        self.assertEquals(self.store.references(sha256), 1)
+
+        self.assertEquals(self.store.unlink(os.path.join(self.tmpdir, 'repo2', 'foo.deb')), len(b'package contents'))
+        self.assertFalse(os.path.exists(self.store.path(sha256)))
+        self.assertEquals(self.store.references(sha256), 0)
+
+    def test_dedupe(self):
+        first = self.write('pool/a/foo.deb')
+        second = self.write('pool/b/foo.deb')
+        self.write('pool/c/bar.deb', b'other contents')
+
+        self.assertEquals(self.store.dedupe(os.path.join(self.tmpdir, 'pool')), len(b'package contents'))
+        self.assertTrue(os.path.samefile(first, second))
+
+        # Files already in the store are not read again
+        with mock.patch('aasemble.django.apps.buildsvc.artifactstore.sha256_file') as sha256_file:
+            self.assertEquals(self.store.dedupe(os.path.join(self.tmpdir, 'pool')), 0)
+        self.assertFalse(sha256_file.called)
+
+    def test_collect(self):
+        kept = self.store.link(self.write('build/foo.deb'), os.path.join(self.tmpdir, 'repo1', 'foo.deb'))
+        gone = self.store.link(self.write('build/bar.deb', b'other contents'), os.path.join(self.tmpdir, 'repo1', 'bar.deb'))
+        shutil.rmtree(os.path.join(self.tmpdir, 'build'))
+
+        # Removed behind the store's back, as reprepro does
+        os.unlink(os.path.join(self.tmpdir, 'repo1', 'bar.deb'))
+
+        self.assertEquals(self.store.collect(), len(b'other contents'))
+        self.assertTrue(os.path.exists(self.store.path(kept)))
+        self.assertFalse(os.path.exists(self.store.path(gone)))
+
+
+class BuildEnvironmentCacheTestCase(TestCase):
+    def setUp(self):
+        super(BuildEnvironmentCacheTestCase, self).setUp()
+        self.basedir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.basedir)
+        with open(os.path.join(self.basedir, 'repos'), 'w') as fp:
+            fp.write('deb http://example.com/ aasemble main')
+        self.client = mock.MagicMock()
+        self.client.inspect_image.return_value = {'Size': 1000}
+        self.cache = BuildEnvironmentCache(client=self.client, base_dist='ubuntu', base_release='trusty')
+
+    def test_environment_key_ignores_order(self):
+        self.assertEquals(environment_key(['a', 'b'], 'repos', '', 'aasemble', 'ubuntu:trusty'),
+                          environment_key(['b', 'a', 'a'], 'repos', '', 'aasemble', 'ubuntu:trusty'))
+        self.assertNotEquals(environment_key(['a', 'b'], 'repos', '', 'aasemble', 'ubuntu:trusty'),
+                             environment_key(['a', 'b'], 'other repos', '', 'aasemble', 'ubuntu:trusty'))
+
+    def test_prepare_builds_missing_image(self):
+        self.client.images.return_value = []
+
+        dist, release = self.cache.prepare(['python-all'], self.basedir, 'aasemble')
+
+        self.assertEquals(dist, 'aasemble-buildenv')
+        self.client.build.assert_called_once_with(path=mock.ANY, tag='aasemble-buildenv:%s' % (release,), rm=True, stream=True, decode=True)
+        self.assertEquals(BuildEnvironment.objects.get(key=release).size, 1000)
+
+    def test_prepare_fails_if_image_build_fails(self):
+        self.client.images.return_value = []
+        self.client.build.return_value = iter([{'stream': 'Step 1 : FROM ubuntu:trusty\n'},
+                                               {'error': 'failed', 'errorDetail': {'message': 'Unable to locate package python-al'}}])
+
+        with self.assertRaisesRegexp(BuildEnvironmentFailed, 'Unable to locate package python-al'):
+            self.cache.prepare(['python-al'], self.basedir, 'aasemble')
+
+        self.assertFalse(BuildEnvironment.objects.exists())
+
+    def test_prepare_copes_with_concurrent_record(self):
+        self.client.images.return_value = [{'Id': 'abc'}]
+        key = environment_key(['python-all'], 'deb http://example.com/ aasemble main', '', 'aasemble', 'ubuntu:trusty')
+        BuildEnvironment.objects.create(key=key, size=500)
+
+        # The other build records the environment after we looked for it
+        with mock.patch('django.db.models.query.QuerySet.update', return_value=0):
+            dist, release = self.cache.prepare(['python-all'], self.basedir, 'aasemble')
+
+        self.assertEquals(release, key)
+        self.assertEquals(BuildEnvironment.objects.get(key=key).size, 500)
+
+    def test_prepare_reuses_existing_image(self):
+        self.client.images.return_value = [{'Id': 'abc'}]
+
+        dist, release = self.cache.prepare(['python-all'], self.basedir, 'aasemble')
+
+        self.assertFalse(self.client.build.called)
+        self.assertTrue(BuildEnvironment.objects.filter(key=release).exists())
+
+    def test_evict(self):
+        now = timezone.now()
+        BuildEnvironment.objects.create(key='stale', size=10, last_used=now - datetime.timedelta(days=30))
+        BuildEnvironment.objects.create(key='older', size=100, last_used=now - datetime.timedelta(hours=2))
+        BuildEnvironment.objects.create(key='newer', size=100, last_used=now - datetime.timedelta(hours=1))
+
+        evicted = self.cache.evict(max_age=7 * 24 * 3600, max_size=150)
+
+        self.assertEquals(evicted, ['stale', 'older'])
+        self.client.remove_image.assert_any_call('aasemble-buildenv:stale')
+        self.assertEquals([env.key for env in BuildEnvironment.objects.all()], ['newer'])
+
+
+class OutputCaptureTestCase(TestCase):
+    def test_capture_stdout_is_per_thread(self):
+        from six import StringIO
+
+        from .output import capture_stdout
+
+        sinks = [StringIO() for i in range(4)]
+        barrier = threading.Event()
+
+        def build(n):
+            with capture_stdout(sinks[n]):
+                barrier.wait()
+                for i in range(100):
+                    print('build %d line %d' % (n, i))
+
+        threads = [threading.Thread(target=build, args=(n,)) for n in range(len(sinks))]
+        for t in threads:
+            t.start()
+        barrier.set()
+        for t in threads:
+            t.join()
+
+        for n, sink in enumerate(sinks):
+            lines = sink.getvalue().splitlines()
+            self.assertEquals(len(lines), 100)
+            self.assertTrue(all(line.startswith('build %d ' % (n,)) for line in lines))
@@ -1,4 +1,5 @@
 import os
+import shutil
 import tempfile
 
 from django.conf import settings
@@ -9,8 +10,10 @@ from django.contrib.auth.models import User
 from django.contrib.sessions.backends.db import SessionStore
 from django.test import TestCase, override_settings
 
+import mock
+
 from aasemble.django.exceptions import CommandFailed
-from aasemble.django.utils import run_cmd
+from aasemble.django.utils import recursive_render, run_cmd, tree_digest
 
 stdout_stderr_script = '''#!/bin/sh
 
@@ -126,3 +129,42 @@ class UtilsTestCase(AasembleTestCase):
 
         finally:
             os.unlink(tmpfile)
+
+    def _prepare_templates(self):
+        srcdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, srcdir)
+        os.mkdir(os.path.join(srcdir, 'conf'))
+        with open(os.path.join(srcdir, 'conf', 'a'), 'w') as fp:
+            fp.write('{{ name }}\n')
+        with open(os.path.join(srcdir, 'conf', 'b'), 'w') as fp:
+            fp.write('static\n')
+        return srcdir
+
+    def _render(self, src, context):
+        with open(src, 'r') as fp:
+            return fp.read().replace('{{ name }}', context['name'])
+
+    @mock.patch('aasemble.django.utils.render_to_string')
+    def test_recursive_render_only_writes_changes(self, render_to_string):
+        # The template loaders only look in the apps' template directories
+        render_to_string.side_effect = self._render
+        srcdir = self._prepare_templates()
+        dstdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, dstdir)
+
+        self.assertEquals(sorted(recursive_render(srcdir, dstdir, {'name': 'foo'})),
+                          [os.path.join(dstdir, 'conf', 'a'), os.path.join(dstdir, 'conf', 'b')])
+        self.assertEquals(recursive_render(srcdir, dstdir, {'name': 'foo'}), [])
+        self.assertEquals(recursive_render(srcdir, dstdir, {'name': 'bar'}), [os.path.join(dstdir, 'conf', 'a')])
+
+        with open(os.path.join(dstdir, 'conf', 'a'), 'r') as fp:
+            self.assertEquals(fp.read(), 'bar\n')
+
+    def test_tree_digest(self):
+        srcdir = self._prepare_templates()
+        digest = tree_digest(srcdir)
+
+        self.assertEquals(tree_digest(srcdir), digest)
+        with open(os.path.join(srcdir, 'conf', 'b'), 'w') as fp:
+            fp.write('changed\n')
+        self.assertNotEquals(tree_digest(srcdir), digest)
@@ -1,3 +1,4 @@
+import hashlib
 import logging
 import os
 import os.path
@@ -10,21 +11,55 @@ from .exceptions import CommandFailed
 LOG = logging.getLogger(__name__)
 
 
+def file_digest(path):
+    """SHA1 of the file at path, or None if there is no such file"""
+    try:
+        with open(path, 'rb') as fp:
+            return hashlib.sha1(fp.read()).hexdigest()
+    except IOError:
+        return None
+
+
+def tree_digest(path):
+    """SHA1 covering the names and contents of every file under path"""
+    h = hashlib.sha1()
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+        for f in sorted(filenames):
+            if f.endswith('.swp'):
+                continue
+            fpath = os.path.join(dirpath, f)
+            h.update(os.path.relpath(fpath, path).encode('utf-8'))
+            h.update(b'\0')
+            h.update(file_digest(fpath).encode('ascii'))
+    return h.hexdigest()
+
+
 def recursive_render(src, dst, context, logger=LOG):
+    """Render the templates under src to dst
+
+    Files that already hold what their template renders to are left
+    alone. Returns the paths that were written."""
     logger.debug('Processing %s' % (src,))
+    written = []
     if os.path.isdir(src):
         if not os.path.isdir(dst):
             os.mkdir(dst)
         for f in os.listdir(src):
-            recursive_render(os.path.join(src, f), os.path.join(dst, f), context)
+            written += recursive_render(os.path.join(src, f), os.path.join(dst, f), context, logger=logger)
     else:
         if src.endswith('.swp'):
-            return
+            return written
         logger.debug('Rendering %s' % (src,))
         s = render_to_string(src, context)
         logger.debug('Result: %r' % (s,))
+        if file_digest(dst) == hashlib.sha1(s.encode('utf-8')).hexdigest():
+            logger.debug('%s is up to date' % (dst,))
+            return written
         with open(dst, 'w') as fp_out:
             fp_out.write(s)
+        written.append(dst)
+    return written
 
 
 def run_cmd(cmd, input=None, cwd=None, override_env=None,
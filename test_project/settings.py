@@ -113,6 +113,7 @@ STATIC_ROOT = 'staticfiles'
 
 BUILDSVC_REPOS_BASE_DIR = os.path.join(BASE_DIR, 'data', 'repos')
 BUILDSVC_REPOS_BASE_PUBLIC_DIR = os.path.join(BASE_DIR, 'data', 'public_repos')
+BUILDSVC_ARTIFACT_STORE_DIR = os.path.join(BASE_DIR, 'data', 'artifacts')
 BUILDSVC_REPOS_BASE_URL = 'http://127.0.0.1:8000/apt'
 BUILDSVC_DEFAULT_SERIES_NAME = 'aasemble'
 BUILDSVC_DEBEMAIL = 'pkgbuild@aasemble.com'
@@ -139,6 +140,30 @@ CELERYBEAT_SCHEDULE = {
         'task': 'aasemble.django.apps.buildsvc.tasks.poll_all',
         'schedule': timedelta(seconds=10),
     },
+    'dispatch-builds': {
+        'task': 'aasemble.django.apps.buildsvc.tasks.dispatch_builds',
+        'schedule': timedelta(minutes=1),
+    },
+    'sweep-scratch': {
+        'task': 'aasemble.django.apps.buildsvc.tasks.sweep_scratch',
+        'schedule': timedelta(minutes=15),
+    },
+    'refill-key-pool': {
+        'task': 'aasemble.django.apps.buildsvc.tasks.refill_key_pool',
+        'schedule': timedelta(minutes=1),
+    },
+    'collect-artifacts': {
+        'task': 'aasemble.django.apps.buildsvc.tasks.collect_artifacts',
+        'schedule': timedelta(hours=1),
+    },
+    'apply-retention': {
+        'task': 'aasemble.django.apps.buildsvc.tasks.apply_retention',
+        'schedule': timedelta(hours=1),
+    },
+    'evict-build-environments': {
+        'task': 'aasemble.django.apps.buildsvc.tasks.evict_build_environments',
+        'schedule': timedelta(hours=1),
+    },
 }
 
 CELERY_TIMEZONE = TIME_ZONE